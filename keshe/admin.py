@@ -0,0 +1,154 @@
+"""本地管理接口
+
+服务器在 Unix 域 socket 上接受管理命令，每行一个 JSON 请求，每行返回一个 JSON 响应：
+
+    {"command": "users"}                        -> {"ok": true, "users": [...]}
+    {"command": "kick", "username": "张三"}      -> {"ok": true}
+    {"command": "delete", "filename": "a.txt"}  -> {"ok": true}
+    {"command": "stats"}                        -> {"ok": true, "stats": {...}}
+
+失败时返回 {"ok": false, "error": "..."}。socket 文件的权限是 0600，只有运行服务器的用户可以连接。
+命令在服务器的事件循环中执行，和 Qt 窗口上的按钮效果相同。
+
+命令行用法（不依赖 PyQt）:
+    python admin.py users
+    python admin.py kick 张三
+    python admin.py delete a.txt
+    python admin.py stats
+"""
+import asyncio
+import json
+import os
+import socket
+import sys
+
+from upload_store import UploadError, safe_filename
+
+ADMIN_SOCKET = 'server.sock'
+MAX_REQUEST_SIZE = 64 * 1024
+
+
+class AdminServer:
+    """挂接到 ChatServerCore 上的管理 socket"""
+
+    def __init__(self, core, path=ADMIN_SOCKET):
+        self.core = core
+        self.path = path
+        self.server = None
+
+    async def start(self):
+        if os.path.exists(self.path):
+            # 上次异常退出留下的 socket 文件
+            os.remove(self.path)
+        self.server = await asyncio.start_unix_server(self.handle, self.path, limit=MAX_REQUEST_SIZE)
+        os.chmod(self.path, 0o600)
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError("请求必须是 JSON 对象")
+                    response = self.execute(request)
+                except ValueError as e:
+                    response = {'ok': False, 'error': f"请求格式错误: {str(e)}"}
+                writer.write(json.dumps(response, ensure_ascii=False).encode() + b'\n')
+                await writer.drain()
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def execute(self, request):
+        """执行一条管理命令"""
+        command = request.get('command')
+        core = self.core
+        if command == 'users':
+            return {'ok': True, 'users': list(core.presence()[1])}
+        if command == 'kick':
+            username = request.get('username')
+            if not core.kick_user(username):
+                return {'ok': False, 'error': f"用户 {username} 不在线"}
+            return {'ok': True}
+        if command == 'delete':
+            try:
+                filename = safe_filename(request.get('filename'))
+            except UploadError as e:
+                return {'ok': False, 'error': str(e)}
+            if filename not in core.catalog.entries:
+                return {'ok': False, 'error': f"文件不存在: {filename}"}
+            if not core.delete_file(filename):
+                return {'ok': False, 'error': f"删除文件失败: {filename}"}
+            return {'ok': True}
+        if command == 'stats':
+            return {'ok': True, 'stats': core.stats()}
+        return {'ok': False, 'error': f"未知的命令: {command}"}
+
+
+def send_command(path, request, timeout=10):
+    """连接管理 socket 执行一条命令，返回响应"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(json.dumps(request, ensure_ascii=False).encode() + b'\n')
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    if not data:
+        raise ConnectionError("服务器没有响应")
+    return json.loads(data)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="聊天服务器管理工具")
+    parser.add_argument('--socket', default=ADMIN_SOCKET, help="服务器的管理 socket 路径")
+    parser.add_argument('--json', action='store_true', help="按原样输出 JSON 响应")
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('users', help="列出在线用户")
+    commands.add_parser('kick', help="强制用户下线").add_argument('username')
+    commands.add_parser('delete', help="删除服务器文件").add_argument('filename')
+    commands.add_parser('stats', help="显示服务器统计信息")
+    args = parser.parse_args(argv)
+
+    request = {'command': args.command}
+    if args.command == 'kick':
+        request['username'] = args.username
+    elif args.command == 'delete':
+        request['filename'] = args.filename
+    try:
+        response = send_command(args.socket, request)
+    except (OSError, ValueError) as e:
+        print(f"无法连接到服务器的管理 socket {args.socket}: {str(e)}", file=sys.stderr)
+        return 2
+
+    if args.json:
+        print(json.dumps(response, ensure_ascii=False, indent=2))
+    elif not response.get('ok'):
+        print(response.get('error'), file=sys.stderr)
+    elif args.command == 'users':
+        for user in response['users']:
+            print(user)
+    elif args.command == 'stats':
+        print(json.dumps(response['stats'], ensure_ascii=False, indent=2))
+    return 0 if response.get('ok') else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,125 @@
+"""广播基准测试：每次广播消耗的 CPU 时间随房间人数的变化
+
+对比旧实现（每个接收者重新 json.dumps + encode，表情分三次 send）
+和新实现（只编码一次，所有接收者共享同一缓冲区，用 writev 一次写出帧头和内容）。
+
+用法: python benchmarks/bench_broadcast.py [房间人数 ...]
+"""
+import json
+import os
+import socket
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from binary_codec import EMOJI
+from protocol import FRAME_EMOJI, HEADER_SIZE, build_frame, build_json
+from server_core import raise_fd_limit
+
+ROUNDS = 20
+EMOJI_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'emojis')
+
+
+def make_room(size):
+    senders = []
+    receivers = []
+    for _ in range(size):
+        a, b = socket.socketpair()
+        a.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1024 * 1024)
+        b.setblocking(False)
+        senders.append(a)
+        receivers.append(b)
+    return senders, receivers
+
+
+def drain(receivers):
+    for r in receivers:
+        try:
+            while r.recv(1024 * 1024):
+                pass
+        except BlockingIOError:
+            pass
+
+
+def measure(senders, receivers, broadcast):
+    total = 0.0
+    for _ in range(ROUNDS):
+        start = time.process_time()
+        broadcast(senders)
+        total += time.process_time() - start
+        drain(receivers)
+    return total / ROUNDS
+
+
+def legacy_text(data):
+    def broadcast(senders):
+        for s in senders:
+            s.send(json.dumps(data).encode())
+    return broadcast
+
+
+def shared_text(data):
+    def broadcast(senders):
+        frame = build_json(data)
+        for s in senders:
+            os.writev(s.fileno(), frame)
+    return broadcast
+
+
+def legacy_emoji(data):
+    def broadcast(senders):
+        for s in senders:
+            s.send(b'\x01')
+            s.send(struct.pack('>I', len(data)))
+            s.send(data)
+    return broadcast
+
+
+def shared_emoji(data):
+    def broadcast(senders):
+        frame = build_frame(FRAME_EMOJI, data)
+        for s in senders:
+            os.writev(s.fileno(), frame)
+    return broadcast
+
+
+def load_emoji():
+    for name in sorted(os.listdir(EMOJI_DIR)):
+        if name.endswith('.png'):
+            with open(os.path.join(EMOJI_DIR, name), 'rb') as f:
+                image = f.read()
+            head, data = EMOJI.encode(image, to='所有人', sender='alice')
+            return head[HEADER_SIZE:] + data
+    return os.urandom(4096)
+
+
+def main():
+    sizes = [int(x) for x in sys.argv[1:]] or [10, 100, 1000, 4000]
+    limit = raise_fd_limit()
+    text = {'type': 'message', 'from': 'alice', 'content': '大家好，这是一条广播消息' * 4}
+    emoji = load_emoji()
+
+    print(f"每次广播的 CPU 时间（{ROUNDS} 轮平均），表情大小 {len(emoji)} 字节")
+    print(f"{'人数':>8} {'文本-旧':>12} {'文本-新':>12} {'表情-旧':>12} {'表情-新':>12}")
+    for size in sizes:
+        if limit is not None and size * 2 + 64 > limit:
+            print(f"{size:>8} 跳过：文件描述符上限 {limit} 不足")
+            continue
+        senders, receivers = make_room(size)
+        try:
+            results = [
+                measure(senders, receivers, legacy_text(text)),
+                measure(senders, receivers, shared_text(text)),
+                measure(senders, receivers, legacy_emoji(emoji)),
+                measure(senders, receivers, shared_emoji(emoji)),
+            ]
+        finally:
+            for s in senders + receivers:
+                s.close()
+        print(f"{size:>8} " + " ".join(f"{r * 1e3:10.3f}ms" for r in results))
+
+
+if __name__ == "__main__":
+    main()
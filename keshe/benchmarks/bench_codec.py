@@ -0,0 +1,92 @@
+"""编码基准测试：pickle 与 binary_codec 编码表情帧的速度和内存分配
+
+编码：pickle.dumps(字典) 对比 Schema.encode（返回帧头和数据两个缓冲区，数据不拷贝）
+解码：pickle.loads(内容) 对比 Schema.decode（数据是指向内容的 memoryview）
+内存分配用 tracemalloc 统计一次编码 + 解码的峰值。
+
+用法: python benchmarks/bench_codec.py [数据大小(KB) ...]
+"""
+import os
+import pickle
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from binary_codec import EMOJI
+from protocol import FRAME_EMOJI, HEADER_SIZE, build_frame
+
+MIN_DURATION = 0.5
+
+
+def pickle_encode(data):
+    return build_frame(FRAME_EMOJI, pickle.dumps({
+        'type': 'emoji', 'to': 'bob', 'from': 'alice', 'content': data
+    }))
+
+
+def pickle_decode(payload):
+    return pickle.loads(payload)['content']
+
+
+def codec_encode(data):
+    return EMOJI.encode(data, to='bob', sender='alice')
+
+
+def codec_decode(payload):
+    return EMOJI.decode(payload).data
+
+
+def received_payload(frame):
+    """接收端拿到的帧内容（去掉帧头后的连续字节）"""
+    return b''.join(frame)[HEADER_SIZE:]
+
+
+def rate(func, arg):
+    """每秒调用次数"""
+    count = 0
+    start = time.perf_counter()
+    while True:
+        func(arg)
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= MIN_DURATION:
+            return count / elapsed
+
+
+def peak_allocation(encode, decode, data):
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    frame = encode(data)
+    payload = received_payload(frame)
+    del frame
+    base = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    decode(payload)
+    decode_peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    encode(data)
+    encode_peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return encode_peak, decode_peak
+
+
+def main():
+    sizes = [int(x) for x in sys.argv[1:]] or [4, 1024, 65536]
+    print(f"{'大小':>9} {'方式':>7} {'编码/秒':>10} {'解码/秒':>10} {'编码分配':>10} {'解码分配':>10}")
+    for size_kb in sizes:
+        data = os.urandom(size_kb * 1024)
+        for name, encode, decode in (('pickle', pickle_encode, pickle_decode),
+                                     ('codec', codec_encode, codec_decode)):
+            payload = received_payload(encode(data))
+            encode_rate = rate(encode, data)
+            decode_rate = rate(decode, payload)
+            encode_peak, decode_peak = peak_allocation(encode, decode, data)
+            print(f"{size_kb:>7}KB {name:>8} {encode_rate:>12.0f} {decode_rate:>12.0f} "
+                  f"{encode_peak / 1024:>10.1f}KB {decode_peak / 1024:>10.1f}KB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""压缩基准测试：各压缩算法对典型帧内容的压缩率、耗时，以及在不同带宽下的预计传输时间
+
+测试内容包括文本文件、在线用户列表和文件目录的 JSON、表情图片（PNG）、docx 和随机数据。
+每种内容分别用不压缩和本机支持的每种算法编码一次（与实际发送时的判断相同，
+不值得压缩的内容按原样发送），预计传输时间 = 压缩 + 解压耗时 + 线路字节数 / 带宽。
+
+用法: python benchmarks/bench_compression.py [带宽(Mbit/s) ...]
+"""
+import glob
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from compression import Compressor, available, decompress
+from protocol import FRAME_JSON, FRAME_CHUNK, build_frame, build_chunk, compress_frame, HEADER_SIZE
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REPEAT = 3
+
+
+def sample_payloads():
+    """[(名称, 帧类型, 内容, 文件名)]"""
+    samples = []
+    text = ''.join(f'第{i}行：今天的会议记录，请大家查收附件。status=ok user_{i % 50}\n'
+                   for i in range(20000)).encode()
+    samples.append(('文本文件', FRAME_CHUNK, text, 'notes.txt'))
+    users = json.dumps({'type': 'users_list', 'users': [f'user_{i}' for i in range(2000)],
+                        'version': 1234}).encode()
+    samples.append(('用户列表', FRAME_JSON, users, None))
+    files = json.dumps({'type': 'welcome', 'files': [
+        {'name': f'报告_{i}.pdf', 'size': i * 1024, 'mtime': 1700000000.0 + i,
+         'hash': f'{i:064x}'} for i in range(1000)]}).encode()
+    samples.append(('文件目录', FRAME_JSON, files, None))
+    for pattern, name in (('emojis/*.png', '表情PNG'), ('server_files/*.docx', 'docx')):
+        paths = glob.glob(os.path.join(BASE_DIR, pattern))
+        if paths:
+            with open(paths[0], 'rb') as f:
+                samples.append((name, FRAME_CHUNK, f.read(), paths[0]))
+    samples.append(('随机数据', FRAME_CHUNK, os.urandom(1024 * 1024), 'data.bin'))
+    return samples
+
+
+def measure(frame, compressor, filename):
+    """返回 (线路字节数, 压缩秒数, 解压秒数)"""
+    if compressor is None:
+        return sum(len(b) for b in frame), 0.0, 0.0
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        encoded = compress_frame(frame, compressor, filename)
+    compress_seconds = (time.perf_counter() - start) / REPEAT
+    wire = sum(len(b) for b in encoded)
+    if encoded is frame:
+        return wire, compress_seconds, 0.0
+    payload = b''.join(encoded)[HEADER_SIZE:]
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        decompress(payload)
+    return wire, compress_seconds, (time.perf_counter() - start) / REPEAT
+
+
+def main():
+    bandwidths = [float(x) for x in sys.argv[1:]] or [1, 10, 100]
+    algorithms = [None] + available()
+    print(f"{'内容':<8} {'算法':<6} {'原始':>10} {'线路':>10} {'压缩率':>7} {'压缩ms':>8} {'解压ms':>8} "
+          + ' '.join(f"{f'{bw:g}Mbit/s':>10}" for bw in bandwidths))
+    for name, frame_type, payload, filename in sample_payloads():
+        # 文件内容按下载时的数据块发送
+        frame = build_chunk(1, payload) if frame_type == FRAME_CHUNK else build_frame(frame_type, payload)
+        raw = sum(len(b) for b in frame)
+        for algorithm in algorithms:
+            compressor = Compressor(algorithm) if algorithm else None
+            wire, compress_seconds, decompress_seconds = measure(frame, compressor, filename)
+            estimates = [compress_seconds + decompress_seconds + wire * 8 / (bw * 1e6)
+                         for bw in bandwidths]
+            print(f"{name:<8} {algorithm or '不压缩':<6} {raw:>10} {wire:>10} {wire / raw:>7.1%} "
+                  f"{compress_seconds * 1000:>8.2f} {decompress_seconds * 1000:>8.2f} "
+                  + ' '.join(f"{t * 1000:>8.0f}ms" for t in estimates))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""下载基准测试：sendfile 下载路径的吞吐量和内存占用
+
+每个测试用例都启动一个新的服务器子进程，下载完成后读取子进程的峰值内存（VmHWM），
+减去下载前的内存即为这次下载额外占用的内存。客户端只统计字节数，不保存数据。
+
+服务器占用的内存应当与文件大小无关（旧的整帧下载路径要把整个文件读入内存，已经删除）。
+
+用法: python benchmarks/bench_download.py [文件大小(MB) ...]
+"""
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from protocol import FRAME_JSON, FRAME_CHUNK, HEADER, HEADER_SIZE, decode_json, send_json
+
+MB = 1024 * 1024
+RECV_BUFFER_SIZE = 1024 * 1024
+
+
+def serve(files_dir, port):
+    """子进程：运行服务器直到被终止"""
+    from server_core import ChatServerCore
+    core = ChatServerCore('127.0.0.1', port, files_dir=files_dir)
+    core.start_in_thread()
+    print('ready', flush=True)
+    while True:
+        time.sleep(3600)
+
+
+def memory_kb(pid, field):
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    return 0
+
+
+class FrameSkipper:
+    """只解析帧头、丢弃内容的接收端，客户端本身几乎不占内存"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray(RECV_BUFFER_SIZE)
+        self.view = memoryview(self.buffer)
+
+    def read_exact(self, size, keep=True):
+        data = bytearray() if keep else None
+        while size:
+            n = self.sock.recv_into(self.view, min(size, len(self.buffer)))
+            if not n:
+                raise ConnectionError("连接已断开")
+            if keep:
+                data += self.view[:n]
+            size -= n
+        return data
+
+    def next_frame(self):
+        """返回 (类型, 长度, JSON 消息或 None)，非 JSON 帧的内容被丢弃"""
+        frame_type, length = HEADER.unpack(self.read_exact(HEADER_SIZE))
+        if frame_type == FRAME_JSON:
+            return frame_type, length, decode_json(self.read_exact(length))
+        self.read_exact(length, keep=False)
+        return frame_type, length, None
+
+
+def login(port):
+    sock = socket.create_connection(('127.0.0.1', port))
+    send_json(sock, {'type': 'login', 'username': 'bench'})
+    reader = FrameSkipper(sock)
+    while True:
+        _, _, message = reader.next_frame()
+        if message and message['type'] == 'welcome':
+            return sock, reader
+
+
+def download_sendfile(sock, reader, filename, size):
+    send_json(sock, {'type': 'download', 'transfer_id': 1, 'filename': filename})
+    received = 0
+    while True:
+        frame_type, length, message = reader.next_frame()
+        if frame_type == FRAME_CHUNK:
+            received += length - 4
+        elif message and message['type'] == 'download_end':
+            assert received == size, (received, size)
+            return
+
+
+def run_case(files_dir, filename, size, download, port):
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve', files_dir, str(port)],
+                              stdout=subprocess.PIPE, text=True)
+    try:
+        server.stdout.readline()
+        sock, reader = login(port)
+        base = memory_kb(server.pid, 'VmRSS')
+        start = time.perf_counter()
+        download(sock, reader, filename, size)
+        elapsed = time.perf_counter() - start
+        peak = memory_kb(server.pid, 'VmHWM')
+        sock.close()
+        return size / MB / elapsed, (peak - base) / 1024
+    finally:
+        server.kill()
+        server.wait()
+
+
+def make_file(path, size):
+    block = os.urandom(MB)
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining:
+            n = min(remaining, MB)
+            f.write(block[:n])
+            remaining -= n
+
+
+def main():
+    sizes = [int(x) for x in sys.argv[1:]] or [1, 16, 256, 2048]
+    files_dir = tempfile.mkdtemp(prefix='bench-download-')
+    port = 5700
+    try:
+        print(f"{'大小':>8} {'吞吐':>12} {'内存':>10}")
+        for size_mb in sizes:
+            size = size_mb * MB
+            filename = f'bench-{size_mb}.bin'
+            make_file(os.path.join(files_dir, filename), size)
+            port += 1
+            speed, memory = run_case(files_dir, filename, size, download_sendfile, port)
+            print(f"{size_mb:>6}MB {speed:>8.0f}MB/s {memory:>8.1f}MB", flush=True)
+            os.remove(os.path.join(files_dir, filename))
+    finally:
+        shutil.rmtree(files_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == '--serve':
+        serve(sys.argv[2], int(sys.argv[3]))
+    else:
+        main()
@@ -0,0 +1,99 @@
+"""接收基准测试：recv + 拼接缓冲区的旧帧解码与 recv_into + 缓冲池的 FrameReader
+
+发送线程通过 socketpair 发送一批固定内容的帧（小消息为主，夹杂一些表情和大块数据），
+接收端分别用两种方式解码，统计吞吐量和每帧新分配的缓冲区数量。
+
+用法: python benchmarks/bench_receive.py [帧数]
+"""
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from buffer_pool import BufferPool
+from protocol import HEADER, HEADER_SIZE, FrameReader, build_frame
+
+RECV_SIZE = 65536
+
+
+class OldDecoder:
+    """旧的解码方式：recv 得到 bytes，拼接到 bytearray，每帧再复制成 bytes"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray()
+
+    def read_batch(self):
+        while True:
+            data = self.sock.recv(RECV_SIZE)
+            if not data:
+                return None
+            self.buffer += data
+            frames = []
+            offset = 0
+            while len(self.buffer) - offset >= HEADER_SIZE:
+                frame_type, length = HEADER.unpack_from(self.buffer, offset)
+                start = offset + HEADER_SIZE
+                if len(self.buffer) - start < length:
+                    break
+                frames.append((frame_type, bytes(self.buffer[start:start + length])))
+                offset = start + length
+            del self.buffer[:offset]
+            if frames:
+                return frames
+
+
+def make_stream(count):
+    sizes = []
+    for i in range(count):
+        if i % 100 == 99:
+            sizes.append(256 * 1024)   # 数据块
+        elif i % 10 == 9:
+            sizes.append(3000)         # 表情
+        else:
+            sizes.append(120)          # 聊天消息
+    return b''.join(b''.join(build_frame(0, b'x' * size)) for size in sizes), sum(sizes)
+
+
+def run(make_reader, stream, count):
+    receiver, sender = socket.socketpair()
+
+    def send():
+        sender.sendall(stream)
+        sender.close()
+
+    thread = threading.Thread(target=send)
+    reader = make_reader(receiver)
+    start = time.perf_counter()
+    thread.start()
+    frames = 0
+    while True:
+        batch = reader.read_batch()
+        if batch is None:
+            break
+        frames += len(batch)
+    elapsed = time.perf_counter() - start
+    thread.join()
+    receiver.close()
+    assert frames == count, frames
+    return elapsed
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    stream, payload_bytes = make_stream(count)
+    print(f"{count} 帧，共 {payload_bytes / 1024 / 1024:.1f}MB")
+    elapsed = run(OldDecoder, stream, count)
+    print(f"旧解码:      {payload_bytes / elapsed / 1024 / 1024:8.0f}MB/s  每帧分配 1 个 bytes")
+    pool = BufferPool()
+    elapsed = run(lambda sock: FrameReader(sock, pool), stream, count)
+    stats = pool.stats()
+    print(f"FrameReader: {payload_bytes / elapsed / 1024 / 1024:8.0f}MB/s  "
+          f"新分配 {stats['allocated']} 个缓冲区，复用 {stats['reused']} 次")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""路由表基准测试：10k 在线用户时的查找、加入/离开和广播快照开销
+
+用法: python benchmarks/bench_routing.py [用户数]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from routing import RoutingTable
+
+
+class FakeConnection:
+    __slots__ = ('username',)
+
+    def __init__(self, username):
+        self.username = username
+
+
+def timeit(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+def report(name, seconds):
+    if seconds < 1e-3:
+        print(f"  {name:<28} {seconds * 1e9:12.0f} ns")
+    else:
+        print(f"  {name:<28} {seconds * 1e3:12.3f} ms")
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    names = [f"user{i}" for i in range(users)]
+    conns = [FakeConnection(name) for name in names]
+
+    table = RoutingTable()
+    legacy = {}  # 旧实现: {socket: username}，按用户名查找需要线性扫描
+    for name, conn in zip(names, conns):
+        table.add(name, conn)
+        legacy[conn] = name
+
+    targets = [random.choice(names) for _ in range(1000)]
+
+    def legacy_lookup():
+        for to in targets:
+            for c, name in legacy.items():
+                if name == to:
+                    break
+
+    def table_lookup():
+        for to in targets:
+            table.get(to)
+
+    def join_leave():
+        conn = FakeConnection('newcomer')
+        table.add('newcomer', conn)
+        table.remove(conn)
+
+    def snapshot_after_change():
+        join_leave()
+        table.snapshot()
+
+    def fanout():
+        for conn in table.snapshot():
+            pass
+
+    print(f"在线用户数: {users}")
+    report("线性扫描查找（旧实现）", timeit(legacy_lookup, 3) / len(targets))
+    report("索引查找", timeit(table_lookup, 100) / len(targets))
+    report("加入 + 离开", timeit(join_leave, 10000))
+    report("缓存快照", timeit(table.snapshot, 100000))
+    report("成员变化后重建快照", timeit(snapshot_after_change, 200))
+    report("遍历快照广播", timeit(fanout, 200))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""多进程服务器基准测试：私聊消息的吞吐量随工作进程数的变化
+
+对每个工作进程数启动一次 server.py --workers N，由 LOAD_PROCESSES 个压测进程各自登录 PAIRS 对用户，
+每对用户互相发私聊消息（每次最多 WINDOW 条未收到的消息），统计 DURATION 秒内送达的消息数。
+两个用户连接到不同的工作进程时，消息经过 broker 转发。
+
+压测进程和服务器运行在同一台机器上，吞吐量只有在 CPU 核数多于 工作进程数 + 压测进程数 时才能体现出扩展性。
+
+用法: python benchmarks/bench_workers.py [工作进程数 ...]
+"""
+import asyncio
+import json
+import multiprocessing
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+KESHE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, KESHE_DIR)
+
+from protocol import HEADER, build_json
+
+LOAD_PROCESSES = 4
+PAIRS = 25
+WINDOW = 32
+DURATION = 5
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def read_frame(reader):
+    frame_type, length = HEADER.unpack(await reader.readexactly(HEADER.size))
+    return frame_type, await reader.readexactly(length)
+
+
+async def login(port, username):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.writelines(build_json({'type': 'login', 'username': username}))
+    await read_frame(reader)  # welcome
+    return reader, writer
+
+
+async def run_pair(port, name, deadline, counts):
+    """两个用户互相发私聊消息，每个方向最多 WINDOW 条在途"""
+    a = await login(port, f"{name}a")
+    b = await login(port, f"{name}b")
+    content = 'x' * 64
+
+    async def direction(sender, receiver, to):
+        while time.monotonic() < deadline:
+            frame = build_json({'type': 'message', 'to': to, 'content': content})
+            sender[1].writelines(list(frame) * WINDOW)
+            await sender[1].drain()
+            received = 0
+            while received < WINDOW:
+                frame_type, payload = await read_frame(receiver[0])
+                if json.loads(payload)['type'] == 'private_message':
+                    received += 1
+            counts[0] += received
+
+    await asyncio.gather(direction(a, b, f"{name}b"), direction(b, a, f"{name}a"))
+    for _, writer in (a, b):
+        writer.close()
+
+
+def load(port, index, start, results):
+    async def main():
+        counts = [0]
+        await asyncio.sleep(max(start - time.time(), 0))
+        deadline = time.monotonic() + DURATION
+        await asyncio.gather(*(run_pair(port, f"p{index}-{i}", deadline, counts) for i in range(PAIRS)))
+        results.put(counts[0])
+    asyncio.run(main())
+
+
+def measure(workers):
+    port = free_port()
+    workdir = tempfile.mkdtemp(prefix='bench-workers-')
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(KESHE_DIR, 'server.py'), '--host', '127.0.0.1', '--port', str(port),
+         '--workers', str(workers), '--files-dir', os.path.join(workdir, 'files'),
+         '--broker-socket', os.path.join(workdir, 'broker.sock'), '--admin-socket', 'off',
+         '--log-file', 'off', '--compression', 'off', '--quiet'],
+        cwd=workdir)
+    try:
+        time.sleep(1 + 0.5 * workers)
+        results = multiprocessing.Queue()
+        start = time.time() + 1
+        loaders = [multiprocessing.Process(target=load, args=(port, i, start, results))
+                   for i in range(LOAD_PROCESSES)]
+        for loader in loaders:
+            loader.start()
+        total = sum(results.get() for _ in loaders)
+        for loader in loaders:
+            loader.join()
+        return total / DURATION
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def main():
+    counts = [int(x) for x in sys.argv[1:]] or [1, 2, 4]
+    print(f"CPU 核数 {os.cpu_count()}，{LOAD_PROCESSES} 个压测进程 × {PAIRS} 对用户，每次 {DURATION} 秒")
+    print(f"{'工作进程':>8} {'消息/秒':>12} {'相对单进程':>10}")
+    base = None
+    for workers in counts:
+        rate = measure(workers)
+        if base is None:
+            base = rate
+        print(f"{workers:>8} {rate:12.0f} {rate / base:10.2f}")
+
+
+if __name__ == "__main__":
+    main()
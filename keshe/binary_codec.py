@@ -0,0 +1,83 @@
+"""表情帧的二进制编码（取代 pickle）
+
+内容的布局是固定的：
+
+    1 字节编码版本 | 1 字节动作 | 每个字符串字段 2 字节长度 | 字符串字段（UTF-8）| 二进制数据
+
+二进制数据放在最后，长度由帧长度推出。编码时不拷贝数据，直接和帧头组成缓冲区元组交给
+writev；解码时返回指向原缓冲区的 memoryview。解码只做 struct 解析，不会像 pickle 那样执行代码。
+"""
+import struct
+
+from protocol import FRAME_EMOJI, HEADER
+
+CODEC_VERSION = 1
+
+ACTION_SEND = 0  # 发送表情
+ACTION_DATA = 2  # 表情图片请求（emoji_get）的响应
+
+MAX_FIELD_SIZE = 0xFFFF
+
+
+class CodecError(ValueError):
+    """帧内容不符合编码格式"""
+
+
+class Record:
+    """解码结果：字符串字段是属性，二进制数据 data 是 memoryview"""
+
+    __slots__ = ('action', 'to', 'sender', 'data')
+
+    def __init__(self, action):
+        self.action = action
+        self.to = ''
+        self.sender = ''
+        self.data = None
+
+
+class Schema:
+    """一种帧的字段布局"""
+
+    def __init__(self, frame_type, fields):
+        self.frame_type = frame_type
+        self.fields = fields
+        self.header = struct.Struct('>BB' + 'H' * len(fields))
+
+    def encode(self, data=b'', action=ACTION_SEND, **values):
+        """编码成 (帧头, 数据) 缓冲区元组，可以直接放进出站队列或交给 FrameWriter.send_buffers"""
+        encoded = []
+        for name in self.fields:
+            raw = (values.pop(name, None) or '').encode()
+            if len(raw) > MAX_FIELD_SIZE:
+                raise CodecError(f"字段 {name} 太长")
+            encoded.append(raw)
+        if values:
+            raise CodecError(f"未知的字段: {', '.join(values)}")
+        head = self.header.pack(CODEC_VERSION, action, *[len(raw) for raw in encoded])
+        head += b''.join(encoded)
+        return (HEADER.pack(self.frame_type, len(head) + len(data)) + head, data)
+
+    def decode(self, payload):
+        """解析帧内容，返回 Record"""
+        view = memoryview(payload)
+        if len(view) < self.header.size:
+            raise CodecError("帧内容太短")
+        version, action, *lengths = self.header.unpack_from(view)
+        if version != CODEC_VERSION:
+            raise CodecError(f"不支持的编码版本: {version}")
+        record = Record(action)
+        offset = self.header.size
+        for name, length in zip(self.fields, lengths):
+            end = offset + length
+            if end > len(view):
+                raise CodecError("帧内容太短")
+            try:
+                setattr(record, name, str(view[offset:end], 'utf-8'))
+            except UnicodeDecodeError:
+                raise CodecError(f"字段 {name} 不是合法的 UTF-8") from None
+            offset = end
+        record.data = view[offset:]
+        return record
+
+
+EMOJI = Schema(FRAME_EMOJI, ('to', 'sender'))
@@ -0,0 +1,305 @@
+"""多进程服务器的本地代理（broker）
+
+server.py --workers N 启动 N 个工作进程，它们用 SO_REUSEPORT 监听同一个端口，由内核分配新连接。
+每个工作进程只持有连接到自己的用户，在线状态和跨进程的转发都经过主进程中的 Broker（Unix 域 socket）：
+
+- claim / release：登记、注销用户名。Broker 保证用户名全局唯一，维护全局的在线状态版本号，
+  每次变化都用一条 presence 消息通知所有工作进程（发起登记的进程把它当作登记成功的应答）；
+- deliver：把一帧转发给连接在其他进程上的用户；
+- broadcast：把一帧转发给其他所有进程，由它们发给各自的用户；
+- kick：让用户所在的进程强制它下线；
+- emoji：把新加入的自定义表情同步给其他进程的表情目录。
+
+链路上都是 protocol.py 的帧。控制消息是 JSON 帧，deliver / broadcast / emoji 的控制消息后面紧跟着
+要转发的那一帧，Broker 只看控制消息，转发的帧原样写出，不解码也不拷贝。
+链路积压超过 LINK_MAX_BUFFER 时丢弃可丢弃的广播，其他消息则断开这条链路（见 send_op），
+工作进程随后退出，由主进程重新启动。
+
+工作进程一侧的 BrokerClient 是 ChatServerCore 的 cluster 接口（见 ChatServerCore.__init__）：
+connect、close、claim、release、presence、locate、deliver、broadcast、kick、share_emoji。
+"""
+import asyncio
+import os
+
+from protocol import FRAME_EMOJI, FrameProtocol, build_frame, build_json, decode_json
+from outbound import write_vectored
+
+BROKER_SOCKET = 'broker.sock'
+CONNECT_TIMEOUT = 10  # 工作进程等待 Broker 启动的最长时间（秒）
+FRAME_OPS = ('deliver', 'broadcast', 'emoji')  # 后面紧跟一帧数据的控制消息
+LINK_MAX_BUFFER = 16 * 1024 * 1024  # 链路积压的字节数上限，一条链路承载一个工作进程所有用户的消息
+
+
+def send_op(writer, message, frame=None, droppable=False, limit=LINK_MAX_BUFFER):
+    """写出一条控制消息（以及紧跟的数据帧），返回是否已写出
+
+    对方读得太慢、链路积压超过 limit 字节时，与客户端发送队列的 drop 策略相同：
+    可丢弃的消息直接丢弃，其他消息则断开链路，积压不会无限增长。
+    """
+    transport = writer.transport
+    if transport.is_closing():
+        return False
+    if transport.get_write_buffer_size() > limit:
+        if not droppable:
+            transport.abort()
+        return False
+    buffers = list(build_json(message))
+    if frame is not None:
+        buffers.extend(frame)
+    try:
+        write_vectored(transport, buffers)
+    except ConnectionError:
+        # 对方已经退出，读协程随后会收到连接关闭
+        transport.abort()
+        return False
+    return True
+
+
+async def read_ops(reader, handle):
+    """读取控制消息，逐条调用 handle(消息, 紧跟的数据帧或 None)，连接关闭时返回"""
+    pending = None  # 等待数据帧的控制消息
+    while True:
+        frames = await reader.read_batch()
+        if not frames:
+            return
+        for frame_type, payload in frames:
+            if pending is not None:
+                message, pending = pending, None
+                handle(message, build_frame(frame_type, payload))
+                continue
+            message = decode_json(payload)
+            if message.get('op') in FRAME_OPS:
+                pending = message
+            else:
+                handle(message, None)
+
+
+class Broker:
+    """在主进程中运行，记录每个用户名所在的工作进程"""
+
+    def __init__(self, path):
+        self.path = path
+        self.server = None
+        self.workers = {}  # {工作进程编号: StreamWriter}
+        self.users = {}    # {用户名: 工作进程编号}，保持登录顺序
+        self.version = 0   # 全局在线状态版本号
+
+    async def start(self):
+        if os.path.exists(self.path):
+            # 上次异常退出留下的 socket 文件
+            os.remove(self.path)
+        loop = asyncio.get_running_loop()
+        self.server = await loop.create_unix_server(lambda: FrameProtocol(self.handle_worker), self.path)
+        os.chmod(self.path, 0o600)
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    async def handle_worker(self, reader, writer):
+        worker = None
+
+        def handle(message, frame):
+            nonlocal worker
+            op = message.get('op')
+            if op == 'hello':
+                worker = message['worker']
+                old = self.workers.get(worker)
+                if old is not None:
+                    old.close()
+                self.release_worker(worker)
+                self.workers[worker] = writer
+                send_op(writer, {'op': 'snapshot', 'users': self.users, 'version': self.version})
+            elif worker is None:
+                raise ConnectionError("工作进程没有先发送 hello")
+            elif op == 'claim':
+                self.claim(worker, message['user'])
+            elif op == 'release':
+                self.release(worker, message['user'])
+            elif op == 'deliver':
+                self.forward(self.users.get(message['user']), message, frame)
+            elif op == 'kick':
+                self.forward(self.users.get(message['user']), message)
+            elif op in ('broadcast', 'emoji'):
+                for other in list(self.workers):
+                    if other != worker:
+                        self.forward(other, message, frame)
+
+        try:
+            await read_ops(reader, handle)
+        except (ConnectionError, ValueError, KeyError) as e:
+            print(f"工作进程 {worker} 的 broker 连接出错: {str(e)}")
+        finally:
+            writer.close()
+            if worker is not None and self.workers.get(worker) is writer:
+                del self.workers[worker]
+                # 工作进程退出后，它的用户全部下线
+                self.release_worker(worker)
+
+    def claim(self, worker, username):
+        if username in self.users:
+            self.forward(worker, {'op': 'claim_failed', 'user': username})
+            return
+        self.users[username] = worker
+        self.publish('join', username, worker)
+
+    def release(self, worker, username):
+        if self.users.get(username) == worker:
+            del self.users[username]
+            self.publish('leave', username, worker)
+
+    def release_worker(self, worker):
+        for username in [name for name, owner in self.users.items() if owner == worker]:
+            self.release(worker, username)
+
+    def publish(self, change, username, worker):
+        self.version += 1
+        message = {'op': 'presence', 'change': change, 'user': username,
+                   'worker': worker, 'version': self.version}
+        for other in list(self.workers):
+            self.forward(other, message)
+
+    def forward(self, worker, message, frame=None):
+        writer = self.workers.get(worker)
+        if writer is not None:
+            send_op(writer, message, frame, droppable=message.get('droppable', False))
+
+
+class BrokerClient:
+    """工作进程一侧的 Broker 连接，作为 ChatServerCore 的 cluster 接口"""
+
+    def __init__(self, path, worker):
+        self.path = path
+        self.worker = worker
+        self.core = None
+        self.writer = None
+        self.users = {}   # 全局在线用户的镜像 {用户名: 工作进程编号}
+        self.names = ()   # 用户名快照
+        self.version = 0
+        self.claims = {}  # {用户名: 等待登记结果的 Future}
+        self.ready = None
+
+    async def connect(self, core):
+        """连接 Broker 并取得在线用户快照；Broker 可能还没启动，在 CONNECT_TIMEOUT 内重试"""
+        self.core = core
+        loop = asyncio.get_running_loop()
+        self.ready = loop.create_future()
+        deadline = loop.time() + CONNECT_TIMEOUT
+        while True:
+            try:
+                await loop.create_unix_connection(lambda: FrameProtocol(self.run), self.path)
+                break
+            except OSError:
+                if loop.time() > deadline:
+                    raise
+                await asyncio.sleep(0.1)
+        await self.ready
+
+    async def run(self, reader, writer):
+        self.writer = writer
+        send_op(writer, {'op': 'hello', 'worker': self.worker})
+        try:
+            await read_ops(reader, self.handle)
+        except (ConnectionError, ValueError, KeyError) as e:
+            self.core.log_message(f"broker 连接出错: {str(e)}")
+        finally:
+            writer.close()
+            self.writer = None
+            for future in self.claims.values():
+                if not future.done():
+                    future.set_result(False)
+            self.claims.clear()
+            if not self.ready.done():
+                self.ready.set_exception(ConnectionError("broker 连接已关闭"))
+            self.core.on_cluster_lost()
+
+    def handle(self, message, frame):
+        op = message['op']
+        core = self.core
+        if op == 'snapshot':
+            self.users = dict(message['users'])
+            self.names = tuple(self.users)
+            self.version = message['version']
+            self.ready.set_result(None)
+        elif op == 'presence':
+            username = message['user']
+            if message['change'] == 'join':
+                self.users[username] = message['worker']
+            else:
+                self.users.pop(username, None)
+            self.names = tuple(self.users)
+            self.version = message['version']
+            if message['change'] == 'join' and message['worker'] == self.worker:
+                # 本进程的登记成功；其他进程登记、注销同名用户时等待的登记结果由 claim_failed 给出
+                future = self.claims.pop(username, None)
+                if future is not None and not future.done():
+                    future.set_result(True)
+            core.on_cluster_presence(message['change'], username)
+        elif op == 'claim_failed':
+            future = self.claims.pop(message['user'], None)
+            if future is not None and not future.done():
+                future.set_result(False)
+        elif op == 'deliver':
+            conn = core.find_client(message['user'])
+            if conn is not None:
+                core.send_encoded(conn, frame)
+        elif op == 'broadcast':
+            core.multicast(frame, droppable=message.get('droppable', False))
+        elif op == 'kick':
+            core.kick_user(message['user'])
+        elif op == 'emoji':
+            core.emojis.add(frame[1])
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+    # ---------- cluster 接口 ----------
+
+    async def claim(self, username):
+        """登记用户名，被其他进程的用户占用时返回 False"""
+        if self.writer is None or username in self.claims:
+            return False
+        future = asyncio.get_running_loop().create_future()
+        self.claims[username] = future
+        send_op(self.writer, {'op': 'claim', 'user': username})
+        return await future
+
+    def release(self, username):
+        if self.writer is not None:
+            send_op(self.writer, {'op': 'release', 'user': username})
+
+    def presence(self):
+        """返回全局的 (版本号, 用户名快照)"""
+        return self.version, self.names
+
+    def locate(self, username):
+        """用户是否在其他进程上在线"""
+        owner = self.users.get(username)
+        return owner is not None and owner != self.worker
+
+    def deliver(self, username, frame):
+        """把已编码的帧转发给其他进程上的用户，用户不在线时返回 False"""
+        if self.writer is None or not self.locate(username):
+            return False
+        return send_op(self.writer, {'op': 'deliver', 'user': username}, frame)
+
+    def broadcast(self, frame, droppable=False):
+        """把已编码的帧转发给其他所有进程上的用户"""
+        if self.writer is not None and len(self.users) > len(self.core.clients):
+            send_op(self.writer, {'op': 'broadcast', 'droppable': droppable}, frame, droppable=droppable)
+
+    def kick(self, username):
+        if self.writer is None or not self.locate(username):
+            return False
+        return send_op(self.writer, {'op': 'kick', 'user': username})
+
+    def share_emoji(self, data):
+        """把新加入的自定义表情同步给其他进程"""
+        if self.writer is not None:
+            send_op(self.writer, {'op': 'emoji'}, build_frame(FRAME_EMOJI, data))
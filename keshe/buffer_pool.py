@@ -0,0 +1,82 @@
+"""按大小分级的接收缓冲池
+
+较大的帧（见 protocol.FrameAssembler）的内容各自放在一个独立的 bytearray 中，用 recv_into 直接读入。
+缓冲区的大小按 2 的幂分级，用完后放回对应级别的空闲列表，稳定收发时不再反复向内存分配器申请和释放。
+
+帧内容以 memoryview 的形式交给调用方，不做拷贝。缓冲区放回池中之前会检查是否还有
+memoryview 引用它（bytearray 在有 memoryview 时不能改变大小），调用方仍在使用的缓冲区不会被复用，
+只是交给垃圾回收，因此调用方不必显式归还。
+"""
+import threading
+
+MIN_CLASS = 4 * 1024              # 最小的级别
+MAX_CLASS = 4 * 1024 * 1024       # 大于这个大小的帧直接分配，不进入缓冲池
+MAX_FREE_BYTES = 16 * 1024 * 1024  # 每个级别最多保留的空闲字节数
+
+
+def size_class(size):
+    """size 所在的级别（不小于 size 的 2 的幂）"""
+    if size <= MIN_CLASS:
+        return MIN_CLASS
+    return 1 << (size - 1).bit_length()
+
+
+def in_use(buffer):
+    """缓冲区是否还有 memoryview 引用"""
+    try:
+        buffer.append(0)
+    except BufferError:
+        return True
+    del buffer[-1]
+    return False
+
+
+class BufferPool:
+    """线程安全的缓冲池，多个连接和线程可以共用"""
+
+    def __init__(self, max_free_bytes=MAX_FREE_BYTES):
+        self.max_free_bytes = max_free_bytes
+        self.free = {}  # {级别: [bytearray, ...]}
+        self.lock = threading.Lock()
+        self.allocated = 0  # 新分配的缓冲区数
+        self.reused = 0     # 从池中取出复用的次数
+
+    def acquire(self, size):
+        """取一个长度不小于 size 的缓冲区"""
+        if size > MAX_CLASS:
+            self.allocated += 1
+            return bytearray(size)
+        cls = size_class(size)
+        with self.lock:
+            buffers = self.free.get(cls)
+            if buffers:
+                self.reused += 1
+                return buffers.pop()
+            self.allocated += 1
+        return bytearray(cls)
+
+    def release(self, buffer):
+        """归还缓冲区；不属于任何级别、空闲列表已满或者仍被引用的缓冲区直接丢弃"""
+        self.release_all((buffer,))
+
+    def release_all(self, buffers):
+        """一次归还多个缓冲区"""
+        reusable = [buffer for buffer in buffers
+                    if len(buffer) <= MAX_CLASS and len(buffer) == size_class(len(buffer))
+                    and not in_use(buffer)]
+        if not reusable:
+            return
+        with self.lock:
+            for buffer in reusable:
+                free = self.free.setdefault(len(buffer), [])
+                if (len(free) + 1) * len(buffer) <= self.max_free_bytes:
+                    free.append(buffer)
+
+    def stats(self):
+        with self.lock:
+            free = {cls: len(buffers) for cls, buffers in sorted(self.free.items()) if buffers}
+        return {'allocated': self.allocated, 'reused': self.reused, 'free': free}
+
+
+# 默认的全局缓冲池
+default_pool = BufferPool()
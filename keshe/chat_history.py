@@ -0,0 +1,110 @@
+"""聊天记录
+
+全部记录保存在本地 sqlite 文件中，内存里只保留一段连续的记录（窗口），最多 WINDOW_SIZE 条。
+界面只显示窗口中的记录：停在底部时新消息追加到窗口末尾、同时丢掉最早的；
+向上翻到窗口开头时从 sqlite 读入更早的一页，丢掉末尾的；向下翻到窗口末尾时再读入较新的一页。
+无论总共有多少条记录，内存占用和每次追加、翻页的开销都只和窗口大小有关。
+
+每条记录是 (编号, 文本, 表情编号)，不是表情时表情编号为 None。不依赖 Qt，只在界面线程中使用。
+默认的 sqlite 文件是临时文件，关闭时删除。
+"""
+import collections
+import os
+import sqlite3
+import tempfile
+
+WINDOW_SIZE = 500  # 内存中最多保留的记录数
+PAGE_SIZE = 100    # 翻到窗口边缘时一次读入的记录数
+
+
+class ChatHistory:
+
+    def __init__(self, path=None, window_size=WINDOW_SIZE):
+        self.temporary = path is None
+        if path is None:
+            fd, path = tempfile.mkstemp(prefix='chat-', suffix='.sqlite3')
+            os.close(fd)
+        self.path = path
+        self.window_size = window_size
+        self.window = collections.deque()  # 当前窗口中的记录，按编号升序
+        self.db = sqlite3.connect(path)
+        if self.temporary:
+            # 临时文件不需要在崩溃后恢复
+            self.db.execute("PRAGMA journal_mode=MEMORY")
+            self.db.execute("PRAGMA synchronous=OFF")
+        self.db.execute("CREATE TABLE IF NOT EXISTS messages "
+                        "(id INTEGER PRIMARY KEY, text TEXT NOT NULL, emoji TEXT)")
+        row = self.db.execute("SELECT MAX(id) FROM messages").fetchone()
+        self.last_id = row[0] or 0
+        self.window.extend(self.latest())
+
+    def __len__(self):
+        return len(self.window)
+
+    def __getitem__(self, row):
+        return self.window[row]
+
+    def store(self, entries):
+        """保存新记录 [(文本, 表情编号), ...]，返回带编号的记录（尚未加入窗口）"""
+        rows = []
+        for text, emoji in entries:
+            self.last_id += 1
+            rows.append((self.last_id, text, emoji))
+        with self.db:
+            self.db.executemany("INSERT INTO messages (id, text, emoji) VALUES (?, ?, ?)", rows)
+        return rows
+
+    def at_end(self):
+        """窗口是否已经包含最新的记录"""
+        if not self.window:
+            return self.last_id == 0
+        return self.window[-1][0] == self.last_id
+
+    def latest(self):
+        """最新的一个窗口的记录（升序）"""
+        return self._query("SELECT id, text, emoji FROM messages WHERE id > ? ORDER BY id",
+                           (self.last_id - self.window_size,))
+
+    def older(self, limit=PAGE_SIZE):
+        """窗口之前的至多 limit 条记录（升序）"""
+        if not self.window:
+            return []
+        rows = self._query("SELECT id, text, emoji FROM messages WHERE id < ? "
+                           "ORDER BY id DESC LIMIT ?", (self.window[0][0], limit))
+        rows.reverse()
+        return rows
+
+    def newer(self, limit=PAGE_SIZE):
+        """窗口之后的至多 limit 条记录（升序）"""
+        start = self.window[-1][0] if self.window else 0
+        return self._query("SELECT id, text, emoji FROM messages WHERE id > ? "
+                           "ORDER BY id LIMIT ?", (start, limit))
+
+    def extend(self, rows):
+        self.window.extend(rows)
+
+    def prepend(self, rows):
+        self.window.extendleft(reversed(rows))
+
+    def drop_front(self, count):
+        for _ in range(count):
+            self.window.popleft()
+
+    def drop_back(self, count):
+        for _ in range(count):
+            self.window.pop()
+
+    def excess(self):
+        """窗口超出上限的条数"""
+        return max(len(self.window) - self.window_size, 0)
+
+    def close(self):
+        self.db.close()
+        if self.temporary:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def _query(self, sql, params):
+        return [tuple(row) for row in self.db.execute(sql, params)]
@@ -9,8 +9,14 @@ from PIL import Image, ImageTk
 from io import BytesIO
 import math
 import time
-import pickle
-import struct
+from presence import PresenceTracker
+from emoji_catalog import EmojiCache
+import compression
+from binary_codec import EMOJI, ACTION_DATA
+from protocol import (FRAME_JSON, FRAME_EMOJI, FRAME_CHUNK, FrameReader,
+                      FrameWriter, decode_json)
+from transfer_client import (UploadManager, DownloadManager, ParallelDownload,
+                             can_download_parallel)
 
 CHUNK_SIZE = 1024 * 1024  # 1MB chunks for file transfer
 
@@ -73,11 +79,19 @@ class ChatClient:
         self.setup_network()
         self.setup_gui()
         self.file_chunks = {}  # 用于存储文件传输的临时数据
+        self.presence = PresenceTracker()  # 在线用户版本跟踪
+        self.server_catalog = {}  # 服务器文件目录 {文件名: {name, size, mtime, hash}}
+        self.transfer_token = None  # 欢迎消息中的传输连接令牌，并行下载时出示
         
     def setup_network(self):
         self.host = 'localhost'
         self.port = 5000
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # 接收线程、界面线程和上传线程共用同一个发送器，保证帧不会交错
+        self.sender = FrameWriter(self.client_socket)
+        self.uploads = UploadManager()
+        self.downloads = DownloadManager()
+        self.emoji_cache = EmojiCache()
         
     def setup_gui(self):
         self.window = tk.Tk()
@@ -144,26 +158,15 @@ class ChatClient:
             selected = self.users_list.curselection()
             to = self.users_list.get(selected[0]) if selected else "所有人"
             
-            # 读取表情图片
-            with open(emoji_path, 'rb') as f:
-                image_data = f.read()
-            
-            # 创建表情数据包
-            emoji_data = {
-                'type': 'emoji',
-                'to': to,
-                'image': image_data
-            }
-            
-            # 序列化数据
-            data = pickle.dumps(emoji_data)
-            
-            # 发送消息类型标记（1字节）
-            self.client_socket.send(b'\x01')
-            # 发送数据长度（4字节）
-            self.client_socket.send(struct.pack('>I', len(data)))
-            # 发送序列化后的数据
-            self.client_socket.send(data)
+            # 服务器已有的表情只发送编号，否则发送完整的表情帧（服务器会把它加入表情目录）
+            key = self.emoji_cache.local_id(emoji_path)
+            if key in self.emoji_cache.known:
+                self.sender.send_json({'type': 'emoji', 'id': key, 'to': to})
+            else:
+                with open(emoji_path, 'rb') as f:
+                    image_data = f.read()
+                self.sender.send_buffers(EMOJI.encode(image_data, to=to))
+                self.emoji_cache.known.add(key)
             
             # 显示发送的表情
             image = Image.open(emoji_path)
@@ -183,36 +186,32 @@ class ChatClient:
             selected = self.users_list.curselection()
             to = self.users_list.get(selected[0]) if selected else "所有人"
             
-            try:
-                with open(file_path, 'rb') as f:
-                    file_data = f.read()
-                    
-                # 创建文件数据包
-                file_package = {
-                    'type': 'file',
-                    'filename': os.path.basename(file_path),
-                    'to': to,
-                    'content': file_data
-                }
-                
-                # 序列化数据
-                data = pickle.dumps(file_package)
-                
-                # 发送消息类型标记（1字节）
-                self.client_socket.send(b'\x02')  # 文件消息标记
-                # 发送数据长度（4字节）
-                self.client_socket.send(struct.pack('>I', len(data)))
-                
-                # 分块发送序列化数据
-                chunk_size = 8192
-                for i in range(0, len(data), chunk_size):
-                    chunk = data[i:i + chunk_size]
-                    self.client_socket.send(chunk)
-                    
-                self.display_message(f"文件 {os.path.basename(file_path)} 发送完成")
-                
-            except Exception as e:
-                messagebox.showerror("文件发送错误", str(e))
+            if to == "所有人":
+                # 上传到服务器的文件分块发送，在后台线程中进行，不阻塞界面
+                threading.Thread(target=self.upload_to_server, args=(file_path,), daemon=True).start()
+                self.display_message(f"正在上传文件 {os.path.basename(file_path)} ...")
+                return
+            
+            # 私发的文件也分块发送，服务器边收边转发给对方
+            threading.Thread(target=self.relay_to_user, args=(file_path, to), daemon=True).start()
+            self.display_message(f"正在发送文件 {os.path.basename(file_path)} 给 {to} ...")
+
+    def upload_to_server(self, file_path):
+        try:
+            self.uploads.upload(self.sender, file_path,
+                                progress=lambda offset: self.upload_resumed(file_path, offset))
+        except Exception as e:
+            self.display_message(f"文件上传失败: {str(e)}")
+
+    def relay_to_user(self, file_path, to):
+        try:
+            self.uploads.relay(self.sender, file_path, to)
+        except Exception as e:
+            self.display_message(f"文件发送失败: {str(e)}")
+
+    def upload_resumed(self, file_path, offset):
+        if offset:
+            self.display_message(f"文件 {os.path.basename(file_path)} 从 {offset} 字节处继续上传")
 
     def receive_file_chunk(self, data):
         file_id = data.get('file_id')
@@ -248,7 +247,8 @@ class ChatClient:
         try:
             self.client_socket.connect((self.host, self.port))
             self.username = username
-            self.client_socket.send(username.encode())
+            self.sender.send_json({'type': 'login', 'username': username,
+                                   'compression': compression.available()})
             
             # 启动接收消息的线程
             receive_thread = threading.Thread(target=self.receive_messages)
@@ -273,7 +273,7 @@ class ChatClient:
             }
             
             try:
-                self.client_socket.send(json.dumps(data).encode())
+                self.sender.send_json(data)
                 self.message_entry.delete(0, tk.END)
                 if to == 'all':
                     self.display_message(f"你: {message}")
@@ -282,6 +282,25 @@ class ChatClient:
             except:
                 messagebox.showerror("发送错误", "消息发送失败")
                 
+    def receive_emoji(self, data):
+        """按编号收到的表情：有缓存直接显示，否则向服务器请求一次图片"""
+        if data.get('to', '所有人') == '所有人':
+            prefix = f"{data['from']}: "
+        else:
+            prefix = f"{data['from']}对你说: "
+        image_data = self.emoji_cache.get(data['id'])
+        if image_data is not None:
+            self.display_emoji(prefix, image_data)
+        elif self.emoji_cache.wait(data['id'], prefix):
+            self.sender.send_json({'type': 'emoji_get', 'id': data['id']})
+
+    def display_emoji(self, prefix, image_data):
+        image = Image.open(BytesIO(image_data))
+        image = image.resize((40, 40), Image.Resampling.LANCZOS)
+        if prefix:
+            self.display_message(prefix)
+        self.display_image(image)
+
     def display_image(self, image):
         # 在聊天区域显示图片
         photo = ImageTk.PhotoImage(image)
@@ -303,134 +322,214 @@ class ChatClient:
         )
         
         if save_path:
-            # 创建下载请求数据包
-            download_request = {
-                'type': 'file',
-                'action': 'download',
-                'filename': filename,
-                'save_path': save_path
-            }
-            
-            # 序列化数据
-            data = pickle.dumps(download_request)
-            
-            # 发送消息类型标记（1字节）
-            self.client_socket.send(b'\x02')  # 文件消息标记
-            # 发送数据长度（4字节）
-            self.client_socket.send(struct.pack('>I', len(data)))
-            # 发送序列化后的数据
-            self.client_socket.send(data)
+            entry = self.server_catalog.get(filename)
+            if entry is not None and can_download_parallel(entry['size']):
+                # 大文件通过多个传输连接分段并行下载
+                download = ParallelDownload((self.host, self.port), self.username, self.transfer_token,
+                                            filename, save_path, entry['size'], entry['hash'])
+                threading.Thread(target=self.run_parallel_download, args=(download,), daemon=True).start()
+                self.display_message(f"开始分段并行下载文件 {filename} ({entry['size']} 字节)")
+                return
+            try:
+                self.downloads.request(self.sender, filename, save_path)
+            except Exception as e:
+                messagebox.showerror("错误", f"发送下载请求失败: {str(e)}")
+
+    def run_parallel_download(self, download):
+        try:
+            save_path = download.run()
+            self.display_message(f"文件已保存到: {save_path}")
+        except Exception as e:
+            self.display_message(f"下载文件 {download.filename} 失败: {str(e)}")
 
     def display_message(self, message):
         self.chat_area.insert(tk.END, message + "\n")
         self.chat_area.see(tk.END)
         
     def update_users_list(self, users):
+        """用完整列表重建用户列表（仅在登录和重新同步时使用）"""
         self.users_list.delete(0, tk.END)
         self.users_list.insert(tk.END, "所有人")  # 添加群发选项
         for user in users:
             if user != self.username:  # 不显示自己
                 self.users_list.insert(tk.END, user)
 
+    def apply_presence_changes(self, changes):
+        """逐项应用在线状态增量，不重建整个列表"""
+        for op, user in changes:
+            if user == self.username:
+                continue
+            names = self.users_list.get(0, tk.END)
+            if op == 'join' and user not in names:
+                self.users_list.insert(tk.END, user)
+            elif op == 'leave' and user in names:
+                self.users_list.delete(names.index(user))
+
     def update_files_list(self, files):
         """更新服务器文件列表"""
         self.files_list.delete(0, tk.END)
         for file in files:
             self.files_list.insert(tk.END, file)
 
+    def apply_files_delta(self, added, removed):
+        """只更新有变化的文件"""
+        for entry in added:
+            self.server_catalog[entry['name']] = entry
+        for name in removed:
+            self.server_catalog.pop(name, None)
+        names = list(self.files_list.get(0, tk.END))
+        for name in removed:
+            if name in names:
+                self.files_list.delete(names.index(name))
+                names.remove(name)
+        for entry in added:
+            if entry['name'] not in names:
+                self.files_list.insert(tk.END, entry['name'])
+                names.append(entry['name'])
+
     def receive_messages(self):
+        reader = FrameReader(self.client_socket)
         while True:
             try:
-                # 读取消息类型标记（1字节）
-                type_flag = self.client_socket.recv(1)
-                if not type_flag:
+                # 读取一批完整的帧
+                frames = reader.read_batch()
+                if frames is None:
                     break
                     
-                if type_flag == b'\x01':  # 表情消息
-                    # 读取数据长度（4字节）
-                    length_data = self.client_socket.recv(4)
-                    if not length_data:
-                        break
-                    msg_length = struct.unpack('>I', length_data)[0]
-                    
-                    # 读取序列化的表情数据
-                    data = b''
-                    while len(data) < msg_length:
-                        chunk = self.client_socket.recv(min(msg_length - len(data), 8192))
-                        if not chunk:
-                            break
-                        data += chunk
-                        
-                    if len(data) == msg_length:
-                        emoji_data = pickle.loads(data)
-                        # 显示接收到的表情
-                        image = Image.open(BytesIO(emoji_data['image']))
-                        image = image.resize((40, 40), Image.Resampling.LANCZOS)
-                        if emoji_data.get('from'):
-                            self.display_message(f"{emoji_data['from']}对你说: ")
-                        self.display_image(image)
-                        
-                elif type_flag == b'\x02':  # 文件消息
-                    # 读取数据长度（4字节）
-                    length_data = self.client_socket.recv(4)
-                    if not length_data:
-                        break
-                    msg_length = struct.unpack('>I', length_data)[0]
-                    
-                    # 读取序列化的文件数据
-                    data = b''
-                    while len(data) < msg_length:
-                        chunk = self.client_socket.recv(min(msg_length - len(data), 8192))
-                        if not chunk:
-                            break
-                        data += chunk
-                        
-                    if len(data) == msg_length:
-                        file_data = pickle.loads(data)
-                        # 保存接收到的文件
-                        save_path = file_data.get('save_path', file_data['filename'])
-                        with open(save_path, 'wb') as f:
-                            f.write(file_data['content'])
-                        if file_data.get('from'):
-                            self.display_message(f"收到来自 {file_data['from']} 的文件: {file_data['filename']}")
-                        else:
-                            self.display_message(f"文件 {os.path.basename(save_path)} 下载完成")
-                            
-                else:  # 普通消息
-                    # 读取剩余消息
-                    message = self.client_socket.recv(8191)  # 8192 - 1
-                    if not message:
-                        break
-                        
-                    try:
-                        data = json.loads((type_flag + message).decode())
-                        if isinstance(data, dict):
-                            if data['type'] == 'private_message':
-                                self.display_message(f"{data['from']}对你说: {data['content']}")
-                            elif data['type'] == 'users_list':
-                                self.update_users_list(data['users'])
-                            elif data['type'] == 'files_list':
-                                self.update_files_list(data['files'])
-                            elif data['type'] == 'server_message':
-                                self.display_message(f"SERVER: {data['content']}")
-                                # 检查是否被强制下线
-                                if data['content'] == '您已被服务器强制下线':
-                                    self.client_socket.close()
-                                    self.window.after(0, self.handle_force_logout)
-                                    break
-                        else:
-                            self.display_message((type_flag + message).decode())
-                    except json.JSONDecodeError:
-                        self.display_message((type_flag + message).decode())
+                for frame_type, payload in frames:
+                    if not self.handle_frame(frame_type, payload):
+                        return
                     
             except Exception as e:
                 print(f"接收消息错误: {str(e)}")
                 break
                 
+        self.downloads.close_all()
         if self.client_socket:
             self.client_socket.close()
             self.window.after(0, self.handle_disconnect)
 
+    def handle_frame(self, frame_type, payload):
+        """处理一帧数据，被强制下线时返回 False"""
+        if frame_type == FRAME_CHUNK:  # 下载的数据块
+            self.downloads.write_chunk(payload)
+
+        elif frame_type == FRAME_EMOJI:  # 表情消息
+            emoji = EMOJI.decode(payload)
+            if emoji.action == ACTION_DATA:
+                # 请求的表情图片：存入缓存，显示等待它的消息
+                data = bytes(emoji.data)
+                key = self.emoji_cache.put(data)
+                for prefix in self.emoji_cache.resolve(key):
+                    self.display_emoji(prefix, data)
+            else:
+                # 服务器没有加入表情目录、按原样转发的完整表情帧
+                self.display_emoji(f"{emoji.sender}对你说: " if emoji.sender else None, emoji.data)
+            
+        elif frame_type == FRAME_JSON:  # 普通消息
+            try:
+                data = decode_json(payload)
+                if isinstance(data, dict):
+                    if data['type'] == 'private_message':
+                        self.display_message(f"{data['from']}对你说: {data['content']}")
+                    elif data['type'] == 'welcome':
+                        # 服务器选定的压缩算法，之后发送的帧按需压缩
+                        algorithm = data['server'].get('compression')
+                        self.sender.compressor = compression.Compressor(algorithm) if algorithm else None
+                        changes, need_sync = self.presence.reset(data['presence_version'])
+                        if need_sync:
+                            self.sender.send_json({'type': 'presence_sync'})
+                        self.update_users_list(data['users'])
+                        self.apply_presence_changes(changes)
+                        self.server_catalog = {f['name']: f for f in data['files']}
+                        self.transfer_token = data.get('transfer_token')
+                        self.update_files_list(list(self.server_catalog))
+                        self.emoji_cache.reset(data.get('emojis', []))
+                    elif data['type'] == 'users_list':
+                        changes, need_sync = self.presence.reset(data['version'])
+                        if need_sync:
+                            self.sender.send_json({'type': 'presence_sync'})
+                        self.update_users_list(data['users'])
+                        self.apply_presence_changes(changes)
+                    elif data['type'] == 'presence':
+                        changes, need_sync = self.presence.apply(data)
+                        if need_sync:
+                            self.sender.send_json({'type': 'presence_sync'})
+                        self.apply_presence_changes(changes)
+                    elif data['type'] == 'files_delta':
+                        self.apply_files_delta(data['added'], data['removed'])
+                    elif data['type'] == 'download_begin':
+                        if self.downloads.begin(data) is not None:
+                            if data['offset']:
+                                self.display_message(f"文件 {data['filename']} 从 {data['offset']} 字节处继续下载")
+                            else:
+                                self.display_message(f"开始下载文件 {data['filename']} ({data['size']} 字节)")
+                    elif data['type'] == 'download_end':
+                        try:
+                            download, save_path = self.downloads.finish(data)
+                            if download is not None:
+                                self.display_message(f"文件已保存到: {save_path}")
+                        except Exception as e:
+                            self.display_message(f"保存文件失败: {str(e)}")
+                    elif data['type'] == 'download_error':
+                        download = self.downloads.fail(data)
+                        if download is not None:
+                            self.display_message(f"下载文件 {download.filename} 失败: {data['error']}")
+                    elif data['type'] == 'upload_done':
+                        self.uploads.finished(data)
+                        if data.get('deduplicated'):
+                            self.display_message(f"文件 {data['filename']} 上传完成（服务器已有相同内容，未重复传输）")
+                        else:
+                            self.display_message(f"文件 {data['filename']} 上传完成")
+                    elif data['type'] == 'upload_ready':
+                        self.uploads.ready(data)
+                    elif data['type'] == 'upload_error':
+                        if not self.uploads.fail(data):
+                            self.display_message(f"文件上传失败: {data['error']}")
+                    elif data['type'] == 'relay_begin':
+                        # 私发文件的数据块紧跟在后面，先登记再处理数据块
+                        self.downloads.receive(data, os.path.basename(data['filename']))
+                        self.display_message(f"正在接收 {data['from']} 发来的文件: {data['filename']} ({data['size']} 字节)")
+                    elif data['type'] == 'relay_end':
+                        try:
+                            download, save_path = self.downloads.finish(data)
+                            if download is not None:
+                                self.display_message(f"文件已保存到: {save_path}")
+                        except Exception as e:
+                            self.display_message(f"保存文件失败: {str(e)}")
+                    elif data['type'] == 'relay_ready':
+                        self.uploads.ready(data)
+                    elif data['type'] == 'relay_done':
+                        self.display_message(f"文件 {data['filename']} 已发送给 {data['to']}")
+                    elif data['type'] == 'relay_error':
+                        if not self.uploads.fail(data):
+                            download = self.downloads.fail(data)
+                            if download is not None:
+                                self.display_message(f"接收文件 {download.filename} 失败: {data['error']}")
+                            else:
+                                self.display_message(f"文件发送失败: {data['error']}")
+                    elif data['type'] == 'emoji':
+                        self.receive_emoji(data)
+                    elif data['type'] == 'emoji_missing':
+                        self.emoji_cache.known.discard(data['id'])
+                        waiting = self.emoji_cache.resolve(data['id'])
+                        for prefix in waiting:
+                            self.display_message(f"{prefix}[表情无法显示]")
+                        if not waiting:
+                            self.display_message("表情发送失败，请重新发送")
+                    elif data['type'] == 'server_message':
+                        self.display_message(f"SERVER: {data['content']}")
+                        # 检查是否被强制下线
+                        if data['content'] == '您已被服务器强制下线':
+                            self.client_socket.close()
+                            self.window.after(0, self.handle_force_logout)
+                            return False
+                else:
+                    self.display_message(str(payload, 'utf-8'))
+            except json.JSONDecodeError:
+                self.display_message(str(payload, 'utf-8', 'replace'))
+        return True
+
     def handle_force_logout(self):
         """处理强制下线"""
         messagebox.showwarning("强制下线", "您已被服务器强制下线")
@@ -467,4 +566,4 @@ class ChatClient:
 
 if __name__ == "__main__":
     client = ChatClient()
-    client.start() 
\ No newline at end of file
+    client.start() 
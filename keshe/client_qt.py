@@ -1,17 +1,27 @@
 import socket
 import json
 import os
-import pickle
-import struct
+import threading
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QWidget, QVBoxLayout, 
                             QHBoxLayout, QLabel, QPushButton, QListWidget, 
-                            QTextEdit, QGroupBox, QLineEdit, QDialog,
-                            QFileDialog, QMessageBox)
-from PyQt5.QtCore import Qt, pyqtSignal, QObject, QUrl, QSize, QThread
-from PyQt5.QtGui import QPixmap, QImage, QTextDocument, QIcon, QFont
-import time
-import uuid
+                            QListView, QGroupBox, QLineEdit, QDialog,
+                            QFileDialog, QMessageBox, QStyledItemDelegate,
+                            QStyleOptionViewItem, QAbstractItemView)
+from PyQt5.QtCore import (Qt, pyqtSignal, QObject, QSize, QThread, QAbstractListModel,
+                          QModelIndex, QTimer)
+from PyQt5.QtGui import QPixmap, QIcon, QFont
 from wuzi_game import WuziWindow
+from presence import PresenceTracker
+from emoji_catalog import EmojiCache, emoji_id
+from image_cache import LRUCache
+from chat_history import ChatHistory
+from ui_scheduler import UpdateCoalescer, UI_FPS
+import compression
+from binary_codec import EMOJI, ACTION_DATA
+from protocol import (FRAME_JSON, FRAME_EMOJI, FRAME_CHUNK, FrameReader,
+                      FrameWriter, decode_json)
+from transfer_client import (UploadManager, DownloadManager, ParallelDownload,
+                             can_download_parallel)
 
 # 添加全局样式表
 STYLE_SHEET = """
@@ -64,7 +74,7 @@ QLineEdit:focus {
     border-color: #409eff;
 }
 
-QTextEdit {
+QListView {
     border: 1px solid #dcdfe6;
     border-radius: 4px;
     padding: 5px;
@@ -95,54 +105,142 @@ QListWidget::item:hover {
 }
 """
 
+PIXMAP_BUDGET = 32 * 1024 * 1024  # 解码后的表情图片最多占用的内存
+
+
+def pixmap_cost(pixmap):
+    """QPixmap 占用的字节数"""
+    return pixmap.width() * pixmap.height() * max(pixmap.depth(), 8) // 8
+
+
 class SignalManager(QObject):
     """信号管理器，用于线程间通信"""
-    display_message = pyqtSignal(str)
-    display_image = pyqtSignal(QImage)
-    update_users = pyqtSignal(list)
-    update_files = pyqtSignal(list)
+    updates_pending = pyqtSignal()  # 有待处理的界面更新（见 ui_scheduler.py），每批只发一次
     connection_lost = pyqtSignal()
     force_logout = pyqtSignal()
     create_game = pyqtSignal(str, bool)  # 添加创建游戏窗口的信号
     handle_game_action = pyqtSignal(dict)  # 添加处理游戏动作的信号
 
+class ChatModel(QAbstractListModel):
+    """聊天记录的模型：只暴露 ChatHistory 窗口中的记录，视图只绘制可见的行"""
+
+    def __init__(self, history, pixmap_for, parent=None):
+        super().__init__(parent)
+        self.history = history
+        self.pixmap_for = pixmap_for  # 表情编号 -> QPixmap 或 None
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.history)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        _, text, emoji = self.history[index.row()]
+        if role == Qt.DisplayRole:
+            return text
+        if role == Qt.DecorationRole and emoji:
+            return self.pixmap_for(emoji)
+        return None
+
+    def append(self, entries, follow=True):
+        """保存新记录；follow 为 True（视图停在底部）时加入窗口并丢掉最早的记录，否则只保存"""
+        at_end = self.history.at_end()
+        rows = self.history.store(entries)
+        if not follow:
+            return
+        if not at_end or len(rows) >= self.history.window_size:
+            # 窗口停在较早的位置，或者一批新记录就超过了整个窗口：直接换成最新的一页
+            self.reset_to_end()
+            return
+        count = len(self.history)
+        self.beginInsertRows(QModelIndex(), count, count + len(rows) - 1)
+        self.history.extend(rows)
+        self.endInsertRows()
+        self.trim_front()
+
+    def load_older(self):
+        """读入窗口之前的一页，返回读入的条数"""
+        rows = self.history.older()
+        if not rows:
+            return 0
+        self.beginInsertRows(QModelIndex(), 0, len(rows) - 1)
+        self.history.prepend(rows)
+        self.endInsertRows()
+        excess = self.history.excess()
+        if excess:
+            count = len(self.history)
+            self.beginRemoveRows(QModelIndex(), count - excess, count - 1)
+            self.history.drop_back(excess)
+            self.endRemoveRows()
+        return len(rows)
+
+    def load_newer(self):
+        """读入窗口之后的一页，返回从窗口开头丢掉的条数"""
+        rows = self.history.newer()
+        if not rows:
+            return 0
+        count = len(self.history)
+        self.beginInsertRows(QModelIndex(), count, count + len(rows) - 1)
+        self.history.extend(rows)
+        self.endInsertRows()
+        return self.trim_front()
+
+    def trim_front(self):
+        excess = self.history.excess()
+        if excess:
+            self.beginRemoveRows(QModelIndex(), 0, excess - 1)
+            self.history.drop_front(excess)
+            self.endRemoveRows()
+        return excess
+
+    def reset_to_end(self):
+        """窗口换成最新的一页"""
+        self.beginResetModel()
+        self.history.drop_front(len(self.history))
+        self.history.extend(self.history.latest())
+        self.endResetModel()
+
+
+class ChatDelegate(QStyledItemDelegate):
+    """表情显示在前缀文字的右边"""
+
+    def initStyleOption(self, option, index):
+        super().initStyleOption(option, index)
+        option.decorationPosition = QStyleOptionViewItem.Right
+
+
 class NetworkThread(QThread):
     """网络通信线程"""
-    message_received = pyqtSignal(bytes, bytes)  # 接收到的消息信号
+    frames_received = pyqtSignal(list)  # 一次读到的帧 [(帧类型, 内容的 memoryview), ...]
     connection_lost = pyqtSignal()  # 连接断开信号
     
-    def __init__(self, socket):
+    def __init__(self, socket, downloads):
         super().__init__()
         self.socket = socket
+        self.downloads = downloads
         self.running = True
         
     def run(self):
+        reader = FrameReader(self.socket)
         while self.running:
             try:
-                type_flag = self.socket.recv(1)
-                if not type_flag:
+                frames = reader.read_batch()
+                if frames is None:
                     break
                     
-                if type_flag in [b'\x01', b'\x02']:  # 表情或文件消息
-                    length_data = self.socket.recv(4)
-                    if not length_data:
-                        break
-                    msg_length = struct.unpack('>I', length_data)[0]
-                    
-                    data = b''
-                    while len(data) < msg_length:
-                        chunk = self.socket.recv(min(msg_length - len(data), 8192))
-                        if not chunk:
-                            break
-                        data += chunk
-                    
-                    if len(data) == msg_length:
-                        self.message_received.emit(type_flag, data)
-                else:  # 普通消息
-                    message = self.socket.recv(8191)
-                    if not message:
-                        break
-                    self.message_received.emit(type_flag, message)
+                # 一次读到的帧只发一个信号，界面线程一起处理
+                messages = []
+                for frame_type, payload in frames:
+                    # 下载的数据块直接在网络线程中写入磁盘，不经过界面线程
+                    if frame_type == FRAME_CHUNK and self.downloads.write_chunk(payload):
+                        continue
+                    if frame_type == FRAME_JSON:
+                        self.accept_relay(payload)
+                    messages.append((frame_type, payload))
+                if messages:
+                    self.frames_received.emit(messages)
                     
             except Exception as e:
                 print(f"接收消息错误: {str(e)}")
@@ -151,6 +249,15 @@ class NetworkThread(QThread):
         self.running = False
         self.connection_lost.emit()
         
+    def accept_relay(self, payload):
+        """私发文件的数据块紧跟在 relay_begin 之后，必须在网络线程中先登记，不能等界面线程处理"""
+        try:
+            data = decode_json(payload)
+        except ValueError:
+            return
+        if isinstance(data, dict) and data.get('type') == 'relay_begin':
+            self.downloads.receive(data, os.path.basename(data['filename']))
+
     def stop(self):
         self.running = False
 
@@ -257,22 +364,41 @@ class ChatClient(QMainWindow):
         
         # 创建信号管理器
         self.signals = SignalManager()
-        self.signals.display_message.connect(self.append_message, Qt.QueuedConnection)
-        self.signals.display_image.connect(self.append_image, Qt.QueuedConnection)
-        self.signals.update_users.connect(self.update_users_gui, Qt.QueuedConnection)
-        self.signals.update_files.connect(self.update_files_gui, Qt.QueuedConnection)
+        self.signals.updates_pending.connect(self.schedule_updates, Qt.QueuedConnection)
         self.signals.connection_lost.connect(self.handle_disconnect, Qt.QueuedConnection)
         self.signals.force_logout.connect(self.handle_force_logout, Qt.QueuedConnection)
         self.signals.create_game.connect(self.create_game_window, Qt.QueuedConnection)
         self.signals.handle_game_action.connect(self.process_game_action, Qt.QueuedConnection)
         
+        # 聊天记录、用户列表和文件列表的更新先放进队列，按固定帧率合并处理
+        self.updates = UpdateCoalescer(self.signals.updates_pending.emit)
+        self.update_timer = QTimer(self)
+        self.update_timer.setSingleShot(True)
+        self.update_timer.setInterval(1000 // UI_FPS)
+        self.update_timer.timeout.connect(self.flush_updates)
+        
         # 游戏相关
         self.game_window = None
         
+        # 在线用户版本跟踪
+        self.presence = PresenceTracker()
+        
+        # 服务器文件目录 {文件名: {name, size, mtime, hash}}
+        self.server_catalog = {}
+        self.transfer_token = None  # 欢迎消息中的传输连接令牌，并行下载时出示
+        
+        # 解码后的表情 {编号: QPixmap}，超出内存预算时淘汰最久没用的
+        self.pixmaps = LRUCache(PIXMAP_BUDGET, pixmap_cost)
+        
     def setup_network(self):
         self.host = 'localhost'
         self.port = 5000
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # 网络线程、界面线程和上传线程共用同一个发送器，保证帧不会交错
+        self.sender = FrameWriter(self.client_socket)
+        self.uploads = UploadManager()
+        self.downloads = DownloadManager()
+        self.emoji_cache = EmojiCache()
         
     def setup_gui(self):
         self.setWindowTitle("聊天客户端")
@@ -290,17 +416,25 @@ class ChatClient(QMainWindow):
         chat_layout = QVBoxLayout()
         chat_layout.setSpacing(10)
         
-        # 聊天记录显示
-        self.chat_area = QTextEdit()
-        self.chat_area.setReadOnly(True)
+        # 聊天记录显示：内存中只保留最近的一段记录，更早的记录翻到顶部时从本地 sqlite 读入
+        self.history = ChatHistory()
+        self.chat_model = ChatModel(self.history, self.emoji_pixmap, self)
+        self.chat_area = QListView()
+        self.chat_area.setModel(self.chat_model)
+        self.chat_area.setItemDelegate(ChatDelegate(self.chat_area))
+        self.chat_area.setWordWrap(True)
+        self.chat_area.setIconSize(QSize(80, 80))
+        self.chat_area.setSelectionMode(QAbstractItemView.NoSelection)
+        self.chat_area.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
         self.chat_area.setStyleSheet("""
-            QTextEdit {
+            QListView {
                 background-color: white;
                 border: 1px solid #dcdfe6;
                 border-radius: 4px;
                 padding: 10px;
             }
         """)
+        self.chat_area.verticalScrollBar().valueChanged.connect(self.chat_scrolled)
         chat_layout.addWidget(self.chat_area)
         
         # 消息输入区域
@@ -368,29 +502,80 @@ class ChatClient(QMainWindow):
         layout.addWidget(chat_group, stretch=2)
         layout.addWidget(right_panel, stretch=1)
         
-    def append_message(self, message):
-        """添加文本消息到聊天区域"""
-        self.chat_area.append(message)
-        
-    def append_image(self, qimage):
-        """添加图片到聊天区域"""
-        cursor = self.chat_area.textCursor()
-        cursor.movePosition(cursor.End)
+    def schedule_updates(self):
+        """有新的界面更新：等到下一帧再一起处理"""
+        if not self.update_timer.isActive():
+            self.update_timer.start()
+            
+    def flush_updates(self):
+        """处理一批界面更新：列表只重建一次，聊天记录一次追加"""
+        batch = self.updates.take()
+        if batch.users is not None:
+            self.update_users_gui(batch.users)
+        for user, op in batch.presence.items():
+            if op == 'join':
+                self.user_joined_gui(user)
+            elif op == 'leave':
+                self.user_left_gui(user)
+        if batch.files is not None:
+            self.update_files_gui(batch.files)
+        if batch.added or batch.removed:
+            self.files_changed_gui(list(batch.added), batch.removed)
+        if batch.chat:
+            self.append_chat([self.chat_entry(text, key, image_data)
+                              for text, key, image_data in batch.chat])
+            
+    def chat_entry(self, prefix, key, image_data):
+        """一条聊天记录 (文本, 表情编号)：记录中只保存表情编号，显示时从解码缓存中取图片"""
+        if key is None:
+            return prefix, None
+        if image_data is not None and key not in self.pixmaps:
+            # 本地发送的表情也放进磁盘缓存，图片被淘汰后还能重新解码
+            try:
+                if self.emoji_cache.get(key) is None:
+                    self.emoji_cache.put(image_data)
+            except OSError as e:
+                print(f"保存表情缓存失败: {str(e)}")
+        if self.emoji_pixmap(key, image_data) is None:
+            return f"{prefix}[表情无法显示]", None
+        return prefix, key
         
-        # 使用时间戳和随机数生成唯一的资源名称
-        resource_name = f"emoji_{time.time()}_{uuid.uuid4().hex[:8]}.png"
+    def append_chat(self, entries):
+        """追加聊天记录；视图停在底部时跟随显示，否则只保存，不打断正在翻看的位置"""
+        bar = self.chat_area.verticalScrollBar()
+        follow = bar.value() >= bar.maximum()
+        self.chat_model.append(entries, follow)
+        if follow:
+            self.chat_area.scrollToBottom()
+            
+    def chat_scrolled(self, value):
+        """翻到窗口边缘时从本地记录中读入一页"""
+        bar = self.chat_area.verticalScrollBar()
+        if value == bar.minimum() and bar.maximum() > bar.minimum():
+            count = self.chat_model.load_older()
+            if count:
+                # 保持原来第一行的位置不动
+                self.chat_area.scrollTo(self.chat_model.index(count), QAbstractItemView.PositionAtTop)
+        elif value == bar.maximum() and not self.history.at_end():
+            last = len(self.history) - 1
+            dropped = self.chat_model.load_newer()
+            # 保持原来最后一行的位置不动
+            self.chat_area.scrollTo(self.chat_model.index(last - dropped), QAbstractItemView.PositionAtBottom)
         
-        pixmap = QPixmap.fromImage(qimage)
-        self.chat_area.document().addResource(
-            QTextDocument.ImageResource,
-            QUrl(resource_name),
-            pixmap
-        )
-        cursor.insertImage(resource_name)
-        cursor.insertText("\n")
+    def emoji_pixmap(self, key, image_data=None):
+        """解码后的表情，先查缓存；image_data 为 None 时从磁盘缓存读取"""
+        pixmap = self.pixmaps.get(key)
+        if pixmap is not None:
+            return pixmap
+        if image_data is None:
+            image_data = self.emoji_cache.get(key)
+        pixmap = QPixmap()
+        if image_data is None or not pixmap.loadFromData(image_data):
+            return None
+        return self.pixmaps.put(key, pixmap)
         
     def update_users_gui(self, users):
-        """更新用户列表"""
+        """用完整列表重建用户列表（仅在登录和重新同步时使用）"""
         self.users_list.clear()
         self.users_list.addItem("所有人")
         self.users_list.setCurrentRow(0)  # 默认选中"所有人"
@@ -398,11 +583,35 @@ class ChatClient(QMainWindow):
             if user != self.username:
                 self.users_list.addItem(user)
                 
+    def user_joined_gui(self, user):
+        """有用户加入，只添加这一项"""
+        if user != self.username and not self.users_list.findItems(user, Qt.MatchExactly):
+            self.users_list.addItem(user)
+            
+    def user_left_gui(self, user):
+        """有用户离开，只移除这一项"""
+        for item in self.users_list.findItems(user, Qt.MatchExactly):
+            self.users_list.takeItem(self.users_list.row(item))
+            
+    def apply_presence_changes(self, changes):
+        """把在线状态增量交给GUI线程"""
+        for op, user in changes:
+            self.updates.presence(op, user)
+                
     def update_files_gui(self, files):
         """更新文件列表"""
         self.files_list.clear()
         self.files_list.addItems(files)
         
+    def files_changed_gui(self, added, removed):
+        """只更新有变化的文件"""
+        for name in removed:
+            for item in self.files_list.findItems(name, Qt.MatchExactly):
+                self.files_list.takeItem(self.files_list.row(item))
+        for name in added:
+            if not self.files_list.findItems(name, Qt.MatchExactly):
+                self.files_list.addItem(name)
+        
     def show_emoji_selector(self):
         selector = EmojiSelector(self)
         if selector.exec_() == QDialog.Accepted and selector.selected_emoji:
@@ -421,12 +630,12 @@ class ChatClient(QMainWindow):
             }
             
             try:
-                self.client_socket.send(json.dumps(data).encode())
+                self.sender.send_json(data)
                 self.message_input.clear()
                 if to == "所有人":
-                    self.signals.display_message.emit(f"你: {message}")
+                    self.updates.message(f"你: {message}")
                 else:
-                    self.signals.display_message.emit(f"你对{to}说: {message}")
+                    self.updates.message(f"你对{to}说: {message}")
             except:
                 QMessageBox.critical(self, "错误", "消息发送失败")
                 
@@ -435,27 +644,23 @@ class ChatClient(QMainWindow):
             selected_items = self.users_list.selectedItems()
             to = selected_items[0].text() if selected_items else "所有人"
             
-            with open(emoji_path, 'rb') as f:
-                image_data = f.read()
-                
-            emoji_data = {
-                'type': 'emoji',
-                'to': to,
-                'image': image_data
-            }
-            
-            data = pickle.dumps(emoji_data)
-            self.client_socket.send(b'\x01')
-            self.client_socket.send(struct.pack('>I', len(data)))
-            self.client_socket.send(data)
+            # 服务器已有的表情只发送编号，否则发送完整的表情帧（服务器会把它加入表情目录）
+            key = self.emoji_cache.local_id(emoji_path)
+            image_data = None
+            if key not in self.emoji_cache.known or key not in self.pixmaps:
+                with open(emoji_path, 'rb') as f:
+                    image_data = f.read()
+            if key in self.emoji_cache.known:
+                self.sender.send_json({'type': 'emoji', 'id': key, 'to': to})
+            else:
+                self.sender.send_buffers(EMOJI.encode(image_data, to=to))
+                self.emoji_cache.known.add(key)
             
             # 显示发送的表情
-            qimage = QImage(emoji_path)
             if to == "所有人":
-                self.signals.display_message.emit("你: ")
+                self.show_emoji("你: ", key, image_data)
             else:
-                self.signals.display_message.emit(f"你对{to}说: ")
-            self.signals.display_image.emit(qimage)
+                self.show_emoji(f"你对{to}说: ", key, image_data)
             
         except Exception as e:
             QMessageBox.critical(self, "错误", f"发送表情失败: {str(e)}")
@@ -466,30 +671,32 @@ class ChatClient(QMainWindow):
             selected_items = self.users_list.selectedItems()
             to = selected_items[0].text() if selected_items else "所有人"
             
-            try:
-                with open(file_path, 'rb') as f:
-                    file_data = f.read()
-                    
-                file_package = {
-                    'type': 'file',
-                    'filename': os.path.basename(file_path),
-                    'to': to,
-                    'content': file_data
-                }
+            if to == "所有人":
+                # 上传到服务器的文件分块发送，在后台线程中进行，不阻塞界面
+                threading.Thread(target=self.upload_to_server, args=(file_path,), daemon=True).start()
+                self.updates.message(f"正在上传文件 {os.path.basename(file_path)} ...")
+                return
+            
+            # 私发的文件也分块发送，服务器边收边转发给对方
+            threading.Thread(target=self.relay_to_user, args=(file_path, to), daemon=True).start()
+            self.updates.message(f"正在发送文件 {os.path.basename(file_path)} 给 {to} ...")
                 
-                data = pickle.dumps(file_package)
-                self.client_socket.send(b'\x02')
-                self.client_socket.send(struct.pack('>I', len(data)))
+    def upload_to_server(self, file_path):
+        try:
+            self.uploads.upload(self.sender, file_path,
+                                progress=lambda offset: self.upload_resumed(file_path, offset))
+        except Exception as e:
+            self.updates.message(f"文件上传失败: {str(e)}")
                 
-                chunk_size = 8192
-                for i in range(0, len(data), chunk_size):
-                    chunk = data[i:i + chunk_size]
-                    self.client_socket.send(chunk)
-                    
-                self.signals.display_message.emit(f"文件 {os.path.basename(file_path)} 发送完成")
+    def relay_to_user(self, file_path, to):
+        try:
+            self.uploads.relay(self.sender, file_path, to)
+        except Exception as e:
+            self.updates.message(f"文件发送失败: {str(e)}")
                 
-            except Exception as e:
-                QMessageBox.critical(self, "错误", f"文件发送失败: {str(e)}")
+    def upload_resumed(self, file_path, offset):
+        if offset:
+            self.updates.message(f"文件 {os.path.basename(file_path)} 从 {offset} 字节处继续上传")
                 
     def download_file(self):
         if not self.files_list.selectedItems():
@@ -505,30 +712,36 @@ class ChatClient(QMainWindow):
         )
         
         if save_path:
-            download_request = {
-                'type': 'file',
-                'action': 'download',
-                'filename': filename,
-                'save_path': save_path
-            }
-            
+            entry = self.server_catalog.get(filename)
+            if entry is not None and can_download_parallel(entry['size']):
+                # 大文件通过多个传输连接分段并行下载
+                download = ParallelDownload((self.host, self.port), self.username, self.transfer_token,
+                                            filename, save_path, entry['size'], entry['hash'])
+                threading.Thread(target=self.run_parallel_download, args=(download,), daemon=True).start()
+                self.updates.message(f"开始分段并行下载文件 {filename} ({entry['size']} 字节)")
+                return
             try:
-                data = pickle.dumps(download_request)
-                self.client_socket.send(b'\x02')
-                self.client_socket.send(struct.pack('>I', len(data)))
-                self.client_socket.send(data)
+                self.downloads.request(self.sender, filename, save_path)
             except Exception as e:
                 QMessageBox.critical(self, "错误", f"发送下载请求失败: {str(e)}")
                 
+    def run_parallel_download(self, download):
+        try:
+            save_path = download.run()
+            self.updates.message(f"文件已保存到: {save_path}")
+        except Exception as e:
+            self.updates.message(f"下载文件 {download.filename} 失败: {str(e)}")
+                
     def connect_to_server(self, username):
         try:
             self.client_socket.connect((self.host, self.port))
             self.username = username
-            self.client_socket.send(username.encode())
+            self.sender.send_json({'type': 'login', 'username': username,
+                                   'compression': compression.available()})
             
             # 创建并启动网络线程
-            self.network_thread = NetworkThread(self.client_socket)
-            self.network_thread.message_received.connect(self.handle_message, Qt.QueuedConnection)
+            self.network_thread = NetworkThread(self.client_socket, self.downloads)
+            self.network_thread.frames_received.connect(self.handle_frames, Qt.QueuedConnection)
             self.network_thread.connection_lost.connect(self.handle_disconnect, Qt.QueuedConnection)
             self.network_thread.start()
             
@@ -537,53 +750,31 @@ class ChatClient(QMainWindow):
             QMessageBox.critical(self, "连接错误", f"无法连接到服务器: {str(e)}")
             return False
             
-    def handle_message(self, type_flag, message):
+    def handle_frames(self, frames):
+        """处理网络线程一次读到的帧"""
+        for frame_type, message in frames:
+            self.handle_message(frame_type, message)
+            
+    def handle_message(self, frame_type, message):
         """处理接收到的消息"""
         try:
-            if type_flag == b'\x01':  # 表情消息
-                emoji_data = pickle.loads(message)
-                image_data = emoji_data['image']
-                qimage = QImage()
-                qimage.loadFromData(image_data)
-                
-                if emoji_data.get('from'):
-                    self.signals.display_message.emit(f"{emoji_data['from']}对你说: ")
-                self.signals.display_image.emit(qimage)
+            if frame_type == FRAME_EMOJI:  # 表情消息
+                emoji = EMOJI.decode(message)
+                if emoji.action == ACTION_DATA:
+                    # 请求的表情图片：存入缓存，显示等待它的消息
+                    data = bytes(emoji.data)
+                    key = self.emoji_cache.put(data)
+                    for prefix in self.emoji_cache.resolve(key):
+                        self.show_emoji(prefix, key, data)
+                else:
+                    # 服务器没有加入表情目录、按原样转发的完整表情帧
+                    data = bytes(emoji.data)
+                    self.show_emoji(f"{emoji.sender}对你说: " if emoji.sender else None,
+                                    emoji_id(data), data)
                 
-            elif type_flag == b'\x02':  # 文件消息
-                file_data = pickle.loads(message)
-                if 'save_path' in file_data:  # 这是下载的响应
-                    try:
-                        with open(file_data['save_path'], 'wb') as f:
-                            f.write(file_data['content'])
-                        self.signals.display_message.emit(
-                            f"文件已保存到: {file_data['save_path']}"
-                        )
-                    except Exception as e:
-                        self.signals.display_message.emit(
-                            f"保存文件失败: {str(e)}"
-                        )
-                else:  # 这是接收到的文件
-                    try:
-                        save_path = file_data.get('save_path', file_data['filename'])
-                        with open(save_path, 'wb') as f:
-                            f.write(file_data['content'])
-                        if file_data.get('from'):
-                            self.signals.display_message.emit(
-                                f"收到来自 {file_data['from']} 的文件: {file_data['filename']}"
-                            )
-                        else:
-                            self.signals.display_message.emit(
-                                f"文件 {os.path.basename(save_path)} 下载完成"
-                            )
-                    except Exception as e:
-                        self.signals.display_message.emit(
-                            f"保存文件失败: {str(e)}"
-                        )
-                        
-            else:  # 普通消息
+            elif frame_type == FRAME_JSON:  # 普通消息
                 try:
-                    data = json.loads((type_flag + message).decode())
+                    data = decode_json(message)
                     if isinstance(data, dict):
                         if data['type'] == 'game_invite':
                             self.handle_game_invite(data['from'])
@@ -592,29 +783,141 @@ class ChatClient(QMainWindow):
                         elif data['type'] == 'game_move':
                             self.handle_game_move(data)
                         elif data['type'] == 'private_message':
-                            self.signals.display_message.emit(
+                            self.updates.message(
                                 f"{data['from']}对你说: {data['content']}"
                             )
+                        elif data['type'] == 'welcome':
+                            # 服务器选定的压缩算法，之后发送的帧按需压缩
+                            algorithm = data['server'].get('compression')
+                            self.sender.compressor = compression.Compressor(algorithm) if algorithm else None
+                            changes, need_sync = self.presence.reset(data['presence_version'])
+                            if need_sync:
+                                self.sender.send_json({'type': 'presence_sync'})
+                            self.updates.set_users(data['users'])
+                            self.apply_presence_changes(changes)
+                            self.server_catalog = {f['name']: f for f in data['files']}
+                            self.transfer_token = data.get('transfer_token')
+                            self.updates.set_files(list(self.server_catalog))
+                            self.emoji_cache.reset(data.get('emojis', []))
                         elif data['type'] == 'users_list':
-                            self.signals.update_users.emit(data['users'])
-                        elif data['type'] == 'files_list':
-                            self.signals.update_files.emit(data['files'])
+                            changes, need_sync = self.presence.reset(data['version'])
+                            if need_sync:
+                                self.sender.send_json({'type': 'presence_sync'})
+                            self.updates.set_users(data['users'])
+                            self.apply_presence_changes(changes)
+                        elif data['type'] == 'presence':
+                            changes, need_sync = self.presence.apply(data)
+                            if need_sync:
+                                self.sender.send_json({'type': 'presence_sync'})
+                            self.apply_presence_changes(changes)
+                        elif data['type'] == 'files_delta':
+                            for entry in data['added']:
+                                self.server_catalog[entry['name']] = entry
+                            for name in data['removed']:
+                                self.server_catalog.pop(name, None)
+                            self.updates.files_delta(
+                                [entry['name'] for entry in data['added']], data['removed']
+                            )
+                        elif data['type'] == 'download_begin':
+                            if self.downloads.begin(data) is not None:
+                                if data['offset']:
+                                    self.updates.message(
+                                        f"文件 {data['filename']} 从 {data['offset']} 字节处继续下载"
+                                    )
+                                else:
+                                    self.updates.message(
+                                        f"开始下载文件 {data['filename']} ({data['size']} 字节)"
+                                    )
+                        elif data['type'] == 'download_end':
+                            try:
+                                download, save_path = self.downloads.finish(data)
+                                if download is not None:
+                                    self.updates.message(f"文件已保存到: {save_path}")
+                            except Exception as e:
+                                self.updates.message(f"保存文件失败: {str(e)}")
+                        elif data['type'] == 'download_error':
+                            download = self.downloads.fail(data)
+                            if download is not None:
+                                self.updates.message(
+                                    f"下载文件 {download.filename} 失败: {data['error']}"
+                                )
+                        elif data['type'] == 'upload_done':
+                            self.uploads.finished(data)
+                            if data.get('deduplicated'):
+                                self.updates.message(f"文件 {data['filename']} 上传完成（服务器已有相同内容，未重复传输）")
+                            else:
+                                self.updates.message(f"文件 {data['filename']} 上传完成")
+                        elif data['type'] == 'upload_ready':
+                            self.uploads.ready(data)
+                        elif data['type'] == 'upload_error':
+                            if not self.uploads.fail(data):
+                                self.updates.message(f"文件上传失败: {data['error']}")
+                        elif data['type'] == 'relay_begin':
+                            # 已经由网络线程登记，这里只显示提示
+                            self.updates.message(f"正在接收 {data['from']} 发来的文件: {data['filename']} ({data['size']} 字节)")
+                        elif data['type'] == 'relay_end':
+                            try:
+                                download, save_path = self.downloads.finish(data)
+                                if download is not None:
+                                    self.updates.message(f"文件已保存到: {save_path}")
+                            except Exception as e:
+                                self.updates.message(f"保存文件失败: {str(e)}")
+                        elif data['type'] == 'relay_ready':
+                            self.uploads.ready(data)
+                        elif data['type'] == 'relay_done':
+                            self.updates.message(f"文件 {data['filename']} 已发送给 {data['to']}")
+                        elif data['type'] == 'relay_error':
+                            if not self.uploads.fail(data):
+                                download = self.downloads.fail(data)
+                                if download is not None:
+                                    self.updates.message(f"接收文件 {download.filename} 失败: {data['error']}")
+                                else:
+                                    self.updates.message(f"文件发送失败: {data['error']}")
+                        elif data['type'] == 'emoji':
+                            self.receive_emoji(data)
+                        elif data['type'] == 'emoji_missing':
+                            self.emoji_cache.known.discard(data['id'])
+                            waiting = self.emoji_cache.resolve(data['id'])
+                            for prefix in waiting:
+                                self.updates.message(f"{prefix}[表情无法显示]")
+                            if not waiting:
+                                self.updates.message("表情发送失败，请重新发送")
                         elif data['type'] == 'server_message':
-                            self.signals.display_message.emit(f"SERVER: {data['content']}")
+                            self.updates.message(f"SERVER: {data['content']}")
                             if data['content'] == '您已被服务器强制下线':
                                 self.signals.force_logout.emit()
                         elif data['type'] == 'message':
-                            self.signals.display_message.emit(
+                            self.updates.message(
                                 f"{data['from']}: {data['content']}"
                             )
                     else:
-                        self.signals.display_message.emit((type_flag + message).decode())
+                        self.updates.message(str(message, 'utf-8'))
                 except json.JSONDecodeError as e:
-                    print(f"JSON解析错误: {str(e)}, 消息内容: {(type_flag + message).decode()}")
+                    print(f"JSON解析错误: {str(e)}, 消息内容: {str(message, 'utf-8', 'replace')}")
                     
         except Exception as e:
             print(f"处理消息错误: {str(e)}")
             
+    def receive_emoji(self, data):
+        """按编号收到的表情：有缓存直接显示，否则向服务器请求一次图片"""
+        if data.get('to', '所有人') == '所有人':
+            prefix = f"{data['from']}: "
+        else:
+            prefix = f"{data['from']}对你说: "
+        key = data['id']
+        if key in self.pixmaps:
+            # 已经解码过，不必再读磁盘缓存
+            self.show_emoji(prefix, key)
+            return
+        image_data = self.emoji_cache.get(key)
+        if image_data is not None:
+            self.show_emoji(prefix, key, image_data)
+        elif self.emoji_cache.wait(key, prefix):
+            self.sender.send_json({'type': 'emoji_get', 'id': key})
+            
+    def show_emoji(self, prefix, key, image_data=None):
+        self.updates.emoji(prefix or '', key, image_data)
+        
     def handle_force_logout(self):
         """处理强制下线"""
         QMessageBox.warning(self, "强制下线", "您已被服务器强制下线")
@@ -640,8 +943,8 @@ class ChatClient(QMainWindow):
         }
         
         try:
-            self.client_socket.send(json.dumps(invite_data).encode())
-            self.signals.display_message.emit(f"已向 {opponent} 发送游戏邀请")
+            self.sender.send_json(invite_data)
+            self.updates.message(f"已向 {opponent} 发送游戏邀请")
         except:
             QMessageBox.critical(self, "错误", "发送游戏邀请失败")
             
@@ -721,7 +1024,7 @@ class ChatClient(QMainWindow):
             }
             
             try:
-                self.client_socket.send(json.dumps(response_data).encode())
+                self.sender.send_json(response_data)
                 
                 if reply == QMessageBox.Yes:
                     # 通过信号创建游戏窗口（作为白方）
@@ -735,11 +1038,11 @@ class ChatClient(QMainWindow):
         """处理游戏邀请的响应"""
         try:
             if accepted:
-                self.signals.display_message.emit(f"{from_user} 接受了游戏邀请")
+                self.updates.message(f"{from_user} 接受了游戏邀请")
                 # 通过信号创建游戏窗口（作为黑方）
                 self.signals.create_game.emit(from_user, True)
             else:
-                self.signals.display_message.emit(f"{from_user} 拒绝了游戏邀请")
+                self.updates.message(f"{from_user} 拒绝了游戏邀请")
         except Exception as e:
             QMessageBox.critical(self, "错误", f"处理游戏邀请响应失败: {str(e)}")
             
@@ -762,6 +1065,12 @@ class ChatClient(QMainWindow):
                 if self.network_thread.isRunning():
                     self.network_thread.terminate()
 
+            # 关闭未完成的下载，保留 .part 文件以便下次续传
+            self.downloads.close_all()
+            
+            # 删除本次会话的聊天记录文件
+            self.history.close()
+
             # 关闭socket连接
             if hasattr(self, 'client_socket'):
                 try:
@@ -797,7 +1106,7 @@ class ChatClient(QMainWindow):
     def send_game_move(self, move_data):
         """发送游戏相关的移动"""
         try:
-            self.client_socket.send(json.dumps(move_data).encode())
+            self.sender.send_json(move_data)
         except Exception as e:
             QMessageBox.critical(self, "错误", f"发送游戏数据失败: {str(e)}")
             if self.game_window:
@@ -0,0 +1,182 @@
+"""按帧压缩
+
+登录时客户端在 login 消息的 compression 字段中列出自己支持的算法，服务器按自己的优先顺序
+选出一个，放在 welcome 消息的 server.compression 中返回（不压缩时为 None）。
+之后双方发送的每一帧单独决定是否压缩：
+
+- 太小（小于 MIN_SIZE）或太大（大于 MAX_SIZE，压缩太慢）的内容不压缩；
+- 已经压缩过的格式（PNG、JPEG、docx 等）按文件头或扩展名识别出来，不压缩；
+- 较大的内容先试压缩一小段样本，压缩后没有明显变小的内容按原样发送。
+
+压缩后的帧内容为：1 字节算法编号 | 4 字节原始长度 | 压缩数据（帧格式见 protocol.py）。
+解压只看算法编号，不依赖协商结果。标准库提供 zlib 和 lzma，安装了 zstandard 时还支持 zstd。
+"""
+import lzma
+import os
+import struct
+import time
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # zstd 是可选的
+    zstandard = None
+
+ZLIB = 'zlib'
+LZMA = 'lzma'
+ZSTD = 'zstd'
+
+CODEC_IDS = {ZLIB: 1, LZMA: 2, ZSTD: 3}
+PREFERENCE = (ZSTD, ZLIB, LZMA)  # 默认优先顺序：速度快的在前，lzma 压缩率最高但最慢
+
+COMPRESSED_HEADER = struct.Struct('>BI')
+
+MIN_SIZE = 512               # 小于这个大小的内容不压缩
+MAX_SIZE = 4 * 1024 * 1024   # 大于这个大小的内容不压缩（大文件走分块传输）
+MIN_SAVING = 0.1             # 至少节省 10% 才发送压缩结果
+SAMPLE_SIZE = 64 * 1024      # 较大的内容先用 zlib 快速压缩中间的一段样本，估计是否值得压缩
+
+# 已经压缩过的文件格式的文件头
+COMPRESSED_MAGIC = (
+    b'\x89PNG', b'\xff\xd8\xff', b'GIF8', b'PK\x03\x04', b'\x1f\x8b', b'BZh',
+    b'\xfd7zXZ', b'7z\xbc\xaf', b'Rar!', b'\x28\xb5\x2f\xfd', b'OggS', b'ID3', b'fLaC',
+)
+COMPRESSED_EXTENSIONS = {
+    '.png', '.jpg', '.jpeg', '.gif', '.webp', '.ico',
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.7z', '.rar', '.zst',
+    '.docx', '.xlsx', '.pptx', '.odt', '.jar', '.apk',
+    '.mp3', '.mp4', '.m4a', '.mkv', '.avi', '.mov', '.ogg', '.flac',
+}
+
+
+class CompressionError(ValueError):
+    """压缩帧的内容无法解压"""
+
+
+DECOMPRESS_ERRORS = (zlib.error, lzma.LZMAError)
+if zstandard is not None:
+    DECOMPRESS_ERRORS += (zstandard.ZstdError,)
+
+
+def available():
+    """本机支持的算法，按默认优先顺序排列"""
+    return [name for name in PREFERENCE if name != ZSTD or zstandard is not None]
+
+
+def negotiate(offered, enabled):
+    """从对方支持的算法 offered 中按本机的优先顺序 enabled 选出一个，没有共同的算法时返回 None"""
+    if not isinstance(offered, list):
+        return None
+    for name in enabled:
+        if name in offered:
+            return name
+    return None
+
+
+def compressible(data, filename=None):
+    """根据文件名和文件头判断内容是否值得压缩"""
+    if filename and os.path.splitext(str(filename))[1].lower() in COMPRESSED_EXTENSIONS:
+        return False
+    head = bytes(data[:12])
+    if head.startswith(COMPRESSED_MAGIC):
+        return False
+    # WebP、MP4 等容器格式的标识不在开头
+    return head[8:12] != b'WEBP' and head[4:8] != b'ftyp'
+
+
+class Compressor:
+    """一种算法的压缩器，同时统计压缩的效果（可以被多个连接和线程共用）"""
+
+    def __init__(self, name, level=None):
+        if name not in available():
+            raise ValueError(f"不支持的压缩算法: {name}")
+        self.name = name
+        self.codec_id = CODEC_IDS[name]
+        if name == ZLIB:
+            level = 6 if level is None else level
+            self._compress = lambda data: zlib.compress(data, level)
+        elif name == LZMA:
+            preset = 6 if level is None else level
+            self._compress = lambda data: lzma.compress(data, preset=preset, check=lzma.CHECK_NONE)
+        else:
+            level = 3 if level is None else level
+            # ZstdCompressor 不能在多个线程中同时使用，每次新建一个
+            self._compress = lambda data: zstandard.ZstdCompressor(level=level).compress(data)
+
+        # 统计
+        self.frames = 0       # 压缩发送的帧数
+        self.skipped = 0      # 尝试压缩但效果不好、按原样发送的帧数
+        self.raw_bytes = 0    # 压缩前的字节数
+        self.wire_bytes = 0   # 压缩后的字节数
+        self.seconds = 0.0    # 压缩花费的时间
+
+    def compress(self, data, sniff=None, filename=None):
+        """压缩 data，返回压缩帧的内容；不值得压缩时返回 None
+
+        sniff 是用来识别格式的数据开头（默认就是 data）。
+        """
+        if not MIN_SIZE <= len(data) <= MAX_SIZE:
+            return None
+        if not compressible(data if sniff is None else sniff, filename):
+            return None
+        start = time.perf_counter()
+        if len(data) > 2 * SAMPLE_SIZE:
+            middle = len(data) // 2
+            sample = memoryview(data)[middle - SAMPLE_SIZE // 2:middle + SAMPLE_SIZE // 2]
+            if len(zlib.compress(sample, 1)) > SAMPLE_SIZE * (1 - MIN_SAVING):
+                self.seconds += time.perf_counter() - start
+                self.skipped += 1
+                return None
+        compressed = self._compress(data)
+        self.seconds += time.perf_counter() - start
+        if len(compressed) + COMPRESSED_HEADER.size > len(data) * (1 - MIN_SAVING):
+            self.skipped += 1
+            return None
+        self.frames += 1
+        self.raw_bytes += len(data)
+        self.wire_bytes += len(compressed) + COMPRESSED_HEADER.size
+        return COMPRESSED_HEADER.pack(self.codec_id, len(data)) + compressed
+
+    def stats(self):
+        return {
+            'algorithm': self.name,
+            'frames': self.frames,
+            'skipped': self.skipped,
+            'raw_bytes': self.raw_bytes,
+            'wire_bytes': self.wire_bytes,
+            'seconds': round(self.seconds, 3),
+        }
+
+
+def decompress(payload, max_length=MAX_SIZE):
+    """解压压缩帧的内容，解压结果不会超过帧中声明的原始长度
+
+    发送方只压缩不超过 MAX_SIZE 的内容，声明的原始长度为 0 或超过 max_length 的帧直接拒绝，
+    不按对方声明的长度去解压。
+    """
+    if len(payload) < COMPRESSED_HEADER.size:
+        raise CompressionError("压缩帧内容太短")
+    codec_id, length = COMPRESSED_HEADER.unpack_from(payload)
+    if not 0 < length <= max_length:
+        raise CompressionError(f"压缩帧声明的原始长度不合法: {length}")
+    data = memoryview(payload)[COMPRESSED_HEADER.size:]
+    limit = length
+    try:
+        if codec_id == CODEC_IDS[ZLIB]:
+            decompressor = zlib.decompressobj()
+            result = decompressor.decompress(data, limit)
+            complete = decompressor.eof
+        elif codec_id == CODEC_IDS[LZMA]:
+            decompressor = lzma.LZMADecompressor()
+            result = decompressor.decompress(data, limit)
+            complete = decompressor.eof
+        elif codec_id == CODEC_IDS[ZSTD] and zstandard is not None:
+            result = zstandard.ZstdDecompressor().decompress(data, max_output_size=length)
+            complete = True
+        else:
+            raise CompressionError(f"不支持的压缩算法编号: {codec_id}")
+    except DECOMPRESS_ERRORS as e:
+        raise CompressionError(f"解压失败: {str(e)}")
+    if not complete or len(result) != length:
+        raise CompressionError("解压后的长度与声明的不一致")
+    return result
@@ -0,0 +1,45 @@
+"""服务器文件的内容去重
+
+文件目录（FileCatalog）按 SHA-256 建立了索引，内容相同的文件用硬链接共享同一份数据：
+
+- 上传前客户端在 upload_begin 中带上文件哈希，服务器已有相同内容时直接建立硬链接，
+  回复 upload_done（deduplicated 为 True），客户端不必发送任何数据；
+- 上传完成或目录中出现新文件后，如果内容与已有文件相同，也改为硬链接到已有文件，节省磁盘空间。
+
+服务器写入文件总是先写临时文件再重命名（新的 inode），不会改动共享的数据；
+但在服务器之外原地修改其中一个文件会同时改变所有链接到它的文件名。
+"""
+import os
+import shutil
+import uuid
+
+
+def link_file(directory, source, target, copy_fallback=False):
+    """把 target 原子地替换为 source 的硬链接
+
+    两者已经是同一个文件时什么都不做，返回 False；文件系统不支持硬链接时，
+    copy_fallback 为 True 则复制一份，否则抛出 OSError。
+    """
+    source_path = os.path.join(directory, source)
+    target_path = os.path.join(directory, target)
+    try:
+        if os.path.samefile(source_path, target_path):
+            return False
+    except FileNotFoundError:
+        pass
+    temp_path = os.path.join(directory, f'.link-{uuid.uuid4().hex}')
+    try:
+        try:
+            os.link(source_path, temp_path)
+        except OSError:
+            if not copy_fallback:
+                raise
+            shutil.copyfile(source_path, temp_path)
+        os.replace(temp_path, target_path)
+    except OSError:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+    return True
@@ -0,0 +1,164 @@
+"""按内容哈希标识的表情
+
+表情用图片内容 SHA-256 的前 16 个十六进制字符作为编号。服务器启动时扫描 emojis 目录建立目录，
+在 welcome 消息的 emojis 字段中把目录（编号和名称）发给客户端，每个会话只发送一次。
+之后发送表情只需要一条很小的 JSON 消息：
+
+    客户端 -> 服务器  {'type': 'emoji', 'id': 编号, 'to': 接收者}
+    服务器 -> 接收者  {'type': 'emoji', 'id': 编号, 'from': 发送者, 'to': 接收者}
+
+客户端收到本地没有的编号时发送 {'type': 'emoji_get', 'id': 编号}，服务器用一个 ACTION_DATA 的表情帧
+返回图片内容，客户端校验哈希后保存到磁盘缓存（emoji_cache 目录），以后不再请求。
+客户端本地的表情不在服务器目录中时仍按原来的方式发送完整的表情帧，服务器把它加入目录后按编号转发。
+"""
+import hashlib
+import os
+import threading
+import uuid
+
+ID_LENGTH = 16
+EMOJI_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif')
+MAX_EMOJI_SIZE = 256 * 1024  # 客户端发来的表情加入目录的大小上限
+MAX_CUSTOM = 256             # 客户端发来的表情最多加入目录的个数
+CACHE_DIR = 'emoji_cache'
+
+
+def emoji_id(data):
+    """表情内容的编号"""
+    return hashlib.sha256(data).hexdigest()[:ID_LENGTH]
+
+
+def valid_id(value):
+    return (isinstance(value, str) and len(value) == ID_LENGTH
+            and all(c in '0123456789abcdef' for c in value))
+
+
+class EmojiCatalog:
+    """服务器的表情目录 {编号: 图片内容}，表情都很小，全部放在内存中"""
+
+    def __init__(self, directory='emojis', max_custom=MAX_CUSTOM):
+        self.directory = directory
+        self.max_custom = max_custom
+        self.data = {}     # {编号: bytes}
+        self.names = {}    # {编号: 名称}
+        self.custom = 0    # 客户端发来后加入目录的表情数
+
+    def load(self):
+        """扫描表情目录，返回表情数量"""
+        self.data = {}
+        self.names = {}
+        self.custom = 0
+        if not os.path.isdir(self.directory):
+            return 0
+        for name in sorted(os.listdir(self.directory)):
+            if not name.lower().endswith(EMOJI_EXTENSIONS):
+                continue
+            with open(os.path.join(self.directory, name), 'rb') as f:
+                data = f.read()
+            key = emoji_id(data)
+            if key not in self.data:
+                self.data[key] = data
+                self.names[key] = name
+        return len(self.data)
+
+    def add(self, data):
+        """把客户端发来的表情加入目录，返回编号；太大或目录已满时返回 None"""
+        key = emoji_id(data)
+        if key in self.data:
+            return key
+        if len(data) > MAX_EMOJI_SIZE or self.custom >= self.max_custom:
+            return None
+        self.data[key] = bytes(data)
+        self.names[key] = ''
+        self.custom += 1
+        return key
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def listing(self):
+        """发给客户端的目录"""
+        return [{'id': key, 'name': name} for key, name in self.names.items()]
+
+
+class EmojiCache:
+    """客户端的表情磁盘缓存
+
+    known 是服务器目录中已有的编号，本地表情在其中时只发送编号。
+    收到未知编号的表情时先把要显示的内容登记到 waiting，向服务器请求一次图片，
+    收到后再一起显示；同一个编号在收到之前只请求一次。
+    """
+
+    def __init__(self, directory=CACHE_DIR):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.known = set()
+        self.local_ids = {}  # {本地表情路径: 编号}
+        self.waiting = {}    # {编号: [等待图片的消息, ...]}
+
+    def reset(self, listing):
+        """处理 welcome 中的表情目录"""
+        self.known = {item['id'] for item in listing}
+
+    def local_id(self, path):
+        """本地表情文件的编号"""
+        key = self.local_ids.get(path)
+        if key is None:
+            with open(path, 'rb') as f:
+                key = emoji_id(f.read())
+            self.local_ids[path] = key
+        return key
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """缓存的图片内容，没有时返回 None"""
+        if not valid_id(key):
+            return None
+        try:
+            with open(self.path(key), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        if emoji_id(data) != key:
+            # 缓存文件损坏，删除后重新请求
+            self.discard(key)
+            return None
+        return data
+
+    def put(self, data):
+        """保存图片内容（先写临时文件再改名），返回编号"""
+        key = emoji_id(data)
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = os.path.join(self.directory, f".{key}-{uuid.uuid4().hex[:8]}")
+        try:
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, self.path(key))
+        except OSError:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+        self.known.add(key)
+        return key
+
+    def discard(self, key):
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def wait(self, key, message):
+        """登记一条等待图片的消息，需要向服务器请求时返回 True"""
+        with self.lock:
+            pending = self.waiting.setdefault(key, [])
+            pending.append(message)
+            return len(pending) == 1
+
+    def resolve(self, key):
+        """图片已收到，取出等待它的消息"""
+        with self.lock:
+            return self.waiting.pop(key, [])
@@ -0,0 +1,274 @@
+"""服务器联邦：把几个服务器节点（例如每个地点一个）连成一个聊天空间
+
+每个节点是一个独立的服务器进程，只持有连接到自己的用户，用户登录、注销时通知其他节点。
+节点之间两两建立一条 TCP 链路（只需一方在 --peer 中写出对方，另一方监听 --federation-port），
+链路上是 protocol.py 的帧，控制消息和 broker.py 相同：
+
+- hello / auth：交换节点名和随机数，用共享密钥（--federation-secret，必须设置）的 HMAC 互相认证，
+  HMAC 覆盖发送方、接收方的节点名和双方的随机数，不能把对方发来的认证消息反射回去冒充；
+- users：认证后发送本节点当前的在线用户，之后用 join / leave 发送增量；
+- deliver：私聊、游戏消息等发给对方节点上的某个用户；
+- broadcast：广播消息每个节点只发一份，由对方节点发给它的所有用户；
+- kick、emoji：强制对方节点上的用户下线，同步新加入的自定义表情。
+
+节点不转发其他节点的消息，所以所有节点必须两两相连。每个节点按自己看到的变化顺序维护在线状态版本号，
+发给本节点客户端的增量是连续的。两个节点同时登录了同名用户时，保留节点名较小的一方，另一方让自己的用户下线。
+链路断开后对方节点的用户全部下线，主动连接的一方每隔 RECONNECT_DELAY 秒重连。
+对方节点卡住、链路积压超过 LINK_MAX_BUFFER 时丢弃可丢弃的广播，其他消息则断开链路，积压是有界的。
+
+Federation 实现和 broker.BrokerClient 相同的 cluster 接口，挂接到 ChatServerCore 上。
+"""
+import asyncio
+import hashlib
+import hmac
+import os
+
+from protocol import FRAME_EMOJI, FrameProtocol, build_frame
+from broker import send_op, read_ops
+
+FEDERATION_PORT = 5100
+RECONNECT_DELAY = 2              # 链路断开后重连的间隔（秒）
+LINK_MAX_BUFFER = 4 * 1024 * 1024  # 链路积压超过这个字节数时丢弃可丢弃的广播，其他消息则断开链路
+
+
+def parse_peer(text):
+    """host:port -> (host, port)，省略端口时使用 FEDERATION_PORT"""
+    host, sep, port = text.rpartition(':')
+    if not sep:
+        return text, FEDERATION_PORT
+    return host.strip('[]'), int(port)
+
+
+class PeerLink:
+    """与另一个节点的一条链路"""
+
+    def __init__(self, outgoing):
+        self.outgoing = outgoing  # 是否由本节点发起
+        self.writer = None
+        self.node = None          # 对方的节点名，收到 hello 后确定
+        self.nonce = os.urandom(16).hex()
+        self.peer_nonce = None    # 对方的随机数
+        self.up = False           # 是否已经通过认证
+
+
+class Federation:
+    """本节点的联邦接口"""
+
+    def __init__(self, name, host='0.0.0.0', port=None, peers=(), secret=''):
+        if not secret:
+            raise ValueError("联邦节点必须设置共享密钥")
+        self.name = name
+        self.host = host
+        self.port = port          # 监听其他节点连接的端口，None 表示只主动连接
+        self.peers = list(peers)  # 主动连接的节点地址 [(host, port), ...]
+        self.secret = secret.encode()
+        self.core = None
+        self.server = None
+        self.tasks = set()
+        self.links = {}   # {节点名: 已认证的 PeerLink}
+        self.users = {}   # 所有节点的在线用户 {用户名: 节点名}，保持登录顺序
+        self.names = ()   # 用户名快照
+        self.version = 0  # 本节点看到的在线状态版本号
+
+    async def connect(self, core):
+        self.core = core
+        loop = asyncio.get_running_loop()
+        if self.port is not None:
+            self.server = await loop.create_server(
+                lambda: FrameProtocol(lambda reader, writer: self.run_link(PeerLink(False), reader, writer)),
+                self.host, self.port)
+            core.log_message(f"联邦节点 {self.name} 在端口 {self.port} 等待其他节点连接")
+        for host, port in self.peers:
+            task = asyncio.ensure_future(self.dial(host, port))
+            self.tasks.add(task)
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+        for task in self.tasks:
+            task.cancel()
+        for link in list(self.links.values()):
+            link.writer.close()
+
+    async def dial(self, host, port):
+        """主动连接一个节点，断开后重连；与该节点已经有另一条链路时不重复连接"""
+        loop = asyncio.get_running_loop()
+        node = None
+        while True:
+            if node is None or node not in self.links:
+                link = PeerLink(True)
+                try:
+                    _, protocol = await loop.create_connection(
+                        lambda: FrameProtocol(lambda reader, writer: self.run_link(link, reader, writer)),
+                        host, port)
+                    await protocol.task
+                except OSError as e:
+                    if node is not None:
+                        self.core.log_message(f"连接节点 {node} ({host}:{port}) 失败: {str(e)}")
+                node = link.node or node
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    async def run_link(self, link, reader, writer):
+        link.writer = writer
+        send_op(writer, {'op': 'hello', 'node': self.name, 'nonce': link.nonce})
+        try:
+            await read_ops(reader, lambda message, frame: self.handle(link, message, frame))
+        except (ConnectionError, ValueError, KeyError, TypeError) as e:
+            self.core.log_message(f"与节点 {link.node} 的链路出错: {str(e)}")
+        finally:
+            writer.close()
+            self.drop(link)
+
+    def mac(self, sender, receiver, challenge, nonce):
+        """sender 回应 receiver 的随机数 challenge 的认证码，nonce 是 sender 自己的随机数"""
+        message = '|'.join(('auth', sender, receiver, challenge, nonce)).encode()
+        return hmac.new(self.secret, message, hashlib.sha256).hexdigest()
+
+    def handle(self, link, message, frame):
+        op = message['op']
+        core = self.core
+        if op == 'hello':
+            node, nonce = message['node'], message['nonce']
+            if link.node is not None or not isinstance(node, str) or not node or node == self.name:
+                raise ConnectionError(f"非法的节点名: {node}")
+            if not isinstance(nonce, str) or len(nonce) < 32 or nonce == link.nonce:
+                raise ConnectionError("非法的随机数")
+            link.node, link.peer_nonce = node, nonce
+            self.send(link, {'op': 'auth', 'mac': self.mac(self.name, node, nonce, link.nonce)})
+        elif op == 'auth':
+            if link.node is None:
+                raise ConnectionError("节点认证失败")
+            expected = self.mac(link.node, self.name, link.nonce, link.peer_nonce)
+            if not hmac.compare_digest(str(message['mac']), expected):
+                raise ConnectionError("节点认证失败")
+            self.establish(link)
+        elif not link.up:
+            raise ConnectionError("节点尚未认证")
+        elif op == 'users':
+            for username in message['users']:
+                self.remote_join(link.node, username)
+        elif op == 'join':
+            self.remote_join(link.node, message['user'])
+        elif op == 'leave':
+            self.remote_leave(link.node, message['user'])
+        elif op == 'deliver':
+            conn = core.find_client(message['user'])
+            if conn is not None:
+                core.send_encoded(conn, frame)
+        elif op == 'broadcast':
+            core.multicast(frame, droppable=message.get('droppable', False))
+        elif op == 'kick':
+            if core.find_client(message['user']) is not None:
+                core.kick_user(message['user'])
+        elif op == 'emoji':
+            core.emojis.add(frame[1])
+
+    def establish(self, link):
+        """链路认证成功；同一个节点有两条链路时两边都保留由节点名较小的一方发起的那条"""
+        existing = self.links.get(link.node)
+        if existing is not None:
+            keep_outgoing = self.name < link.node
+            if existing.outgoing == keep_outgoing:
+                link.writer.close()
+                return
+            existing.writer.close()
+        link.up = True
+        self.links[link.node] = link
+        self.core.log_message(f"已连接联邦节点 {link.node}")
+        local = [name for name, node in self.users.items() if node == self.name]
+        self.send(link, {'op': 'users', 'users': local})
+        # 之前加入的自定义表情，对方节点的客户端可能会请求
+        for key, name in self.core.emojis.names.items():
+            if not name:
+                self.send(link, {'op': 'emoji'}, build_frame(FRAME_EMOJI, self.core.emojis.data[key]))
+
+    def drop(self, link):
+        if self.links.get(link.node) is not link:
+            return
+        del self.links[link.node]
+        self.core.log_message(f"与联邦节点 {link.node} 的链路已断开")
+        for username in [name for name, node in self.users.items() if node == link.node]:
+            self.remote_leave(link.node, username)
+
+    def remote_join(self, node, username):
+        owner = self.users.get(username)
+        if owner == node:
+            return
+        if owner is not None:
+            # 同名用户，保留节点名较小的一方（各节点的判断结果相同）
+            if owner < node:
+                return
+            self.users[username] = node
+            if owner == self.name:
+                conn = self.core.find_client(username)
+                if conn is not None:
+                    self.core.log_message(f"用户名 {username} 已在节点 {node} 登录，断开本节点的用户")
+                    self.core.send_to(conn, {'type': 'server_message',
+                                             'content': f'用户名 {username} 已在其他服务器登录'})
+                    self.core.remove_client(conn)
+            return
+        self.users[username] = node
+        self.changed('join', username)
+
+    def remote_leave(self, node, username):
+        if self.users.get(username) == node:
+            del self.users[username]
+            self.changed('leave', username)
+
+    def changed(self, change, username):
+        self.names = tuple(self.users)
+        self.version += 1
+        self.core.on_cluster_presence(change, username)
+
+    def send(self, link, message, frame=None, droppable=False):
+        """发给一个节点；对方节点卡住、链路积压超过 LINK_MAX_BUFFER 时丢弃可丢弃的消息，其他消息则断开链路"""
+        return send_op(link.writer, message, frame, droppable, LINK_MAX_BUFFER)
+
+    def send_all(self, message, frame=None):
+        for link in list(self.links.values()):
+            self.send(link, message, frame)
+
+    # ---------- cluster 接口 ----------
+
+    async def claim(self, username):
+        """登记本节点的用户，用户名已被任何节点的用户占用时返回 False"""
+        if username in self.users:
+            return False
+        self.users[username] = self.name
+        self.changed('join', username)
+        self.send_all({'op': 'join', 'user': username})
+        return True
+
+    def release(self, username):
+        if self.users.get(username) == self.name:
+            del self.users[username]
+            self.changed('leave', username)
+            self.send_all({'op': 'leave', 'user': username})
+
+    def presence(self):
+        return self.version, self.names
+
+    def locate(self, username):
+        owner = self.users.get(username)
+        return owner is not None and owner != self.name
+
+    def deliver(self, username, frame):
+        link = self.links.get(self.users.get(username))
+        if link is None:
+            return False
+        return self.send(link, {'op': 'deliver', 'user': username}, frame)
+
+    def broadcast(self, frame, droppable=False):
+        """每个节点只发一份"""
+        for link in list(self.links.values()):
+            self.send(link, {'op': 'broadcast', 'droppable': droppable}, frame, droppable)
+
+    def kick(self, username):
+        link = self.links.get(self.users.get(username))
+        if link is None:
+            return False
+        return self.send(link, {'op': 'kick', 'user': username})
+
+    def share_emoji(self, data):
+        self.send_all({'op': 'emoji'}, build_frame(FRAME_EMOJI, data))
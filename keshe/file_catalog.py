@@ -0,0 +1,251 @@
+"""服务器文件目录
+
+启动时扫描一次 server_files，在内存中保存每个文件的名称、大小、修改时间和 SHA-256，
+之后只根据上传、删除和 inotify 事件增量更新，并只把变化推送给客户端。
+文件哈希缓存在目录下的 .catalog.json 中，重启时大小和修改时间没变的文件不必重新计算。
+以 '.' 开头的文件是服务器内部使用的（缓存、未完成的上传等），不会出现在目录中。
+
+目录同时按哈希建立索引，内容相同的文件可以直接找到，用于上传去重（见 dedup.py）。
+"""
+import hashlib
+import json
+import os
+import struct
+
+CACHE_NAME = '.catalog.json'
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_hash(path):
+    """计算文件内容的 SHA-256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def is_hidden(name):
+    return name.startswith('.')
+
+
+class FileCatalog:
+    """文件名 -> {name, size, mtime, hash} 的内存目录"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.entries = {}
+        self.by_hash = {}     # {哈希: {文件名, ...}}
+        self._encoded = None  # 缓存的 JSON 编码结果，目录变化时失效
+        self.dirty = False    # 哈希缓存是否需要写回磁盘
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def load(self):
+        """扫描目录并加载所有文件信息，返回文件数量"""
+        cache = self._read_cache()
+        entries = {}
+        with os.scandir(self.directory) as it:
+            for item in it:
+                if is_hidden(item.name) or not item.is_file():
+                    continue
+                st = item.stat()
+                cached = cache.get(item.name)
+                if cached and cached['size'] == st.st_size and cached['mtime'] == st.st_mtime:
+                    entries[item.name] = cached
+                else:
+                    entries[item.name] = self._make_entry(item.name, st)
+                    self.dirty = True
+        if len(entries) != len(cache):
+            self.dirty = True
+        self.entries = entries
+        self.by_hash = {}
+        for entry in entries.values():
+            self.by_hash.setdefault(entry['hash'], set()).add(entry['name'])
+        self._encoded = None
+        self.save_cache()
+        return len(entries)
+
+    def stat_entry(self, name, known_hash=None):
+        """读取单个文件的最新信息（会计算哈希，可能较慢，适合放到线程池中执行）
+
+        文件不存在时返回 None；调用方已经知道内容哈希时（例如刚校验过的上传）传入 known_hash，不再重新计算。
+        """
+        if is_hidden(name):
+            return None
+        try:
+            st = os.stat(self.path(name))
+        except FileNotFoundError:
+            return None
+        old = self.entries.get(name)
+        if old and old['size'] == st.st_size and old['mtime'] == st.st_mtime:
+            return old
+        return self._make_entry(name, st, known_hash)
+
+    def apply(self, name, entry):
+        """用 stat_entry 的结果更新目录
+
+        返回变化 ('added', entry)、('removed', name)，没有变化时返回 None。
+        """
+        old = self.entries.get(name)
+        if entry is None:
+            if old is None:
+                return None
+            del self.entries[name]
+            self._unindex(old)
+            self._changed()
+            return ('removed', name)
+        if old == entry:
+            return None
+        if old is not None:
+            self._unindex(old)
+        self.entries[name] = entry
+        self.by_hash.setdefault(entry['hash'], set()).add(name)
+        self._changed()
+        return ('added', entry)
+
+    def remove(self, name):
+        return self.apply(name, None)
+
+    def get(self, name):
+        return self.entries.get(name)
+
+    def names(self):
+        return list(self.entries)
+
+    def find_hash(self, digest, exclude=None):
+        """返回一个内容哈希为 digest 的文件名（不包括 exclude），没有时返回 None"""
+        for name in self.by_hash.get(digest, ()):
+            if name != exclude:
+                return name
+        return None
+
+    def duplicates(self):
+        """返回 [(哈希, [文件名, ...]), ...]，只包含有多个文件名的内容"""
+        return [(digest, sorted(names)) for digest, names in self.by_hash.items() if len(names) > 1]
+
+    def encoded(self):
+        """整个目录的 JSON 编码（bytes），没有变化时直接复用"""
+        if self._encoded is None:
+            self._encoded = json.dumps(list(self.entries.values())).encode()
+        return self._encoded
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def _make_entry(self, name, st, known_hash=None):
+        return {
+            'name': name,
+            'size': st.st_size,
+            'mtime': st.st_mtime,
+            'hash': known_hash or file_hash(self.path(name)),
+        }
+
+    def _unindex(self, entry):
+        names = self.by_hash.get(entry['hash'])
+        if names is not None:
+            names.discard(entry['name'])
+            if not names:
+                del self.by_hash[entry['hash']]
+
+    def _changed(self):
+        self._encoded = None
+        self.dirty = True
+
+    def _read_cache(self):
+        try:
+            with open(self.path(CACHE_NAME), 'r', encoding='utf-8') as f:
+                return {entry['name']: entry for entry in json.load(f)}
+        except (OSError, ValueError, KeyError, TypeError):
+            return {}
+
+    def save_cache(self):
+        """把哈希缓存写回磁盘"""
+        if not self.dirty:
+            return
+        # 多进程部署时几个进程共用同一个目录，临时文件按进程区分
+        tmp_path = self.path(f"{CACHE_NAME}.{os.getpid()}.tmp")
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(list(self.entries.values()), f, ensure_ascii=False)
+            os.replace(tmp_path, self.path(CACHE_NAME))
+            self.dirty = False
+        except OSError:
+            pass
+
+
+# ---------- inotify（仅 Linux） ----------
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class DirectoryWatcher:
+    """用 inotify 监视目录，文件写完、移入、移出或删除时回调 callback(name)
+
+    不支持 inotify 的平台上 start() 返回 False，此时目录只靠服务器自身的操作更新。
+    """
+
+    def __init__(self, directory, callback):
+        self.directory = directory
+        self.callback = callback
+        self.fd = None
+        self.loop = None
+
+    def start(self, loop):
+        try:
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                return False
+            wd = libc.inotify_add_watch(fd, os.fsencode(self.directory), WATCH_MASK)
+            if wd < 0:
+                os.close(fd)
+                return False
+        except (OSError, AttributeError):
+            return False
+        self.fd = fd
+        self.loop = loop
+        loop.add_reader(fd, self._on_readable)
+        return True
+
+    def _on_readable(self):
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        names = []
+        while offset + EVENT_HEADER.size <= len(data):
+            _, _, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            raw_name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if raw_name:
+                name = os.fsdecode(raw_name)
+                if not is_hidden(name) and name not in names:
+                    names.append(name)
+        for name in names:
+            self.callback(name)
+
+    def stop(self):
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+            os.close(self.fd)
+            self.fd = None
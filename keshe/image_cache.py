@@ -0,0 +1,62 @@
+"""按内存预算淘汰的 LRU 缓存
+
+用来缓存解码后的表情图片（键是表情编号，见 emoji_catalog.py）：同一个表情只解码一次，
+缓存占用的内存超过预算时淘汰最久没有使用的图片。不依赖 Qt，每个值占用的内存由 cost 函数给出。
+"""
+import collections
+
+
+class LRUCache:
+    """只在界面线程中使用，不加锁"""
+
+    def __init__(self, budget, cost=len):
+        self.budget = budget
+        self.cost = cost
+        self.items = collections.OrderedDict()  # {键: (值, 占用字节数)}，最近使用的在末尾
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key):
+        item = self.items.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        self.items.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    def put(self, key, value):
+        """加入缓存，超出预算时淘汰旧的项（刚加入的项即使超出预算也保留）"""
+        old = self.items.pop(key, None)
+        if old is not None:
+            self.size -= old[1]
+        cost = self.cost(value)
+        self.items[key] = (value, cost)
+        self.size += cost
+        while self.size > self.budget and len(self.items) > 1:
+            _, (_, evicted) = self.items.popitem(last=False)
+            self.size -= evicted
+            self.evictions += 1
+        return value
+
+    def clear(self):
+        self.items.clear()
+        self.size = 0
+
+    def stats(self):
+        return {
+            'items': len(self.items),
+            'bytes': self.size,
+            'budget': self.budget,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,292 @@
+"""每个连接的出站发送队列
+
+发送方只把数据放进接收方的有界队列，由接收方自己的写协程负责真正写入 socket，
+因此一个很慢或卡住的客户端不会拖慢其他人。队列满时按策略处理：
+
+- drop:       丢弃可丢弃的状态更新（在线用户、文件列表等），其他消息则断开连接
+- disconnect: 直接断开该客户端
+- spill:      把后续数据暂存到磁盘临时文件，等客户端跟上后再从磁盘发送
+
+队列中的每一项是 protocol.build_frame 生成的不可变缓冲区元组，
+广播时所有接收者共享同一份编码结果，写入时用 writev 把帧头和内容一起发出。
+
+文件下载以 FileRegion 的形式排队，写协程用 sendfile 把文件内容分块直接从内核发往 socket，
+文件内容不经过 Python，也不会整个读入内存。协商了压缩且文件内容可压缩时，
+改为在线程池中逐块读取并压缩（见 FileRegion.read_frame）。
+"""
+import asyncio
+import collections
+import os
+import tempfile
+
+from protocol import build_chunk, compress_frame
+
+POLICY_DROP = 'drop'
+POLICY_DISCONNECT = 'disconnect'
+POLICY_SPILL = 'spill'
+POLICIES = (POLICY_DROP, POLICY_DISCONNECT, POLICY_SPILL)
+
+DEFAULT_MAX_BYTES = 1024 * 1024         # 内存队列上限
+DEFAULT_MAX_SPILL_BYTES = 256 * 1024 * 1024  # 磁盘暂存上限
+BATCH_BYTES = 256 * 1024                # 写协程每次最多取出的字节数
+SPILL_READ_SIZE = 64 * 1024
+SENDFILE_CHUNK_SIZE = 1024 * 1024      # 文件下载每个数据块的大小
+
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+
+class QueueOverflow(ConnectionError):
+    """发送队列已满，需要断开客户端"""
+
+
+class SpillFile:
+    """磁盘暂存文件，先写入的数据先读出"""
+
+    def __init__(self, spill_dir=None):
+        self.file = tempfile.TemporaryFile(prefix='spill-', dir=spill_dir)
+        self.write_pos = 0
+        self.read_pos = 0
+
+    def write(self, data):
+        self.file.seek(self.write_pos)
+        self.file.write(data)
+        self.write_pos += len(data)
+
+    def read(self, size=SPILL_READ_SIZE):
+        self.file.seek(self.read_pos)
+        data = self.file.read(min(size, self.write_pos - self.read_pos))
+        self.read_pos += len(data)
+        return data
+
+    def unread(self):
+        return self.write_pos - self.read_pos
+
+    def close(self):
+        try:
+            self.file.close()
+        except OSError:
+            pass
+
+
+class FileRegion:
+    """待发送的一段文件内容
+
+    每次发送 SENDFILE_CHUNK_SIZE 字节，作为一个 FRAME_CHUNK 数据块；
+    块与块之间可以穿插发送聊天消息，大文件下载不会阻塞其他消息。
+    全部发送完后再发送 trailer 帧（例如 download_end）。
+    设置了 compressor 时数据块不用 sendfile，而是读出来压缩后发送。
+    """
+
+    def __init__(self, file, transfer_id, offset, count, trailer=None,
+                 chunk_size=SENDFILE_CHUNK_SIZE, compressor=None):
+        self.file = file
+        self.transfer_id = transfer_id
+        self.offset = offset
+        self.remaining = count
+        self.trailer = trailer
+        self.chunk_size = chunk_size
+        self.compressor = compressor
+
+    def next_count(self):
+        """下一个数据块的大小"""
+        return min(self.chunk_size, self.remaining)
+
+    def read_frame(self, count):
+        """读出下一个数据块并编码成（可能压缩过的）帧，会阻塞，应在线程池中调用"""
+        self.file.seek(self.offset)
+        data = self.file.read(count)
+        if len(data) != count:
+            raise ConnectionError("文件在发送过程中被截断")
+        return compress_frame(build_chunk(self.transfer_id, data), self.compressor)
+
+    def advance(self, count):
+        self.offset += count
+        self.remaining -= count
+
+    def close(self):
+        try:
+            self.file.close()
+        except OSError:
+            pass
+
+
+class OutboundQueue:
+    """有界出站队列"""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, policy=POLICY_DROP,
+                 spill_dir=None, max_spill_bytes=DEFAULT_MAX_SPILL_BYTES):
+        if policy not in POLICIES:
+            raise ValueError(f"未知的队列溢出策略: {policy}")
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.spill_dir = spill_dir
+        self.max_spill_bytes = max_spill_bytes
+
+        self.items = collections.deque()  # [(帧, 长度, 是否计入上限)]
+        self.size = 0       # 计入上限的排队字节数
+        self.bulk_size = 0  # 不计入上限的大块数据字节数
+        self.spill = None
+        self.regions = collections.deque()  # 正在发送的文件，轮流各发一块
+        self.closed = False
+        self.waiter = asyncio.Event()
+        self.drained = asyncio.Event()  # 有数据被取走发送时设置，供 wait_below 等待
+
+        # 统计
+        self.dropped = 0
+        self.spilled_bytes = 0
+
+    def put(self, frame, droppable=False, bulk=False):
+        """放入一帧（缓冲区元组），队列溢出且需要断开客户端时抛出 QueueOverflow
+
+        bulk 表示客户端主动请求的大块数据（例如欢迎消息中的完整文件目录），
+        它不计入队列上限，否则其后的小消息都会被误判为客户端太慢。
+        """
+        if self.closed:
+            raise ConnectionError("连接已关闭")
+
+        length = 0
+        for buf in frame:
+            length += len(buf)
+
+        if bulk and self.spill is None:
+            self.items.append((frame, length, False))
+            self.bulk_size += length
+        elif self.spill is not None:
+            # 已经开始暂存到磁盘，后续数据也写入磁盘以保证顺序
+            self._spill(frame, length)
+        elif self.items and self.size + length > self.max_bytes:
+            if self.policy == POLICY_SPILL:
+                self.spill = SpillFile(self.spill_dir)
+                self._spill(frame, length)
+            elif self.policy == POLICY_DROP and droppable:
+                self.dropped += 1
+                return
+            else:
+                raise QueueOverflow("发送队列已满")
+        else:
+            self.items.append((frame, length, True))
+            self.size += length
+        self.waiter.set()
+
+    def put_region(self, region):
+        """放入一段待发送的文件
+
+        文件数据在所有已排队的消息之后发送，之后到达的消息也优先于下一个数据块。
+        """
+        if self.closed:
+            region.close()
+            raise ConnectionError("连接已关闭")
+        self.regions.append(region)
+        self.waiter.set()
+
+    def requeue(self, region):
+        """一个数据块发送完后，把还没发完的文件放回队尾"""
+        self.regions.append(region)
+
+    def _spill(self, frame, length):
+        if self.spill.unread() + length > self.max_spill_bytes:
+            raise QueueOverflow("发送队列的磁盘暂存已满")
+        for buf in frame:
+            self.spill.write(buf)
+        self.spilled_bytes += length
+
+    async def get_batch(self, max_bytes=BATCH_BYTES):
+        """取出一批待发送的缓冲区列表，队列关闭且已发送完时返回 None
+
+        没有排队的消息时返回一个 FileRegion，由调用方发送其中的一块。
+        """
+        while not self.items and self.spill is None and not self.regions:
+            if self.closed:
+                return None
+            self.waiter.clear()
+            await self.waiter.wait()
+
+        if self.items:
+            batch = []
+            total = 0
+            while self.items and total < max_bytes and len(batch) < IOV_MAX - 1:
+                frame, length, counted = self.items.popleft()
+                batch.extend(frame)
+                total += length
+                if counted:
+                    self.size -= length
+                else:
+                    self.bulk_size -= length
+            self.drained.set()
+            return batch
+
+        if self.spill is None:
+            return self.regions.popleft()
+
+        # 内存中的数据发完后再发送磁盘上暂存的数据
+        data = self.spill.read()
+        if not self.spill.unread():
+            self.spill.close()
+            self.spill = None
+        self.drained.set()
+        return [data]
+
+    async def wait_below(self, limit):
+        """等待排队的消息（不含文件下载）降到 limit 字节以下，队列关闭时立即返回
+
+        用于转发数据时的背压：接收方跟不上时暂停读取发送方的数据。
+        """
+        while not self.closed and self.queued() > limit:
+            self.drained.clear()
+            await self.drained.wait()
+
+    def close(self):
+        """不再接受新数据，已排队的数据仍会发送"""
+        self.closed = True
+        self.waiter.set()
+        self.drained.set()
+
+    def discard(self):
+        """丢弃所有未发送的数据"""
+        self.closed = True
+        self.items.clear()
+        self.size = 0
+        self.bulk_size = 0
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+        while self.regions:
+            self.regions.popleft().close()
+        self.waiter.set()
+        self.drained.set()
+
+    def queued(self):
+        """排队的消息字节数（包括暂存到磁盘的，不包括文件下载）"""
+        spilled = self.spill.unread() if self.spill is not None else 0
+        return self.size + self.bulk_size + spilled
+
+    def pending(self):
+        """尚未发送的字节数"""
+        return self.queued() + sum(region.remaining for region in self.regions)
+
+
+def write_vectored(transport, buffers):
+    """把多个缓冲区写入传输层
+
+    传输层缓冲区为空时直接对 socket 调用 writev，一次系统调用发出帧头和内容，
+    无需先拼接成一个大的 bytes；没写完的部分再交给传输层排队。
+    """
+    sock = transport.get_extra_info('socket')
+    if (hasattr(os, 'writev') and sock is not None
+            and transport.get_write_buffer_size() == 0 and not transport.is_closing()):
+        try:
+            sent = os.writev(sock.fileno(), buffers)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        for i, buf in enumerate(buffers):
+            if sent < len(buf):
+                rest = [memoryview(buf)[sent:]]
+                rest.extend(buffers[i + 1:])
+                transport.writelines(rest)
+                return
+            sent -= len(buf)
+        return
+    transport.writelines(buffers)
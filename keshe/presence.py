@@ -0,0 +1,52 @@
+"""客户端在线用户状态跟踪
+
+服务器只推送 join/leave 增量，每条增量带有单调递增的版本号。
+版本号不连续说明漏掉了增量（例如服务器因队列拥塞丢弃了它），
+此时需要向服务器请求一次完整的在线列表（presence_sync）。
+"""
+
+
+class PresenceTracker:
+    """按版本号检查并应用在线状态增量"""
+
+    def __init__(self):
+        self.version = None
+        self.syncing = False
+        self.pending = []  # 等待完整列表期间收到的增量
+
+    def reset(self, version):
+        """收到完整在线列表（欢迎消息或重新同步的结果）后调用
+
+        返回 (等待期间缓存、且比该列表更新的增量 [(op, user)], 是否需要再发送 presence_sync 请求)，
+        调用方应继续应用这些增量；缓存的增量中版本号仍不连续时需要重新同步。
+        """
+        self.version = version
+        self.syncing = False
+        pending, self.pending = self.pending, []
+        changes = []
+        need_sync = False
+        for delta in sorted(pending, key=lambda d: d['version']):
+            delta_changes, gap = self.apply(delta)
+            changes.extend(delta_changes)
+            need_sync = need_sync or gap
+        return changes, need_sync
+
+    def apply(self, delta):
+        """处理一条增量
+
+        返回 (可以立即应用的 [(op, user)], 是否需要发送 presence_sync 请求)。
+        """
+        if self.version is None or self.syncing:
+            self.pending.append(delta)
+            return [], False
+
+        version = delta['version']
+        if version <= self.version:  # 已经包含在当前列表中
+            return [], False
+        if version != self.version + 1:
+            self.syncing = True
+            self.pending.append(delta)
+            return [], True
+
+        self.version = version
+        return [(delta['op'], delta['user'])], False
@@ -0,0 +1,385 @@
+"""客户端与服务器共用的通信协议
+
+每一帧的格式为：1 字节类型 + 4 字节大端长度 + 内容。
+TCP 会合并或拆分数据，因此接收方必须按帧解码，不能直接对 recv 的结果做 json.loads。
+类型字节的最高位表示内容经过压缩（见 compression.py），接收时会自动解压。
+接收方用 recv_into 把每一帧读进自己的缓冲区（见 buffer_pool.py），帧内容以 memoryview 交给调用方。
+"""
+import asyncio
+import collections
+import json
+import struct
+import threading
+
+from buffer_pool import default_pool
+from compression import decompress
+
+PROTOCOL_VERSION = 4  # 2: 表情帧和文件帧改用 binary_codec 编码；3: 协商后可以压缩帧；4: 表情按编号发送
+
+FRAME_JSON = 0x00   # JSON 控制消息
+FRAME_EMOJI = 0x01  # 表情
+# 0x02 曾是整个文件放在一帧中的文件帧，已删除，文件一律分块传输
+FRAME_CHUNK = 0x03  # 分块传输的数据块：4 字节传输编号 + 数据
+RELAY_ID_BASE = 0x80000000  # 服务器为转发的私发文件分配的传输编号从这里开始，不会与客户端自己的编号冲突
+FLAG_COMPRESSED = 0x80  # 类型字节的最高位：内容经过压缩
+
+CHUNK_SIZE = 256 * 1024  # 分块传输时每块的大小
+
+HEADER = struct.Struct('>BI')
+HEADER_SIZE = HEADER.size
+TRANSFER_ID = struct.Struct('>I')
+
+RECV_SIZE = 65536           # 接收暂存区的大小，放不下的帧直接读入帧缓冲区
+POOLED_FRAME_SIZE = 4096   # 不小于这个大小的帧使用缓冲池中的缓冲区
+MAX_PENDING_FRAMES = 256    # 服务器端积压这么多帧或 MAX_PENDING_BYTES 字节没有处理时暂停读取
+MAX_PENDING_BYTES = 1024 * 1024
+MAX_FRAME_SIZE = 4 * 1024 * 1024           # 服务器接受的单帧上限：数据块最大 1 MiB，加上其他字段绰绰有余
+MAX_CLIENT_FRAME_SIZE = 64 * 1024 * 1024   # 客户端接受的单帧上限：欢迎消息中带有完整的文件目录
+
+
+class FrameError(ValueError):
+    """帧头不合法（例如声明的长度超过上限），只能断开连接"""
+
+
+def encode_frame(frame_type, payload):
+    """把内容编码成一帧"""
+    return HEADER.pack(frame_type, len(payload)) + payload
+
+
+def encode_json(obj):
+    """把字典编码成 JSON 帧"""
+    return encode_frame(FRAME_JSON, json.dumps(obj).encode())
+
+
+def decode_json(payload):
+    """解析 JSON 帧的内容"""
+    return json.loads(bytes(payload).decode())
+
+
+def build_frame(frame_type, payload):
+    """把一帧编码成 (帧头, 内容) 两个缓冲区，内容不做拷贝
+
+    返回的元组不可变，广播时可以直接共享给所有接收者。
+    """
+    return (HEADER.pack(frame_type, len(payload)), payload)
+
+
+def build_json(obj):
+    """把字典编码成 (帧头, 内容) 形式的 JSON 帧"""
+    return build_frame(FRAME_JSON, json.dumps(obj).encode())
+
+
+def chunk_header(transfer_id, length):
+    """数据块帧的帧头（含传输编号），后面紧跟 length 字节的数据"""
+    return HEADER.pack(FRAME_CHUNK, TRANSFER_ID.size + length) + TRANSFER_ID.pack(transfer_id)
+
+
+def build_chunk(transfer_id, data):
+    """编码一个数据块帧，数据本身不做拷贝"""
+    return (chunk_header(transfer_id, len(data)), data)
+
+
+def parse_chunk(payload):
+    """解析数据块帧，返回 (传输编号, 数据的 memoryview)"""
+    return TRANSFER_ID.unpack_from(payload)[0], memoryview(payload)[TRANSFER_ID.size:]
+
+
+def compress_frame(frame, compressor, filename=None):
+    """按需压缩已编码的帧（缓冲区元组），不值得压缩时原样返回
+
+    根据帧中最后一个缓冲区（数据部分）的开头判断内容格式，filename 可以提供额外的提示。
+    """
+    frame_type, length = HEADER.unpack_from(frame[0])
+    if frame_type & FLAG_COMPRESSED or not length:
+        return frame
+    if len(frame) == 1:
+        payload = bytes(memoryview(frame[0])[HEADER_SIZE:])
+    else:
+        payload = b''.join([memoryview(frame[0])[HEADER_SIZE:], *frame[1:]])
+    compressed = compressor.compress(payload, sniff=frame[-1][:16], filename=filename)
+    if compressed is None:
+        return frame
+    return build_frame(frame_type | FLAG_COMPRESSED, compressed)
+
+
+def sendall_buffers(sock, buffers):
+    """用 sendmsg 一次系统调用发送多个缓冲区（聚集写），不支持时退回 sendall"""
+    if not hasattr(sock, 'sendmsg'):  # Windows
+        sock.sendall(b''.join(buffers))
+        return
+    views = [memoryview(b) for b in buffers if len(b)]
+    while views:
+        sent = sock.sendmsg(views)
+        while views and sent >= len(views[0]):
+            sent -= len(views[0])
+            views.pop(0)
+        if sent:
+            views[0] = views[0][sent:]
+
+
+def send_frame(sock, frame_type, payload):
+    """通过阻塞 socket 发送一帧"""
+    sendall_buffers(sock, build_frame(frame_type, payload))
+
+
+def send_json(sock, obj):
+    """通过阻塞 socket 发送一条 JSON 消息"""
+    sock.sendall(encode_json(obj))
+
+
+class FrameWriter:
+    """线程安全的阻塞式帧发送器
+
+    GUI 线程发送聊天消息的同时，后台线程可能正在分块上传文件，
+    加锁保证每一帧都完整地写入 socket，不会和其他帧交错。
+    与服务器协商好压缩算法后设置 compressor，之后发送的帧按需压缩（在加锁之前完成）。
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.compressor = None
+
+    def send_buffers(self, buffers, compress=True):
+        if compress and self.compressor is not None:
+            buffers = compress_frame(buffers, self.compressor)
+        with self.lock:
+            sendall_buffers(self.sock, buffers)
+
+    def send_frame(self, frame_type, payload):
+        self.send_buffers(build_frame(frame_type, payload))
+
+    def send_json(self, obj):
+        self.send_buffers(build_json(obj))
+
+    def send_chunk(self, transfer_id, data, compress=True):
+        """发送一个数据块，已知内容不可压缩时（例如上传图片）传入 compress=False"""
+        self.send_buffers(build_chunk(transfer_id, data), compress)
+
+
+class FrameAssembler:
+    """不做 I/O 的帧组装器，阻塞的 FrameReader 和 asyncio 的 FrameProtocol 共用
+
+    get_buffer() 给出下一次 recv_into 应该写入的位置，filled(n) 报告实际读入的字节数，
+    组装好的帧用 take() 取出 [(类型, 内容), ...]：
+
+    - 数据先读进暂存区，一次 recv 可以读到多帧；
+    - 小于 POOLED_FRAME_SIZE 的帧直接从暂存区复制成 bytes（在 CPython 中这比管理缓冲池更快）；
+    - 其余的帧各自从缓冲池（buffer_pool）取一个缓冲区，内容是指向它的 memoryview；
+      暂存区放不下的大帧，已经读到的开头复制过去后，剩余部分直接 recv_into 到帧缓冲区中。
+      帧缓冲区随实际收到的数据成倍扩大，不按帧头声明的长度一次分配；
+      声明的长度超过 max_frame 时抛出 FrameError。
+
+    取出的帧缓冲区隔一次 recycle() 再放回缓冲池（仍被引用的不会复用）：调用方通常在
+    frames = reader.read_batch() 的赋值完成之前还引用着上一批帧。
+    压缩的帧在这里解压，解压失败时抛出 CompressionError。
+    """
+
+    def __init__(self, pool=default_pool, stage_size=RECV_SIZE, max_frame=MAX_FRAME_SIZE):
+        self.pool = pool
+        self.max_frame = max_frame
+        self.stage = bytearray(stage_size)
+        self.stage_view = memoryview(self.stage)
+        self.start = 0   # 暂存区中未处理的数据为 [start, end)
+        self.end = 0
+        self.current = None  # 正在直接读入的大帧 [类型, 缓冲区, 长度, 已读入的字节数]
+        self.frames = collections.deque()  # 组装好的帧 (类型, 内容, 缓冲区)
+        self.pending_bytes = 0  # 组装好还没有取出的帧的总字节数
+        self.lent = []      # 上一次 recycle 之后取出的帧缓冲区
+        self.returned = []  # 再上一批取出的帧缓冲区，下一次 recycle 时放回缓冲池
+
+    def get_buffer(self):
+        if self.current is not None:
+            _, buffer, length, received = self.current
+            return memoryview(buffer)[received:min(length, len(buffer))]
+        if self.start:
+            # 把未处理的部分移到暂存区开头
+            pending = self.end - self.start
+            self.stage_view[:pending] = self.stage_view[self.start:self.end]
+            self.start, self.end = 0, pending
+        return self.stage_view[self.end:]
+
+    def filled(self, count):
+        if self.current is not None:
+            self.current[3] += count
+            frame_type, buffer, length, received = self.current
+            if received == length:
+                self.current = None
+                self._complete(frame_type, buffer, length)
+            elif received == len(buffer):
+                self._grow()
+            return
+        self.end += count
+        self._parse()
+
+    def _parse(self):
+        while self.end - self.start >= HEADER_SIZE:
+            frame_type, length = HEADER.unpack_from(self.stage, self.start)
+            if length > self.max_frame:
+                raise FrameError(f"帧长度 {length} 超过上限 {self.max_frame}")
+            body = self.start + HEADER_SIZE
+            available = self.end - body
+            if available >= length and length < POOLED_FRAME_SIZE:
+                payload = bytes(self.stage_view[body:body + length])
+                self.start = body + length
+                if frame_type & FLAG_COMPRESSED:
+                    frame_type &= ~FLAG_COMPRESSED
+                    payload = decompress(payload)
+                self.frames.append((frame_type, payload, None))
+                self.pending_bytes += len(payload)
+            elif available >= length:
+                buffer = self.pool.acquire(length)
+                buffer[:length] = self.stage_view[body:body + length]
+                self.start = body + length
+                self._complete(frame_type, buffer, length)
+            elif HEADER_SIZE + length > len(self.stage):
+                buffer = self.pool.acquire(min(length, max(available, len(self.stage)) * 2))
+                buffer[:available] = self.stage_view[body:self.end]
+                self.current = [frame_type, buffer, length, available]
+                self.start = self.end = 0
+                return
+            else:
+                break
+        if self.start == self.end:
+            self.start = self.end = 0
+
+    def _grow(self):
+        """正在读入的大帧填满了当前缓冲区，换一个两倍大的"""
+        buffer, length, received = self.current[1:]
+        larger = self.pool.acquire(min(length, len(buffer) * 2))
+        larger[:received] = memoryview(buffer)[:received]
+        self.pool.release(buffer)
+        self.current[1] = larger
+
+    def _complete(self, frame_type, buffer, length):
+        payload = memoryview(buffer)[:length]
+        if frame_type & FLAG_COMPRESSED:
+            try:
+                data = decompress(payload)
+            finally:
+                payload.release()
+                self.pool.release(buffer)
+            self.frames.append((frame_type & ~FLAG_COMPRESSED, data, None))
+            self.pending_bytes += len(data)
+        else:
+            self.frames.append((frame_type, payload, buffer))
+            self.pending_bytes += length
+
+    def take(self):
+        """取出所有组装好的帧"""
+        frames = []
+        while self.frames:
+            frame_type, payload, buffer = self.frames.popleft()
+            if buffer is not None:
+                self.lent.append(buffer)
+            frames.append((frame_type, payload))
+        self.pending_bytes = 0
+        return frames
+
+    def recycle(self):
+        """把再上一批取出的帧缓冲区放回缓冲池"""
+        if self.returned:
+            self.pool.release_all(self.returned)
+        self.returned, self.lent = self.lent, []
+
+
+class FrameReader:
+    """阻塞 socket 的帧读取器（客户端使用）"""
+
+    def __init__(self, sock, pool=default_pool, max_frame=MAX_CLIENT_FRAME_SIZE):
+        self.sock = sock
+        self.assembler = FrameAssembler(pool, max_frame=max_frame)
+
+    def read_batch(self):
+        """读取一批完整的帧 [(类型, memoryview), ...]，连接关闭时返回 None
+
+        上一批帧的缓冲区在这时回收，调用方仍然持有的内容不受影响。
+        """
+        assembler = self.assembler
+        assembler.recycle()
+        while not assembler.frames:
+            count = self.sock.recv_into(assembler.get_buffer())
+            if not count:
+                return None
+            assembler.filled(count)
+        return assembler.take()
+
+
+class FrameProtocol(asyncio.streams.FlowControlMixin, asyncio.BufferedProtocol):
+    """asyncio 的帧接收协议（服务器使用）
+
+    事件循环通过 get_buffer / buffer_updated 用 recv_into 把数据直接读进帧缓冲区；
+    发送仍然使用 asyncio.StreamWriter，drain 的流量控制由 FlowControlMixin 提供。
+    连接建立后调用 on_connection(本协议, StreamWriter)，本协议的 read_batch 用于读取帧。
+    积压的帧达到 max_pending 个或 max_pending_bytes 字节时暂停读取，等取走这一批再继续，
+    处理得慢（例如转发私发文件时接收方跟不上）的连接会通过 TCP 流量控制让发送方放慢。
+    """
+
+    def __init__(self, on_connection, pool=default_pool, max_pending=MAX_PENDING_FRAMES,
+                 max_pending_bytes=MAX_PENDING_BYTES):
+        super().__init__(asyncio.get_running_loop())
+        self.on_connection = on_connection
+        self.assembler = FrameAssembler(pool)
+        self.max_pending = max_pending
+        self.max_pending_bytes = max_pending_bytes
+        self.transport = None
+        self.task = None
+        self.waiter = None
+        self.error = None
+        self.eof = False
+        self.reading_paused = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        writer = asyncio.StreamWriter(transport, self, None, self._loop)
+        self.task = self._loop.create_task(self.on_connection(self, writer))
+
+    def get_buffer(self, sizehint):
+        return self.assembler.get_buffer()
+
+    def buffer_updated(self, nbytes):
+        try:
+            self.assembler.filled(nbytes)
+        except Exception as e:
+            self.error = e
+            self.transport.pause_reading()
+        assembler = self.assembler
+        if not self.reading_paused and (len(assembler.frames) >= self.max_pending
+                                        or assembler.pending_bytes >= self.max_pending_bytes):
+            self.reading_paused = True
+            self.transport.pause_reading()
+        self._wakeup()
+
+    def eof_received(self):
+        self.eof = True
+        self._wakeup()
+        return True  # 保持连接打开，把已排队的数据发完
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        self.eof = True
+        self._wakeup()
+
+    def _wakeup(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    async def read_batch(self):
+        """返回一批完整的帧 [(类型, memoryview), ...]，连接关闭时返回空列表"""
+        assembler = self.assembler
+        assembler.recycle()
+        while not assembler.frames:
+            if self.error is not None:
+                raise self.error
+            if self.eof:
+                return []
+            self.waiter = self._loop.create_future()
+            try:
+                await self.waiter
+            finally:
+                self.waiter = None
+        frames = assembler.take()
+        if self.reading_paused and self.error is None:
+            self.reading_paused = False
+            self.transport.resume_reading()
+        return frames
@@ -0,0 +1,83 @@
+"""在线用户路由表
+
+按用户名建立索引，查找目标连接是 O(1)；广播时遍历不可变的快照元组，
+在遍历过程中有用户加入或离开也不会影响正在进行的广播。
+每次加入或离开都会让 version 加一，客户端据此判断是否漏掉了在线状态的增量。
+"""
+import threading
+
+
+class RoutingTable:
+    """用户名 <-> 连接 的双向索引，带写时复制的快照"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_name = {}  # {username: conn}
+        self._by_conn = {}  # {conn: username}，保持加入顺序
+        self._conns = ()    # 连接快照
+        self._names = ()    # 用户名快照
+        self.version = 0    # 在线状态版本号，单调递增
+
+    def add(self, username, conn):
+        """登记用户，用户名已被占用时返回 False"""
+        with self._lock:
+            if username in self._by_name or conn in self._by_conn:
+                return False
+            self._by_name[username] = conn
+            self._by_conn[conn] = username
+            self._conns = None
+            self._names = None
+            self.version += 1
+            return True
+
+    def remove(self, conn):
+        """移除连接，返回其用户名；连接未登记时返回 None"""
+        with self._lock:
+            username = self._by_conn.pop(conn, None)
+            if username is None:
+                return None
+            del self._by_name[username]
+            self._conns = None
+            self._names = None
+            self.version += 1
+            return username
+
+    def get(self, username):
+        """按用户名查找连接"""
+        return self._by_name.get(username)
+
+    def name_of(self, conn):
+        return self._by_conn.get(conn)
+
+    def snapshot(self):
+        """返回当前所有连接的不可变快照，只在成员变化后重建一次"""
+        conns = self._conns
+        if conns is None:
+            with self._lock:
+                conns = self._conns
+                if conns is None:
+                    conns = self._conns = tuple(self._by_conn)
+        return conns
+
+    def usernames(self):
+        """返回当前所有用户名的不可变快照（按加入顺序）"""
+        names = self._names
+        if names is None:
+            with self._lock:
+                names = self._names
+                if names is None:
+                    names = self._names = tuple(self._by_conn.values())
+        return names
+
+    def presence(self):
+        """返回 (版本号, 用户名快照)，两者保证一致"""
+        with self._lock:
+            if self._names is None:
+                self._names = tuple(self._by_conn.values())
+            return self.version, self._names
+
+    def __contains__(self, conn):
+        return conn in self._by_conn
+
+    def __len__(self):
+        return len(self._by_conn)
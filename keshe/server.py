@@ -0,0 +1,219 @@
+"""无界面的聊天服务器入口（不导入 PyQt，可以在没有显示器的服务器上运行）
+
+日志写到滚动日志文件（--log-file）和标准输出，管理命令通过 Unix 域 socket（--admin-socket）执行，
+见 admin.py。收到 SIGTERM 或 Ctrl+C 时关闭监听并删除管理 socket 文件后退出。
+
+--workers N（N > 1）时主进程运行 broker（见 broker.py）并启动 N 个工作进程，
+它们用 SO_REUSEPORT 监听同一个端口，每个进程一个事件循环，连接数和吞吐量可以随 CPU 核数增加。
+每个工作进程写自己的日志文件（server.1.log、server.2.log ...），管理 socket 由 1 号进程打开。
+工作进程意外退出时主进程会重新启动它。
+
+--node-name 启用联邦（见 federation.py）：几个独立的服务器节点两两相连，各自的用户互相可见。
+节点之间的共享密钥用 --federation-secret 或环境变量 CHAT_FEDERATION_SECRET 指定。
+
+用法: python server.py [--host 0.0.0.0] [--port 5000] [--admin-socket server.sock] [--workers 4]
+      python server.py --node-name 北京 --federation-port 5100 --peer shanghai.example.com:5100
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+
+from compression import available
+from outbound import POLICIES, POLICY_DROP, DEFAULT_MAX_BYTES
+from admin import ADMIN_SOCKET
+from broker import BROKER_SOCKET, Broker, BrokerClient
+from federation import Federation, parse_peer
+from server_core import ChatServerCore, print_log
+
+RESTART_CHECK_INTERVAL = 1  # 主进程检查工作进程是否存活的间隔（秒）
+MIN_UPTIME = 5              # 工作进程启动后这么短时间内就退出，视为启动失败，不再重启（秒）
+STOP_TIMEOUT = 10           # 退出时等待工作进程结束的最长时间（秒）
+
+
+def off(value):
+    """命令行中 off 表示不启用"""
+    return None if value == 'off' else value
+
+
+def worker_path(path, worker):
+    """工作进程自己的日志文件：server.log -> server.1.log"""
+    if path is None or worker is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{worker}{ext}"
+
+
+def make_core(args, worker=None, cluster=None):
+    compression = [] if args.compression == 'off' else args.compression.split(',')
+    admin_socket = off(args.admin_socket) if worker in (None, 1) else None
+    core = ChatServerCore(args.host, args.port, files_dir=args.files_dir,
+                          queue_limit=args.queue_limit, overflow_policy=args.overflow_policy,
+                          compression=compression, log_file=worker_path(off(args.log_file), worker),
+                          admin_socket=admin_socket, cluster=cluster, reuse_port=worker is not None,
+                          transfer_secret=args.transfer_secret)
+    if not args.quiet:
+        if worker is None:
+            core.add_listener('log', print_log)
+        else:
+            core.add_listener('log', lambda message: print_log(f"[{worker}] {message}"))
+    return core
+
+
+def request_stop(core):
+    """SIGTERM：在事件循环中停止服务器，和 Ctrl+C 一样执行清理"""
+    if core.loop is None:
+        sys.exit(0)
+    core.call_threadsafe(core.stop)
+
+
+def run_core(core):
+    signal.signal(signal.SIGTERM, lambda signum, frame: request_stop(core))
+    try:
+        core.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if core.journal is not None:
+            core.journal.close()
+
+
+def run_worker(args, worker):
+    """工作进程的入口"""
+    run_core(make_core(args, worker, BrokerClient(args.broker_socket, worker)))
+
+
+class Supervisor:
+    """主进程：运行 broker，启动工作进程，工作进程意外退出时重新启动"""
+
+    def __init__(self, args):
+        self.args = args
+        # 不用 fork：子进程不应该继承主进程的事件循环
+        self.context = multiprocessing.get_context('spawn')
+        self.broker = Broker(args.broker_socket)
+        self.processes = {}  # {工作进程编号: (Process, 启动时间)}
+        self.stopping = None
+
+    def log(self, message):
+        if not self.args.quiet:
+            print_log(message)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        loop.add_signal_handler(signal.SIGTERM, self.stopping.set)
+        loop.add_signal_handler(signal.SIGINT, self.stopping.set)
+        await self.broker.start()
+        try:
+            for worker in range(1, self.args.workers + 1):
+                self.start_worker(worker)
+            self.log(f"已启动 {self.args.workers} 个工作进程，broker: {self.broker.path}")
+            while not self.stopping.is_set():
+                try:
+                    await asyncio.wait_for(self.stopping.wait(), RESTART_CHECK_INTERVAL)
+                except asyncio.TimeoutError:
+                    self.check_workers()
+        finally:
+            # 工作进程退出时还要通过 broker 注销用户，最后再关闭 broker
+            await self.stop_workers()
+            self.broker.close()
+
+    def check_workers(self):
+        for worker, (process, started) in list(self.processes.items()):
+            if process.is_alive():
+                continue
+            if time.monotonic() - started < MIN_UPTIME:
+                raise RuntimeError(f"工作进程 {worker} 启动失败（退出码 {process.exitcode}）")
+            self.log(f"工作进程 {worker} 已退出（退出码 {process.exitcode}），重新启动")
+            self.start_worker(worker)
+
+    def start_worker(self, worker):
+        process = self.context.Process(target=run_worker, args=(self.args, worker),
+                                       name=f"chat-worker-{worker}")
+        process.start()
+        self.processes[worker] = (process, time.monotonic())
+
+    async def stop_workers(self):
+        processes = [process for process, _ in self.processes.values()]
+        self.processes.clear()
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + STOP_TIMEOUT
+        while any(process.is_alive() for process in processes) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        for process in processes:
+            if process.is_alive():
+                process.kill()
+            process.join()
+
+
+def run_cluster(args):
+    if not hasattr(socket, 'SO_REUSEPORT') or not hasattr(socket, 'AF_UNIX'):
+        print("当前系统不支持 SO_REUSEPORT 或 Unix 域 socket，无法启动多个工作进程", file=sys.stderr)
+        return 1
+    try:
+        asyncio.run(Supervisor(args).run())
+    except (RuntimeError, OSError) as e:
+        print(f"服务器退出: {str(e)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="无界面聊天服务器")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--files-dir', default='server_files', help="服务器文件目录")
+    parser.add_argument('--overflow-policy', choices=POLICIES, default=POLICY_DROP,
+                        help="客户端发送队列满时的处理策略")
+    parser.add_argument('--queue-limit', type=int, default=DEFAULT_MAX_BYTES,
+                        help="每个客户端发送队列的字节上限")
+    parser.add_argument('--compression', default=','.join(available()),
+                        help="允许的压缩算法，按优先顺序用逗号分隔，off 表示不压缩")
+    parser.add_argument('--log-file', default='server.log',
+                        help="滚动日志文件的路径，off 表示不写文件")
+    parser.add_argument('--admin-socket', default=ADMIN_SOCKET,
+                        help="管理命令的 Unix 域 socket 路径，off 表示不启用")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="工作进程数，大于 1 时多个进程共同监听同一个端口")
+    parser.add_argument('--broker-socket', default=BROKER_SOCKET,
+                        help="多进程部署时工作进程之间通信用的 Unix 域 socket 路径")
+    parser.add_argument('--node-name', help="联邦中本节点的名称，不指定时不启用联邦")
+    parser.add_argument('--federation-port', type=int,
+                        help="接受其他联邦节点连接的端口，不指定时只主动连接 --peer")
+    parser.add_argument('--peer', action='append', default=[], metavar='HOST:PORT',
+                        help="主动连接的联邦节点，可以指定多次")
+    parser.add_argument('--federation-secret', default=os.environ.get('CHAT_FEDERATION_SECRET', ''),
+                        help="联邦节点之间的共享密钥（启用联邦时必须指定）")
+    parser.add_argument('--quiet', action='store_true', help="不在标准输出打印日志")
+    args = parser.parse_args(argv)
+    # 传输连接令牌的签名密钥，由主进程生成，所有工作进程共用
+    args.transfer_secret = os.urandom(32)
+
+    if args.workers > 1:
+        if args.node_name:
+            parser.error("联邦暂不支持与 --workers 同时使用")
+        return run_cluster(args)
+    if (args.peer or args.federation_port is not None) and not args.node_name:
+        parser.error("--peer 和 --federation-port 需要同时指定 --node-name")
+    if args.node_name and not args.federation_secret:
+        parser.error("联邦需要共享密钥：请指定 --federation-secret 或环境变量 CHAT_FEDERATION_SECRET")
+    federation = None
+    if args.node_name:
+        try:
+            peers = [parse_peer(peer) for peer in args.peer]
+        except ValueError as e:
+            parser.error(f"非法的节点地址: {str(e)}")
+        federation = Federation(args.node_name, args.host, args.federation_port, peers,
+                                args.federation_secret)
+    run_core(make_core(args, cluster=federation))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1199 @@
+"""聊天服务器核心（asyncio 实现，不依赖 PyQt）
+
+每个客户端连接对应一个协程，所有数据都按 protocol.py 定义的帧收发：
+JSON 控制消息、表情帧、文件分块以及五子棋游戏消息。
+Qt 窗口（server_qt.py）可以作为可选的监控前端挂接到这里。
+"""
+import asyncio
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import socket
+import threading
+from datetime import datetime
+
+from protocol import (PROTOCOL_VERSION, FRAME_JSON, FRAME_EMOJI, FRAME_CHUNK,
+                      FrameProtocol, build_frame, build_json, decode_json, parse_chunk,
+                      build_chunk, chunk_header, compress_frame, RELAY_ID_BASE)
+from compression import Compressor, available, negotiate, compressible
+from routing import RoutingTable
+from binary_codec import EMOJI, ACTION_DATA, CodecError
+from file_catalog import FileCatalog, DirectoryWatcher
+from dedup import link_file
+from emoji_catalog import EmojiCatalog, valid_id
+from server_log import LogJournal
+from buffer_pool import default_pool
+from admin import AdminServer
+from upload_store import UploadSession, UploadError, safe_filename, cleanup_partials
+from outbound import (OutboundQueue, FileRegion, QueueOverflow, POLICY_DROP,
+                      DEFAULT_MAX_BYTES, write_vectored)
+
+try:
+    import resource
+except ImportError:  # Windows 没有 resource 模块
+    resource = None
+
+BROADCAST_TARGET = '所有人'
+KICK_MESSAGE = '您已被服务器强制下线'
+CLOSE_TIMEOUT = 10  # 关闭连接时等待发送完剩余数据的最长时间（秒）
+CATALOG_SAVE_DELAY = 5  # 文件目录变化后延迟写回哈希缓存的时间（秒）
+TRANSFER_STREAMS_MAX = 8  # 每个用户最多同时打开的传输连接数
+RELAY_WINDOW = 1024 * 1024  # 转发私发文件时接收方发送队列中最多积压的字节数
+
+
+def raise_fd_limit():
+    """尽量提高进程可打开的文件描述符上限，以支持上万个并发连接"""
+    if resource is None:
+        return None
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY:
+            target = 65536
+        else:
+            target = hard
+        if soft < target:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+        return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    except (ValueError, OSError):
+        return None
+
+
+class ClientConnection:
+    """一个客户端连接
+
+    发送的数据先进入有界的出站队列，由该连接自己的写协程写入 socket。
+    """
+
+    def __init__(self, reader, writer, queue):
+        self.reader = reader
+        self.writer = writer
+        self.queue = queue
+        self.address = writer.get_extra_info('peername')
+        self.username = None
+        self.closed = False
+        self.uploads = {}  # {传输编号: UploadSession}
+        self.relays = {}   # {传输编号: RelayStream}，该连接正在私发的文件
+        self.compressor = None  # 登录时协商的压缩算法
+        self.transfer_token = None  # 本次会话的传输连接令牌，随欢迎消息发给客户端
+        self.writer_task = asyncio.ensure_future(self.write_loop())
+
+    async def write_loop(self):
+        """写协程：不断取出队列中的数据写入 socket"""
+        try:
+            while True:
+                batch = await self.queue.get_batch()
+                if batch is None:
+                    break
+                if isinstance(batch, FileRegion):
+                    await self.send_region(batch)
+                    continue
+                write_vectored(self.writer.transport, batch)
+                await self.writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.queue.discard()
+            self.writer.close()
+
+    async def send_region(self, region):
+        """用 sendfile 发送文件中的一块，文件内容不经过 Python"""
+        transport = self.writer.transport
+        try:
+            if transport.is_closing():
+                raise ConnectionError("连接已关闭")
+            count = region.next_count()
+            loop = asyncio.get_running_loop()
+            if region.compressor is not None:
+                # 压缩的数据块在线程池中读取和压缩
+                frame = await loop.run_in_executor(None, region.read_frame, count)
+                write_vectored(transport, frame)
+                await self.writer.drain()
+                sent = count
+            else:
+                transport.write(chunk_header(region.transfer_id, count))
+                sent = await loop.sendfile(transport, region.file, region.offset, count)
+            if sent != count:
+                # 帧头已经声明了长度，数据不够时只能断开连接
+                raise ConnectionError("文件在发送过程中被截断")
+        except (Exception, asyncio.CancelledError):
+            region.close()
+            raise
+        region.advance(sent)
+        if region.remaining:
+            self.queue.requeue(region)
+        else:
+            region.close()
+            if region.trailer is not None:
+                write_vectored(transport, list(region.trailer))
+                await self.writer.drain()
+
+    def send(self, frame, droppable=False, bulk=False, variants=None):
+        """把已编码的帧放入出站队列，droppable 表示队列满时可以丢弃
+
+        frame 是 protocol.build_frame 返回的不可变缓冲区元组，可以被多个连接共享；
+        bulk 表示客户端主动请求的大块数据，不计入队列上限。
+        """
+        if self.closed:
+            raise ConnectionError("连接已关闭")
+        if self.compressor is not None:
+            frame = self.compress(frame, variants)
+        try:
+            self.queue.put(frame, droppable, bulk)
+        except QueueOverflow:
+            self.abort()
+            raise
+
+    def compress(self, frame, variants=None):
+        """按协商的算法压缩帧；variants 缓存同一帧的压缩结果，广播时每种算法只压缩一次"""
+        if variants is None:
+            return compress_frame(frame, self.compressor)
+        name = self.compressor.name
+        if name not in variants:
+            variants[name] = compress_frame(frame, self.compressor)
+        return variants[name]
+
+    def send_frame(self, frame_type, payload):
+        """发送一帧"""
+        self.send(build_frame(frame_type, payload))
+
+    def send_json(self, obj, droppable=False):
+        """发送一条 JSON 消息"""
+        self.send(build_json(obj), droppable)
+
+    def send_file(self, region):
+        """排队发送一段文件（FileRegion）"""
+        if self.closed:
+            region.close()
+            raise ConnectionError("连接已关闭")
+        if not region.remaining:
+            # 空文件没有数据块，直接发送结尾帧
+            region.close()
+            if region.trailer is not None:
+                self.send(region.trailer)
+            return
+        self.queue.put_region(region)
+
+    def close(self):
+        """发送完已排队的数据后关闭连接"""
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.close()
+        # 对方一直不读数据时，超时后强制关闭
+        asyncio.get_running_loop().call_later(CLOSE_TIMEOUT, self.abort)
+
+    def abort(self):
+        """丢弃未发送的数据并立即关闭连接"""
+        self.closed = True
+        self.queue.discard()
+        self.writer_task.cancel()
+        transport = self.writer.transport
+        if not transport.is_closing():
+            transport.abort()
+
+
+class RelayStream:
+    """一个正在转发的私发文件
+
+    发送方的数据块只换掉帧头中的传输编号就放进接收方的发送队列，数据本身不拷贝、不落盘；
+    接收方的队列积压超过 RELAY_WINDOW 时暂停处理发送方的数据，每个转发占用的内存是有界的。
+    """
+
+    def __init__(self, target, relay_id, filename, size):
+        self.target = target
+        self.relay_id = relay_id
+        self.filename = filename
+        self.size = size
+        self.received = 0
+
+
+class ChatServerCore:
+    """asyncio 聊天服务器核心"""
+
+    def __init__(self, host='localhost', port=5000, files_dir='server_files', backlog=1024,
+                 queue_limit=DEFAULT_MAX_BYTES, overflow_policy=POLICY_DROP, spill_dir=None,
+                 compression=None, emoji_dir='emojis', log_file=None, admin_socket=None,
+                 cluster=None, reuse_port=False, transfer_secret=None):
+        self.host = host
+        self.port = port
+        self.files_dir = files_dir
+        self.backlog = backlog
+
+        # 出站队列配置
+        self.queue_limit = queue_limit
+        self.overflow_policy = overflow_policy
+        self.spill_dir = spill_dir
+
+        # 允许的压缩算法（按优先顺序），默认为本机支持的全部算法，空列表表示不压缩
+        self.compression = available() if compression is None else list(compression)
+        self.compressors = {name: Compressor(name) for name in self.compression}
+
+        self.clients = RoutingTable()  # 用户名 <-> ClientConnection
+        self.transfers = {}  # {用户名: 该用户的传输连接集合}，用于并行下载
+        self.relay_ids = itertools.count(RELAY_ID_BASE)
+        self.catalog = FileCatalog(self.files_dir)
+        self.emojis = EmojiCatalog(emoji_dir)
+        self.watcher = DirectoryWatcher(self.files_dir, self.on_file_event)
+        self.catalog_save_handle = None
+        self.background_tasks = set()
+        self.listeners = {'log': [], 'users': [], 'files': []}
+
+        # 日志文件由后台线程写入，不占用事件循环
+        self.journal = LogJournal(log_file) if log_file else None
+        if self.journal is not None:
+            self.add_listener('log', self.journal.write)
+
+        # 本地管理 socket（见 admin.py），None 表示不启用
+        self.admin = AdminServer(self, admin_socket) if admin_socket else None
+
+        # 多进程部署（见 broker.py）或联邦（见 federation.py）时与其他服务器进程的接口，None 表示独立运行；
+        # reuse_port 让几个进程监听同一个端口，由内核分配新连接
+        self.cluster = cluster
+        self.reuse_port = reuse_port
+        # 签发传输连接令牌的密钥，多进程部署时所有工作进程共用，令牌在任何一个进程上都能校验
+        self.transfer_secret = transfer_secret or os.urandom(32)
+
+        self.loop = None
+        self.server = None
+        self.started_at = None
+        self.ready = threading.Event()
+
+        # 创建服务器文件存储目录
+        if not os.path.exists(self.files_dir):
+            os.makedirs(self.files_dir)
+
+    # ---------- 监听器 ----------
+
+    def add_listener(self, event, callback):
+        """注册事件回调，event 为 'log'、'users' 或 'files'"""
+        self.listeners[event].append(callback)
+
+    def emit(self, event, *args):
+        for callback in self.listeners[event]:
+            try:
+                callback(*args)
+            except Exception as e:
+                print(f"事件回调出错: {str(e)}")
+
+    def log_message(self, message):
+        """输出日志"""
+        self.emit('log', message)
+
+    # ---------- 启动与运行 ----------
+
+    async def serve(self):
+        """启动服务器并一直运行"""
+        await self.start()
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        finally:
+            if self.admin is not None:
+                self.admin.close()
+            if self.cluster is not None:
+                self.cluster.close()
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        raise_fd_limit()
+        if self.cluster is not None:
+            # 先取得全局的在线用户，再开始接受连接
+            await self.cluster.connect(self)
+        self.server = await self.loop.create_server(
+            lambda: FrameProtocol(self.handle_client), self.host, self.port, backlog=self.backlog,
+            reuse_port=self.reuse_port or None
+        )
+        self.scan_server_files()
+        self.load_emojis()
+        cleanup_partials(self.files_dir)
+        self.spawn(self.share_duplicates())
+        if self.watcher.start(self.loop):
+            self.log_message("已启用 inotify 监视服务器文件目录")
+        if self.admin is not None:
+            await self.start_admin()
+        self.started_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.log_message("服务器已启动...")
+        self.ready.set()
+
+    async def start_admin(self):
+        if not hasattr(socket, 'AF_UNIX'):
+            self.log_message("当前系统不支持 Unix 域 socket，未启用管理接口")
+            self.admin = None
+            return
+        try:
+            await self.admin.start()
+            self.log_message(f"管理接口: {self.admin.path}")
+        except OSError as e:
+            self.log_message(f"启动管理接口失败: {str(e)}")
+            self.admin = None
+
+    def run(self):
+        """在当前线程中运行事件循环"""
+        try:
+            asyncio.run(self.serve())
+        except asyncio.CancelledError:
+            pass
+
+    def stop(self):
+        """停止接受连接，serve() 随后退出（在事件循环中调用）"""
+        if self.server is not None:
+            self.server.close()
+
+    def start_in_thread(self):
+        """在后台线程中运行服务器，供 GUI 前端使用"""
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        self.ready.wait(5)
+        return thread
+
+    def call_threadsafe(self, func, *args):
+        """从其他线程（例如 GUI 线程）调度到事件循环中执行"""
+        if self.loop is None:
+            return
+        self.loop.call_soon_threadsafe(func, *args)
+
+    # ---------- 用户与文件 ----------
+
+    def find_client(self, username):
+        return self.clients.get(username)
+
+    def is_online(self, username):
+        """用户是否在线（多进程部署时包括其他进程上的用户）"""
+        if self.find_client(username) is not None:
+            return True
+        return self.cluster is not None and self.cluster.locate(username)
+
+    def presence(self):
+        """返回 (在线状态版本号, 在线用户名快照)，多进程部署时是所有进程的用户"""
+        if self.cluster is not None:
+            return self.cluster.presence()
+        return self.clients.presence()
+
+    def send_to(self, conn, obj, droppable=False):
+        """向单个客户端发送 JSON 消息，失败时移除该客户端"""
+        return self.send_encoded(conn, build_json(obj), droppable)
+
+    def send_frame_to(self, conn, frame_type, payload):
+        return self.send_encoded(conn, build_frame(frame_type, payload))
+
+    def send_encoded(self, conn, frame, droppable=False, bulk=False, variants=None):
+        """发送已编码的帧，失败时移除该客户端"""
+        try:
+            conn.send(frame, droppable, bulk, variants)
+            return True
+        except Exception as e:
+            self.drop_client(conn, e)
+            return False
+
+    def multicast(self, frame, exclude_client=None, droppable=False):
+        """把同一个已编码的帧发给本进程的所有在线客户端，只编码一次（每种压缩算法也只压缩一次）"""
+        variants = {}
+        for client in self.clients.snapshot():
+            if client is not exclude_client:
+                self.send_encoded(client, frame, droppable, variants=variants)
+
+    def broadcast_frame(self, frame, exclude_client=None, droppable=False):
+        """把已编码的帧发给所有用户，多进程部署时也转发给其他进程"""
+        self.multicast(frame, exclude_client, droppable)
+        if self.cluster is not None:
+            self.cluster.broadcast(frame, droppable)
+
+    def send_to_user(self, username, frame):
+        """把已编码的帧发给指定用户（可能连接在其他进程上），用户不在线时返回 False"""
+        target = self.find_client(username)
+        if target is not None:
+            return self.send_encoded(target, frame)
+        return self.cluster is not None and self.cluster.deliver(username, frame)
+
+    def drop_client(self, conn, error):
+        """发送失败时移除客户端
+
+        移除操作推迟到下一轮事件循环执行，避免在广播过程中递归地再次广播离开消息。
+        """
+        if conn.closed and conn not in self.clients:
+            return
+        if isinstance(error, QueueOverflow) and conn.username:
+            self.log_message(f"{conn.username} 的发送队列已满，断开连接")
+        conn.abort()
+        self.loop.call_soon(self.remove_client, conn)
+
+    def broadcast(self, message, exclude_client=None):
+        """发送服务器消息给所有客户端"""
+        data = {
+            'type': 'server_message',
+            'content': message
+        }
+        self.broadcast_frame(build_json(data), exclude_client)
+
+    def remove_client(self, conn):
+        username = self.clients.remove(conn)
+        if username is not None:
+            conn.close()
+            for stream in self.transfers.pop(username, ()):
+                stream.abort()
+            if self.cluster is not None:
+                # 由 cluster 通知后再推送在线状态（见 on_cluster_presence）
+                self.cluster.release(username)
+            else:
+                self.publish_presence('leave', username)
+            self.log_message(f"{username} 已断开连接")
+            self.broadcast(f"SERVER: {username} 已离开聊天室")
+        else:
+            conn.close()
+
+    def publish_presence(self, op, username, exclude_client=None):
+        """向客户端推送一条在线状态增量（op 为 'join' 或 'leave'）
+
+        增量在队列拥塞时可以丢弃，客户端发现版本号不连续后会请求完整列表。
+        """
+        version, users = self.presence()
+        self.emit('users', list(users))
+
+        data = {
+            'type': 'presence',
+            'op': op,
+            'user': username,
+            'version': version
+        }
+        self.multicast(build_json(data), exclude_client, droppable=True)
+
+    def users_snapshot(self):
+        """完整的在线用户列表及其版本号，用于客户端重新同步"""
+        version, users = self.presence()
+        return {
+            'type': 'users_list',
+            'users': list(users),
+            'version': version
+        }
+
+    def welcome_snapshot(self, compression=None):
+        """登录成功后发给新用户的快照：在线用户、服务器文件和服务器信息
+
+        compression 是为这个用户协商好的压缩算法。
+        """
+        version, users = self.presence()
+        return {
+            'type': 'welcome',
+            'users': list(users),
+            'presence_version': version,
+            'server': {
+                'protocol': PROTOCOL_VERSION,
+                'online': len(users),
+                'started': self.started_at,
+                'compression': compression,
+            },
+            'emojis': self.emojis.listing()
+        }
+
+    def build_welcome(self, conn):
+        """编码欢迎消息
+
+        文件目录可能很大，这里直接拼接目录缓存的 JSON 编码，而不是每次登录都重新序列化。
+        """
+        compression = conn.compressor.name if conn.compressor is not None else None
+        snapshot = self.welcome_snapshot(compression)
+        snapshot['transfer_token'] = conn.transfer_token
+        head = json.dumps(snapshot).encode()
+        payload = head[:-1] + b', "files": ' + self.catalog.encoded() + b'}'
+        return build_frame(FRAME_JSON, payload)
+
+    def on_cluster_presence(self, change, username):
+        """cluster 通知全局在线状态有变化（包括本进程自己的用户）"""
+        self.publish_presence(change, username)
+
+    def on_cluster_lost(self):
+        """与 broker 的连接断开后无法再保证用户名唯一，停止接受连接并退出"""
+        self.log_message("与 broker 的连接已断开，服务器停止运行")
+        self.stop()
+
+    def spawn(self, coro):
+        """启动后台任务并保留引用，避免任务被提前回收"""
+        task = asyncio.ensure_future(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+        return task
+
+    def scan_server_files(self):
+        """启动时扫描服务器文件目录"""
+        try:
+            count = self.catalog.load()
+            self.log_message(f"扫描到 {count} 个文件")
+            self.emit('files', self.catalog.names())
+        except Exception as e:
+            self.log_message(f"扫描文件目录失败: {str(e)}")
+
+    def load_emojis(self):
+        """启动时加载表情目录"""
+        try:
+            count = self.emojis.load()
+            self.log_message(f"加载了 {count} 个表情")
+        except Exception as e:
+            self.log_message(f"加载表情目录失败: {str(e)}")
+
+    def on_file_event(self, name):
+        """inotify 报告文件有变化"""
+        self.spawn(self.refresh_file(name))
+
+    async def refresh_file(self, name):
+        """重新读取单个文件的信息（哈希在线程池中计算），有变化时通知客户端"""
+        try:
+            entry = await self.loop.run_in_executor(None, self.catalog.stat_entry, name)
+            if entry is not None:
+                entry = await self.share_content(name, entry)
+        except OSError as e:
+            self.log_message(f"读取文件信息失败: {name}, {str(e)}")
+            return
+        self.publish_file_change(self.catalog.apply(name, entry))
+
+    async def share_content(self, name, entry):
+        """内容与已有文件相同时把 name 改为指向已有文件的硬链接，返回更新后的目录项"""
+        source = self.catalog.find_hash(entry['hash'], exclude=name)
+        if source is None:
+            return entry
+        try:
+            linked = await self.loop.run_in_executor(None, link_file, self.files_dir, source, name)
+        except OSError as e:
+            # 不支持硬链接或文件已被删除，保留原来的文件
+            self.log_message(f"建立硬链接失败: {name}, {str(e)}")
+            return entry
+        if not linked:
+            return entry
+        return await self.loop.run_in_executor(None, self.catalog.stat_entry, name, entry['hash'])
+
+    async def share_duplicates(self):
+        """启动时把目录中内容相同的文件改为硬链接"""
+        count = 0
+        for digest, names in self.catalog.duplicates():
+            for name in names[1:]:
+                entry = self.catalog.get(name)
+                if entry is None:
+                    continue
+                try:
+                    shared = await self.share_content(name, entry)
+                except OSError as e:
+                    self.log_message(f"读取文件信息失败: {name}, {str(e)}")
+                    continue
+                if shared is not entry:
+                    count += 1
+                    self.publish_file_change(self.catalog.apply(name, shared))
+        if count:
+            self.log_message(f"内容去重: {count} 个文件改为硬链接")
+
+    def publish_file_change(self, change):
+        """把一项文件目录变化推送给所有客户端"""
+        if change is None:
+            return
+        self.emit('files', self.catalog.names())
+
+        kind, item = change
+        data = {
+            'type': 'files_delta',
+            'added': [item] if kind == 'added' else [],
+            'removed': [item] if kind == 'removed' else []
+        }
+        self.multicast(build_json(data))
+
+        # 合并短时间内的多次变化，再写回哈希缓存
+        if self.catalog_save_handle is None:
+            self.catalog_save_handle = self.loop.call_later(CATALOG_SAVE_DELAY, self.save_catalog)
+
+    def save_catalog(self):
+        self.catalog_save_handle = None
+        self.catalog.save_cache()
+
+    # ---------- 管理操作 ----------
+
+    def kick_user(self, username):
+        """强制用户下线"""
+        conn = self.find_client(username)
+        if conn is None:
+            # 多进程部署时由用户所在的进程执行
+            if self.cluster is not None and self.cluster.kick(username):
+                self.log_message(f"已通知其他进程强制用户 {username} 下线")
+                return True
+            return False
+        try:
+            kick_msg = {
+                'type': 'server_message',
+                'content': KICK_MESSAGE
+            }
+            conn.send_json(kick_msg)
+            self.remove_client(conn)
+            self.log_message(f"已强制用户 {username} 下线")
+            return True
+        except Exception:
+            self.log_message(f"踢出用户 {username} 失败")
+            return False
+
+    def stats(self):
+        """服务器运行状态，供管理接口使用"""
+        clients = self.clients.snapshot()
+        return {
+            'started': self.started_at,
+            'online': len(clients),
+            'online_total': len(self.presence()[1]),
+            'transfer_connections': sum(len(streams) for streams in self.transfers.values()),
+            'uploads': sum(len(conn.uploads) for conn in clients),
+            'relays': sum(len(conn.relays) for conn in clients),
+            'queued_bytes': sum(conn.queue.pending() for conn in clients),
+            'files': len(self.catalog),
+            'emojis': len(self.emojis.data),
+            'compression': [compressor.stats() for compressor in self.compressors.values()],
+            'buffer_pool': default_pool.stats(),
+        }
+
+    def delete_file(self, filename):
+        """删除服务器文件"""
+        file_path = os.path.join(self.files_dir, filename)
+        try:
+            os.remove(file_path)
+            self.log_message(f"已删除文件: {filename}")
+            self.publish_file_change(self.catalog.remove(filename))
+            return True
+        except Exception as e:
+            self.log_message(f"删除文件失败: {str(e)}")
+            return False
+
+    # ---------- 连接处理 ----------
+
+    def make_queue(self):
+        return OutboundQueue(self.queue_limit, self.overflow_policy, self.spill_dir)
+
+    async def handle_client(self, frame_reader, writer):
+        """处理客户端连接（每个连接一个协程），frame_reader 是该连接的 FrameProtocol"""
+        conn = ClientConnection(frame_reader, writer, self.make_queue())
+        try:
+            # 第一帧必须是登录消息
+            frames = await frame_reader.read_batch()
+            if not frames or frames[0][0] != FRAME_JSON:
+                return
+            login = decode_json(frames[0][1])
+            if login.get('type') == 'transfer':
+                await self.serve_transfer(conn, login.get('username'), login.get('token'),
+                                          frames[1:], frame_reader)
+                return
+            username = login.get('username') if login.get('type') == 'login' else None
+            if not username:
+                return
+
+            # 保存客户端信息，多进程部署或联邦时先向 cluster 登记，保证用户名在所有进程中唯一
+            conn.username = username
+            claimed = self.cluster is None or await self.cluster.claim(username)
+            if not claimed or not self.clients.add(username, conn):
+                if claimed and self.cluster is not None:
+                    self.cluster.release(username)
+                conn.send_json({
+                    'type': 'server_message',
+                    'content': f'用户名 {username} 已被占用'
+                })
+                self.log_message(f"用户名 {username} 已被占用，拒绝连接")
+                return
+            conn.transfer_token = self.issue_transfer_token(username)
+            self.log_message(f"{username} 已连接")
+
+            # 协商压缩算法，欢迎消息本身就可以压缩（客户端解压不依赖协商结果）
+            name = negotiate(login.get('compression'), self.compression)
+            if name is not None:
+                conn.compressor = self.compressors[name]
+
+            # 用一帧欢迎消息发送在线用户、文件列表和服务器信息
+            if not self.send_encoded(conn, self.build_welcome(conn), bulk=True):
+                return
+
+            # 广播新用户加入
+            self.broadcast(f"SERVER: {username} 加入了聊天室")
+
+            # 通知其他客户端有用户加入（多进程部署或联邦时由 cluster 通知，见 on_cluster_presence）
+            if self.cluster is None:
+                self.publish_presence('join', username, exclude_client=conn)
+
+            frames = frames[1:]
+            while conn in self.clients:
+                try:
+                    for frame_type, payload in frames:
+                        await self.handle_frame(conn, frame_type, payload)
+                    frames = await frame_reader.read_batch()
+                    if not frames:
+                        break
+                except ConnectionError:
+                    break
+                except Exception as e:
+                    self.log_message(f"处理客户端消息时出错: {str(e)}")
+                    break
+
+        except Exception as e:
+            self.log_message(f"处理客户端连接时出错: {str(e)}")
+
+        finally:
+            for session in conn.uploads.values():
+                session.suspend()
+            conn.uploads.clear()
+            self.remove_client(conn)
+            for transfer_id in list(conn.relays):
+                self.fail_relay(conn, transfer_id, "发送方已断开连接")
+
+    def sign_transfer(self, username, nonce):
+        message = f"{username}|{nonce}".encode()
+        return hmac.new(self.transfer_secret, message, hashlib.sha256).hexdigest()
+
+    def issue_transfer_token(self, username):
+        """为一次登录会话签发传输连接令牌：随机数.HMAC(用户名|随机数)"""
+        nonce = os.urandom(16).hex()
+        return f"{nonce}.{self.sign_transfer(username, nonce)}"
+
+    def check_transfer_token(self, username, token):
+        """传输连接是否出示了该用户当前会话的令牌"""
+        if not isinstance(username, str) or not isinstance(token, str):
+            return False
+        conn = self.find_client(username)
+        if conn is not None:
+            return conn.transfer_token is not None and hmac.compare_digest(token, conn.transfer_token)
+        # 用户连接在其他工作进程上，用共同的密钥校验签名
+        nonce, _, mac = token.partition('.')
+        return (self.cluster is not None and self.cluster.locate(username)
+                and hmac.compare_digest(mac, self.sign_transfer(username, nonce)))
+
+    async def serve_transfer(self, conn, owner, token, frames, frame_reader):
+        """辅助传输连接：已登录的用户额外打开的连接，只用于下载文件（分段并行下载）
+
+        连接时必须出示欢迎消息中的 transfer_token，否则任何人都能占满别人的传输连接名额。
+        传输连接不加入路由表，不参与聊天和在线状态；用户断开时一并关闭。
+        """
+        if not self.check_transfer_token(owner, token):
+            self.log_message(f"拒绝了用户 {owner} 的传输连接: 令牌无效")
+            return
+        streams = self.transfers.get(owner, ())
+        if len(streams) >= TRANSFER_STREAMS_MAX:
+            return
+        conn.username = owner
+        self.transfers.setdefault(owner, set()).add(conn)
+        try:
+            while True:
+                for frame_type, payload in frames:
+                    if frame_type != FRAME_JSON:
+                        continue
+                    data = decode_json(payload)
+                    if data.get('type') == 'download':
+                        self.handle_download(conn, data)
+                frames = await frame_reader.read_batch()
+                if not frames:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            streams = self.transfers.get(owner)
+            if streams is not None:
+                streams.discard(conn)
+                if not streams:
+                    del self.transfers[owner]
+
+    async def handle_frame(self, conn, frame_type, payload):
+        """按帧类型分发"""
+        if frame_type == FRAME_EMOJI:  # 表情消息
+            try:
+                self.handle_emoji(conn, EMOJI.decode(payload), payload)
+            except CodecError as e:
+                self.log_message(f"{conn.username} 发送的帧格式错误: {str(e)}")
+        elif frame_type == FRAME_CHUNK:  # 分块上传或私发的数据
+            transfer_id, data = parse_chunk(payload)
+            if transfer_id in conn.relays:
+                await self.relay_chunk(conn, transfer_id, data)
+            else:
+                self.handle_upload_chunk(conn, transfer_id, data)
+        elif frame_type == FRAME_JSON:  # 普通消息
+            try:
+                data = decode_json(payload)
+            except ValueError:
+                self.log_message(f"JSON解析错误: {bytes(payload[:200])!r}")
+                return
+            if not isinstance(data, dict):
+                self.reject_message(conn, None, "消息不是 JSON 对象")
+                return
+            try:
+                self.handle_json(conn, data)
+            except (KeyError, TypeError, ValueError) as e:
+                # 帧本身完整，只是缺少字段或字段类型不对：丢弃这条消息，不断开连接
+                self.reject_message(conn, data.get('type'), repr(e))
+        else:
+            self.log_message(f"未知的帧类型: {frame_type}")
+
+    def handle_emoji(self, conn, emoji, payload):
+        """转发完整的表情帧：先加入表情目录，之后按编号转发，接收方各自按需取一次图片"""
+        to = emoji.to or BROADCAST_TARGET
+        known = len(self.emojis.data)
+        key = self.emojis.add(emoji.data)
+        if key is not None:
+            if self.cluster is not None and len(self.emojis.data) > known:
+                # 新表情同步给其他进程，接收方可能从其他进程请求图片
+                self.cluster.share_emoji(emoji.data)
+            self.route_emoji(conn, key, to)
+            return
+
+        # 无法加入目录的表情按原样转发
+        if to == BROADCAST_TARGET:
+            # 广播表情，原样转发收到的内容
+            self.broadcast_frame(build_frame(FRAME_EMOJI, payload), conn)
+        else:
+            # 私发表情，附上发送者，图片数据不做拷贝
+            self.send_to_user(to, EMOJI.encode(emoji.data, to=to, sender=conn.username))
+
+    def route_emoji(self, conn, key, to):
+        """按编号转发表情"""
+        data = {
+            'type': 'emoji',
+            'id': key,
+            'from': conn.username,
+            'to': to
+        }
+        if to == BROADCAST_TARGET:
+            self.broadcast_frame(build_json(data), conn)
+        else:
+            self.send_to_user(to, build_json(data))
+
+    def handle_emoji_id(self, conn, data):
+        """处理只带编号的表情消息"""
+        key = data.get('id')
+        if self.emojis.get(key) is None:
+            # 服务器不认识这个编号（例如重启后丢失了客户端加入的表情），让客户端重新发送完整的表情帧
+            self.send_to(conn, {'type': 'emoji_missing', 'id': key})
+            return
+        self.route_emoji(conn, key, data.get('to') or BROADCAST_TARGET)
+
+    def handle_emoji_get(self, conn, data):
+        """客户端请求表情图片"""
+        key = data.get('id')
+        content = self.emojis.get(key) if valid_id(key) else None
+        if content is None:
+            self.send_to(conn, {'type': 'emoji_missing', 'id': key})
+            return
+        self.send_encoded(conn, EMOJI.encode(content, action=ACTION_DATA))
+
+    # ---------- 零拷贝下载 ----------
+
+    def handle_download(self, conn, data):
+        """先发送 download_begin，再用 sendfile 分块发送文件内容，最后发送 download_end
+
+        offset 和 length 指定下载的字节范围（默认整个文件），客户端据此断点续传或分段并行下载。
+        """
+        transfer_id = data['transfer_id']
+        try:
+            filename = safe_filename(data['filename'])
+            f = open(os.path.join(self.files_dir, filename), 'rb')
+        except FileNotFoundError:
+            self.send_to(conn, {'type': 'download_error', 'transfer_id': transfer_id,
+                                'error': f"文件不存在: {data['filename']}"})
+            return
+        except (UploadError, OSError) as e:
+            self.send_to(conn, {'type': 'download_error', 'transfer_id': transfer_id, 'error': str(e)})
+            return
+        size = os.fstat(f.fileno()).st_size
+        offset = data.get('offset', 0)
+        length = data.get('length')
+        if length is None:
+            length = size - offset
+        if not (isinstance(offset, int) and isinstance(length, int)
+                and 0 <= offset and 0 <= length and offset + length <= size):
+            f.close()
+            self.send_to(conn, {'type': 'download_error', 'transfer_id': transfer_id,
+                                'error': f"下载范围超出文件大小: {offset}+{length} > {size}"})
+            return
+        begin = {
+            'type': 'download_begin',
+            'transfer_id': transfer_id,
+            'filename': filename,
+            'size': size,
+            'offset': offset,
+            'length': length
+        }
+        entry = self.catalog.get(filename)
+        if entry is not None and entry['size'] == size:
+            begin['hash'] = entry['hash']
+        end = build_json({
+            'type': 'download_end',
+            'transfer_id': transfer_id,
+            'size': size,
+            'offset': offset,
+            'length': length
+        })
+        region = FileRegion(f, transfer_id, offset, length, trailer=end)
+        if conn.compressor is not None and compressible(f.read(16), filename):
+            region.compressor = conn.compressor
+        if not self.send_to(conn, begin):
+            region.close()
+            return
+        try:
+            conn.send_file(region)
+        except Exception as e:
+            self.drop_client(conn, e)
+            return
+        if offset or length != size:
+            self.log_message(f"{conn.username} 下载了文件: {filename} [{offset}, {offset + length})")
+        else:
+            self.log_message(f"{conn.username} 下载了文件: {filename}")
+
+    # ---------- 流式上传 ----------
+
+    def handle_upload_begin(self, conn, data):
+        """开始上传，回复 upload_ready 告诉客户端从哪个位置开始发送（续传时不为 0）"""
+        transfer_id = data['transfer_id']
+        old = conn.uploads.pop(transfer_id, None)
+        if old is not None:
+            old.suspend()
+        digest = data.get('hash')
+        source = self.catalog.find_hash(digest) if digest else None
+        if source is not None and self.catalog.get(source)['size'] == data['size']:
+            self.spawn(self.deduplicate_upload(conn, transfer_id, data['filename'], source, digest))
+            return
+        try:
+            session = UploadSession(self.files_dir, data['filename'], data['size'], data.get('hash'))
+        except (UploadError, OSError, ValueError) as e:
+            self.send_to(conn, {'type': 'upload_error', 'transfer_id': transfer_id, 'error': str(e)})
+            return
+        conn.uploads[transfer_id] = session
+        if session.offset:
+            self.log_message(f"{conn.username} 从 {session.offset} 字节处继续上传: {session.filename}")
+        self.send_to(conn, {'type': 'upload_ready', 'transfer_id': transfer_id, 'offset': session.offset})
+
+    async def deduplicate_upload(self, conn, transfer_id, filename, source, digest):
+        """服务器上已有相同内容的文件：直接建立硬链接，客户端不必发送数据"""
+        try:
+            filename = safe_filename(filename)
+            await self.loop.run_in_executor(None, link_file, self.files_dir, source, filename, True)
+            entry = await self.loop.run_in_executor(None, self.catalog.stat_entry, filename, digest)
+        except (UploadError, OSError) as e:
+            self.fail_upload(conn, transfer_id, e)
+            return
+        self.log_message(f"{conn.username} 上传了文件: {filename}（与 {source} 内容相同，未传输数据）")
+        self.send_to(conn, {'type': 'upload_done', 'transfer_id': transfer_id, 'filename': filename,
+                            'deduplicated': True})
+        self.publish_file_change(self.catalog.apply(filename, entry))
+
+    def handle_upload_chunk(self, conn, transfer_id, data):
+        session = conn.uploads.get(transfer_id)
+        if session is None:
+            return
+        try:
+            session.write(data)
+        except (UploadError, OSError) as e:
+            self.fail_upload(conn, transfer_id, e)
+
+    def handle_upload_end(self, conn, data):
+        transfer_id = data['transfer_id']
+        session = conn.uploads.pop(transfer_id, None)
+        if session is None:
+            return
+        self.spawn(self.finish_upload(conn, transfer_id, session))
+
+    async def finish_upload(self, conn, transfer_id, session):
+        """在线程池中校验并保存上传的文件"""
+        try:
+            filename = await self.loop.run_in_executor(None, session.finish)
+        except (UploadError, OSError) as e:
+            self.fail_upload(conn, transfer_id, e, session)
+            return
+        self.log_message(f"{conn.username} 上传了文件: {filename} ({session.size} 字节)")
+        self.send_to(conn, {'type': 'upload_done', 'transfer_id': transfer_id, 'filename': filename})
+        if session.expected_hash is not None:
+            # 哈希已经校验过，只需要 stat 一次
+            entry = self.catalog.stat_entry(filename, session.expected_hash)
+            if entry is not None:
+                entry = await self.share_content(filename, entry)
+            self.publish_file_change(self.catalog.apply(filename, entry))
+        else:
+            self.spawn(self.refresh_file(filename))
+
+    def fail_upload(self, conn, transfer_id, error, session=None):
+        if session is None:
+            session = conn.uploads.pop(transfer_id, None)
+        if session is not None:
+            session.abort()
+        self.log_message(f"{conn.username} 上传文件失败: {str(error)}")
+        self.send_to(conn, {'type': 'upload_error', 'transfer_id': transfer_id, 'error': str(error)})
+
+    # ---------- 私发文件的流式转发 ----------
+
+    def handle_relay_begin(self, conn, data):
+        """开始私发文件：先通知接收方，再回复 relay_ready 让发送方开始发送数据块"""
+        transfer_id = data['transfer_id']
+        to = data.get('to')
+        target = self.find_client(to)
+        try:
+            filename = safe_filename(data['filename'])
+            size = data['size']
+            if not isinstance(size, int) or size < 0:
+                raise UploadError(f"非法的文件大小: {size}")
+            if target is None and self.is_online(to):
+                raise UploadError(f"用户 {to} 连接在其他服务器进程上，请改为上传到服务器")
+            if target is None or target is conn:
+                raise UploadError(f"用户 {to} 不在线")
+        except UploadError as e:
+            self.send_to(conn, {'type': 'relay_error', 'transfer_id': transfer_id, 'error': str(e)})
+            return
+        relay = RelayStream(target, next(self.relay_ids), filename, size)
+        if not self.send_to(target, {'type': 'relay_begin', 'transfer_id': relay.relay_id,
+                                     'from': conn.username, 'filename': filename, 'size': size}):
+            self.send_to(conn, {'type': 'relay_error', 'transfer_id': transfer_id,
+                                'error': f"用户 {to} 已断开连接"})
+            return
+        conn.relays[transfer_id] = relay
+        self.send_to(conn, {'type': 'relay_ready', 'transfer_id': transfer_id, 'offset': 0})
+
+    async def relay_chunk(self, conn, transfer_id, data):
+        """把一个数据块转发给接收方，接收方积压太多时等待它发送出去"""
+        relay = conn.relays[transfer_id]
+        relay.received += len(data)
+        if relay.received > relay.size:
+            self.fail_relay(conn, transfer_id, "收到的数据超过了文件大小")
+            return
+        if not self.send_encoded(relay.target, build_chunk(relay.relay_id, data), bulk=True):
+            self.fail_relay(conn, transfer_id, f"用户 {relay.target.username} 已断开连接")
+            return
+        await relay.target.queue.wait_below(RELAY_WINDOW)
+
+    def handle_relay_end(self, conn, data):
+        transfer_id = data['transfer_id']
+        relay = conn.relays.get(transfer_id)
+        if relay is None:
+            return
+        if relay.received != relay.size:
+            self.fail_relay(conn, transfer_id, f"文件不完整: 收到 {relay.received} / {relay.size} 字节")
+            return
+        to = relay.target.username
+        if not self.send_to(relay.target, {'type': 'relay_end', 'transfer_id': relay.relay_id,
+                                           'size': relay.size}):
+            # 接收方已断开或发送队列溢出，文件没有送达
+            self.fail_relay(conn, transfer_id, f"用户 {to} 已断开连接")
+            return
+        del conn.relays[transfer_id]
+        self.send_to(conn, {'type': 'relay_done', 'transfer_id': transfer_id,
+                            'filename': relay.filename, 'to': to})
+        self.log_message(f"{conn.username} 向 {to} 发送了文件: {relay.filename} ({relay.size} 字节)")
+
+    def fail_relay(self, conn, transfer_id, error):
+        """取消转发，通知双方"""
+        relay = conn.relays.pop(transfer_id, None)
+        if relay is None:
+            return
+        self.log_message(f"{conn.username} 私发文件失败: {error}")
+        if not conn.closed:
+            self.send_to(conn, {'type': 'relay_error', 'transfer_id': transfer_id, 'error': error})
+        if not relay.target.closed:
+            self.send_to(relay.target, {'type': 'relay_error', 'transfer_id': relay.relay_id, 'error': error})
+
+    def reject_message(self, conn, msg_type, reason):
+        """记录并告知客户端它发送的消息格式错误"""
+        self.log_message(f"{conn.username} 发送的 {msg_type} 消息格式错误: {reason}")
+        self.send_to(conn, {'type': 'server_message', 'content': f'消息格式错误: {msg_type}'})
+
+    def handle_json(self, conn, data):
+        """处理普通 JSON 消息"""
+        username = conn.username
+        msg_type = data.get('type')
+
+        if msg_type == 'message':
+            to = data.get('to', BROADCAST_TARGET)
+            content = data['content']
+
+            if to == BROADCAST_TARGET:
+                # 广播消息
+                broadcast_data = {
+                    'type': 'message',
+                    'from': username,
+                    'content': content
+                }
+                self.broadcast_frame(build_json(broadcast_data), conn)
+            else:
+                # 私聊消息
+                private_data = {
+                    'type': 'private_message',
+                    'from': username,
+                    'content': content
+                }
+                self.send_to_user(to, build_json(private_data))
+
+        elif msg_type == 'upload_begin':
+            self.handle_upload_begin(conn, data)
+
+        elif msg_type == 'upload_end':
+            self.handle_upload_end(conn, data)
+
+        elif msg_type == 'relay_begin':
+            self.handle_relay_begin(conn, data)
+
+        elif msg_type == 'relay_end':
+            self.handle_relay_end(conn, data)
+
+        elif msg_type == 'download':
+            self.handle_download(conn, data)
+
+        elif msg_type == 'emoji':
+            self.handle_emoji_id(conn, data)
+
+        elif msg_type == 'emoji_get':
+            self.handle_emoji_get(conn, data)
+
+        elif msg_type == 'presence_sync':
+            # 客户端发现在线状态版本不连续，发送完整列表
+            self.send_to(conn, self.users_snapshot())
+
+        elif msg_type == 'game_invite':
+            # 转发邀请给目标用户
+            to = data['to']
+            invite_data = {
+                'type': 'game_invite',
+                'from': username,
+                'to': to
+            }
+            if self.send_to_user(to, build_json(invite_data)):
+                self.log_message(f"{username} 向 {to} 发送了游戏邀请")
+
+        elif msg_type == 'game_invite_response':
+            # 转发响应给发起邀请的用户
+            to = data['to']
+            response_data = {
+                'type': 'game_invite_response',
+                'from': username,
+                'to': to,
+                'accepted': data['accepted']
+            }
+            if self.send_to_user(to, build_json(response_data)):
+                self.log_message(
+                    f"{username} {'接受' if data['accepted'] else '拒绝'}了 {to} 的游戏邀请"
+                )
+
+        elif msg_type == 'game_move':
+            # 转发游戏数据给对手
+            to = data['to']
+            move_data = data.copy()
+            move_data['from'] = username
+            if self.send_to_user(to, build_json(move_data)):
+                self.log_game_move(username, to, data)
+
+    def log_game_move(self, username, to, data):
+        action = data.get('action', '')
+        if action == 'move':
+            self.log_message(f"游戏移动: {username} -> {to}")
+        elif action == 'win':
+            self.log_message(f"游戏结束: {username} 获胜")
+        elif action == 'surrender':
+            self.log_message(f"游戏结束: {username} 认输")
+        elif action == 'draw_request':
+            self.log_message(f"{username} 向 {to} 请求和棋")
+        elif action == 'draw_response':
+            self.log_message(
+                f"{username} {'接受' if data['accepted'] else '拒绝'}了 {to} 的和棋请求"
+            )
+
+
+def print_log(message):
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    print(f"[{timestamp}] {message}")
+
+
+if __name__ == "__main__":
+    # 无界面的入口在 server.py 中
+    from server import main
+    main()
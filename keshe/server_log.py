@@ -0,0 +1,135 @@
+"""服务器日志
+
+log_message 可能在处理每个请求时调用（例如每一步五子棋都有日志），所以日志的输出不能拖慢事件循环：
+
+- LogJournal 把日志放进有界队列，由后台线程成批写入文件，文件超过 max_bytes 时滚动，
+  保留 backups 个旧文件（server.log.1 最新）。队列满时丢弃新日志并计数，不阻塞调用方；
+- LogBuffer 给界面用：只保留最近的 max_lines 条待显示日志，界面按固定间隔一次取走一批。
+
+两者都不依赖 Qt，可以在任意线程中调用。
+"""
+import collections
+import os
+import queue
+import threading
+import time
+from datetime import datetime
+
+MAX_BYTES = 10 * 1024 * 1024  # 单个日志文件的大小上限
+BACKUPS = 5                   # 保留的旧日志文件数
+MAX_PENDING = 100000          # 等待写入文件的最多条数
+BATCH_LINES = 1000            # 后台线程每次最多合并写入的条数
+PANEL_LINES = 2000            # 日志面板最多显示的条数
+
+
+def format_line(timestamp, message):
+    return f"[{datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')}] {message}"
+
+
+class LogJournal:
+    """后台线程写入的滚动日志文件"""
+
+    def __init__(self, path, max_bytes=MAX_BYTES, backups=BACKUPS, max_pending=MAX_PENDING):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.queue = queue.Queue(max_pending)
+        self.dropped = 0
+        self.file = None
+        self.size = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, message):
+        """记录一条日志（不阻塞）"""
+        try:
+            self.queue.put_nowait((time.time(), message))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self, timeout=5):
+        """写完队列中剩余的日志后停止后台线程"""
+        self.queue.put((None, None))
+        self.thread.join(timeout)
+
+    def run(self):
+        while True:
+            items = [self.queue.get()]
+            # 一次取出已经排队的日志（至多 BATCH_LINES 条），合并成一次写入
+            while len(items) < BATCH_LINES:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = False
+            lines = []
+            for timestamp, message in items:
+                if timestamp is None:
+                    stop = True
+                else:
+                    lines.append(format_line(timestamp, message) + '\n')
+            if self.dropped:
+                dropped, self.dropped = self.dropped, 0
+                lines.append(format_line(time.time(), f"日志队列已满，丢弃了 {dropped} 条日志") + '\n')
+            try:
+                self._write(''.join(lines).encode('utf-8'))
+            except Exception as e:
+                print(f"写入日志文件失败: {str(e)}")
+            if stop:
+                if self.file is not None:
+                    self.file.close()
+                    self.file = None
+                return
+
+    def _write(self, data):
+        if not data:
+            return
+        if self.file is None:
+            self.file = open(self.path, 'ab')
+            self.size = self.file.tell()
+        if self.size and self.size + len(data) > self.max_bytes:
+            self._rotate()
+        self.file.write(data)
+        self.file.flush()
+        self.size += len(data)
+
+    def _rotate(self):
+        """server.log -> server.log.1 -> server.log.2 ...，最旧的删除"""
+        self.file.close()
+        for index in range(self.backups - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        if self.backups > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.file = open(self.path, 'ab')
+        self.size = 0
+
+
+class LogBuffer:
+    """等待界面显示的日志，只保留最近的 max_lines 条"""
+
+    def __init__(self, max_lines=PANEL_LINES):
+        self.lock = threading.Lock()
+        self.lines = collections.deque(maxlen=max_lines)
+        self.dropped = 0
+
+    def append(self, message):
+        line = format_line(time.time(), message)
+        with self.lock:
+            if len(self.lines) == self.lines.maxlen:
+                self.dropped += 1
+            self.lines.append(line)
+
+    def take(self):
+        """取出全部待显示的日志，返回 (日志行列表, 因为太多而没有显示的条数)"""
+        with self.lock:
+            lines = list(self.lines)
+            self.lines.clear()
+            dropped, self.dropped = self.dropped, 0
+        return lines, dropped
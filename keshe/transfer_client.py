@@ -0,0 +1,457 @@
+"""客户端文件传输（client_qt.py 和 client.py 共用）
+
+上传时按 CHUNK_SIZE 从磁盘读取文件并逐块发送，内存占用与文件大小无关。
+上传请求带有文件哈希，服务器保留未完成的临时文件，连接断开后重新上传同一文件时
+服务器在 upload_ready 中告诉客户端从哪个位置继续。
+
+下载时服务器先发送 download_begin，然后发送 FRAME_CHUNK 数据块，最后发送 download_end；
+数据块由网络线程直接写入 <保存路径>.part，完成后再重命名为保存路径。
+连接断开后 .part 文件会保留，再次下载到同一位置时从 .part 的末尾继续。
+
+私发文件也按数据块发送（relay_begin / relay_ready / 数据块 / relay_end），服务器边收边转发给接收方；
+接收方收到的 relay_begin、数据块和 relay_end 与下载的处理方式相同。
+
+大文件可以用 ParallelDownload 分段并行下载：额外打开几个传输连接，
+各自请求一段字节范围，用 os.pwrite 写入预先分配好大小的文件，最后校验整个文件的哈希。
+"""
+import hashlib
+import itertools
+import os
+import socket
+import threading
+
+from compression import compressible
+from file_catalog import file_hash, HASH_CHUNK_SIZE
+from protocol import (CHUNK_SIZE, FRAME_JSON, FRAME_CHUNK, HEADER, HEADER_SIZE, TRANSFER_ID,
+                      decode_json, parse_chunk, send_json)
+
+UPLOAD_READY_TIMEOUT = 30  # 等待服务器回复 upload_ready 的秒数
+
+PARALLEL_STREAMS = 4                    # 并行下载的连接数
+PARALLEL_MIN_SIZE = 64 * 1024 * 1024    # 小于这个大小的文件用聊天连接直接下载
+PARALLEL_SUFFIX = '.pdownload'
+PARALLEL_TIMEOUT = 60                   # 传输连接上多久收不到数据视为失败（秒）
+RECV_BUFFER_SIZE = 1024 * 1024
+
+_transfer_ids = itertools.count(1)
+
+
+def next_transfer_id():
+    """分配一个本连接内唯一的传输编号"""
+    return next(_transfer_ids)
+
+
+class UploadManager:
+    """客户端正在进行的上传和私发
+
+    upload / relay 在后台线程中调用，ready / finished / fail 在处理服务器消息的线程中调用。
+    服务器已有相同内容的文件时会直接回复 upload_done，这时不发送任何数据。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = {}  # {传输编号: {'event', 'offset', 'error', 'done'}}
+
+    def upload(self, sender, path, filename=None, progress=None):
+        """把本地文件分块上传到服务器，返回 (传输编号, 续传起点)
+
+        sender 是 protocol.FrameWriter；服务器保存完成后会回复 upload_done 或 upload_error。
+        progress(offset) 在收到 upload_ready 后调用一次；服务器去重时不调用，续传起点为文件大小。
+        """
+        return self._send(sender, path, {
+            'type': 'upload_begin',
+            'filename': filename or os.path.basename(path),
+            'size': os.path.getsize(path),
+            'hash': file_hash(path)
+        }, 'upload_end', progress)
+
+    def relay(self, sender, path, to):
+        """把本地文件私发给用户 to，服务器边收边转发，返回传输编号
+
+        服务器回复 relay_ready 后开始发送，全部转发后回复 relay_done，失败时回复 relay_error。
+        """
+        transfer_id, _ = self._send(sender, path, {
+            'type': 'relay_begin',
+            'to': to,
+            'filename': os.path.basename(path),
+            'size': os.path.getsize(path)
+        }, 'relay_end')
+        return transfer_id
+
+    def _send(self, sender, path, begin, end_type, progress=None):
+        """发送 begin 消息，等服务器回复后从它给出的位置开始逐块发送文件"""
+        transfer_id = next_transfer_id()
+        begin['transfer_id'] = transfer_id
+        state = {'event': threading.Event(), 'offset': None, 'error': None, 'done': False}
+        with self.lock:
+            self.active[transfer_id] = state
+        try:
+            sender.send_json(begin)
+            if not state['event'].wait(UPLOAD_READY_TIMEOUT):
+                raise IOError("等待服务器响应超时")
+            if state['error'] is not None:
+                raise IOError(state['error'])
+            if state['done']:
+                return transfer_id, begin['size']
+
+            offset = state['offset']
+            if progress is not None:
+                progress(offset)
+            with open(path, 'rb') as f:
+                # 是否值得压缩只按文件名和文件头判断一次，图片、压缩包等不再逐块尝试
+                compress = compressible(f.read(16), path)
+                f.seek(offset)
+                while True:
+                    if state['error'] is not None:
+                        # 服务器中途取消（例如私发的接收方下线）
+                        raise IOError(state['error'])
+                    data = f.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    sender.send_chunk(transfer_id, data, compress)
+            sender.send_json({'type': end_type, 'transfer_id': transfer_id})
+            return transfer_id, offset
+        finally:
+            with self.lock:
+                self.active.pop(transfer_id, None)
+
+    def ready(self, data):
+        """处理 upload_ready / relay_ready"""
+        state = self.active.get(data['transfer_id'])
+        if state is not None:
+            state['offset'] = data['offset']
+            state['event'].set()
+
+    def finished(self, data):
+        """处理 upload_done，服务器去重后直接完成时通知上传线程不必再发送数据"""
+        state = self.active.get(data['transfer_id'])
+        if state is not None:
+            state['done'] = True
+            state['event'].set()
+
+    def fail(self, data):
+        """处理 upload_error / relay_error，发送线程还在运行时返回 True（错误由发送线程报告）"""
+        state = self.active.get(data['transfer_id'])
+        if state is None:
+            return False
+        state['error'] = data['error']
+        state['event'].set()
+        return True
+
+
+class Download:
+    """一个正在进行的下载（或正在接收的私发文件，这时 resumable 为 False，从头接收）"""
+
+    def __init__(self, filename, save_path, resumable=True):
+        self.filename = filename
+        self.save_path = save_path
+        self.part_path = save_path + '.part'
+        self.resumable = resumable
+        self.offset = 0
+        if resumable:
+            try:
+                self.offset = os.path.getsize(self.part_path)
+            except OSError:
+                pass
+        self.size = None
+        self.expected_hash = None
+        self.received = self.offset
+        self.error = None
+        self.file = None
+        self.digest = None
+
+    def _open(self):
+        self.file = open(self.part_path, 'r+b' if self.offset else 'wb')
+        self.file.truncate(self.offset)
+        # 续传时先计算已有部分的哈希，之后随写入增量更新
+        self.digest = hashlib.sha256()
+        remaining = self.offset
+        while remaining:
+            chunk = self.file.read(min(HASH_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            self.digest.update(chunk)
+            remaining -= len(chunk)
+        self.file.seek(self.offset)
+
+    def write(self, data):
+        if self.error is not None:
+            return
+        try:
+            if self.file is None:
+                self._open()
+            self.file.write(data)
+            self.digest.update(data)
+            self.received += len(data)
+        except OSError as e:
+            self.error = e
+
+    def close(self):
+        if self.file is not None:
+            try:
+                self.file.close()
+            except OSError as e:
+                self.error = self.error or e
+            self.file = None
+
+    def finish(self, size):
+        """校验大小和哈希，并把 .part 文件重命名为保存路径"""
+        if self.file is None and self.error is None:
+            # 没有收到数据块（空文件，或 .part 已经完整）
+            self.write(b'')
+        self.close()
+        if self.error is not None:
+            raise self.error
+        if self.received != size:
+            raise IOError(f"文件不完整: 收到 {self.received} / {size} 字节")
+        if self.expected_hash is not None and self.digest.hexdigest() != self.expected_hash:
+            raise IOError("文件校验失败，请重新下载")
+        os.replace(self.part_path, self.save_path)
+        return self.save_path
+
+    def abort(self):
+        """放弃下载并删除 .part 文件"""
+        self.close()
+        try:
+            os.remove(self.part_path)
+        except OSError:
+            pass
+
+
+class DownloadManager:
+    """客户端所有正在进行的下载 {传输编号: Download}
+
+    write_chunk 和 receive 在网络线程中调用，其余方法在界面线程中调用。
+    同一连接上 download_end 一定在该传输的全部数据块之后到达，
+    所以界面线程处理 download_end 时数据已经全部写入磁盘。
+    私发文件的 relay_begin / relay_end / relay_error 分别对应 download_begin / download_end / download_error。
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.downloads = {}
+
+    def request(self, sender, filename, save_path):
+        """向服务器请求下载文件（有 .part 文件时从其末尾继续），返回 Download"""
+        transfer_id = next_transfer_id()
+        download = Download(filename, save_path)
+        with self.lock:
+            self.downloads[transfer_id] = download
+        try:
+            sender.send_json({
+                'type': 'download',
+                'transfer_id': transfer_id,
+                'filename': filename,
+                'offset': download.offset
+            })
+        except Exception:
+            self.pop(transfer_id)
+            raise
+        return download
+
+    def receive(self, data, save_path):
+        """处理 relay_begin：登记一个私发给自己的文件，必须在它的数据块到达之前调用"""
+        download = Download(data['filename'], save_path, resumable=False)
+        download.size = data['size']
+        with self.lock:
+            self.downloads[data['transfer_id']] = download
+        return download
+
+    def write_chunk(self, payload):
+        """把一个数据块写入对应的文件，不是下载的数据块时返回 False"""
+        transfer_id, data = parse_chunk(payload)
+        download = self.downloads.get(transfer_id)
+        if download is None:
+            return False
+        download.write(data)
+        return True
+
+    def get(self, transfer_id):
+        return self.downloads.get(transfer_id)
+
+    def pop(self, transfer_id):
+        with self.lock:
+            return self.downloads.pop(transfer_id, None)
+
+    def begin(self, data):
+        """处理 download_begin，返回对应的下载"""
+        download = self.downloads.get(data['transfer_id'])
+        if download is not None:
+            download.size = data['size']
+            download.expected_hash = data.get('hash')
+        return download
+
+    def finish(self, data):
+        """处理 download_end，返回 (下载, 保存路径)，失败时删除 .part 并抛出异常"""
+        download = self.pop(data['transfer_id'])
+        if download is None:
+            return None, None
+        try:
+            return download, download.finish(data['size'])
+        except Exception:
+            download.abort()
+            raise
+
+    def fail(self, data):
+        """处理 download_error，返回对应的下载"""
+        download = self.pop(data['transfer_id'])
+        if download is not None:
+            download.abort()
+        return download
+
+    def close_all(self):
+        """连接断开：关闭所有下载，保留 .part 文件以便下次续传（私发的文件无法续传，直接删除）"""
+        with self.lock:
+            downloads = list(self.downloads.values())
+            self.downloads.clear()
+        for download in downloads:
+            if download.resumable:
+                download.close()
+            else:
+                download.abort()
+
+
+def can_download_parallel(size):
+    """文件是否适合分段并行下载（Windows 没有 os.pwrite）"""
+    return hasattr(os, 'pwrite') and size >= PARALLEL_MIN_SIZE
+
+
+def split_ranges(size, streams):
+    """把 [0, size) 分成 streams 段，返回 [(offset, length), ...]"""
+    streams = max(1, min(streams, size // CHUNK_SIZE or 1))
+    step = -(-size // streams)
+    return [(offset, min(step, size - offset)) for offset in range(0, size, step)] or [(0, 0)]
+
+
+def recv_exact(sock, view):
+    """把 view 填满，连接断开时抛出 ConnectionError"""
+    while len(view):
+        n = sock.recv_into(view)
+        if not n:
+            raise ConnectionError("连接已断开")
+        view = view[n:]
+
+
+class ParallelDownload:
+    """通过多个传输连接分段下载一个文件
+
+    每个连接以 {'type': 'transfer', 'username': ..., 'token': ...} 登录，token 是欢迎消息中的 transfer_token，
+    服务器把它当作该用户的辅助连接，只处理下载请求。数据块直接用 recv_into 收到固定的缓冲区再 os.pwrite 到目标位置，不做额外拷贝。
+    """
+
+    def __init__(self, address, username, token, filename, save_path, size, expected_hash=None,
+                 streams=PARALLEL_STREAMS):
+        self.address = address
+        self.username = username
+        self.token = token
+        self.filename = filename
+        self.save_path = save_path
+        self.part_path = save_path + PARALLEL_SUFFIX
+        self.size = size
+        self.expected_hash = expected_hash
+        self.streams = streams
+        self.errors = []
+
+    def run(self):
+        """下载并校验，成功时返回保存路径，失败时删除临时文件并抛出异常"""
+        try:
+            fd = os.open(self.part_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                self._preallocate(fd)
+                threads = []
+                for offset, length in split_ranges(self.size, self.streams):
+                    thread = threading.Thread(target=self._fetch_range, args=(fd, offset, length),
+                                              daemon=True)
+                    thread.start()
+                    threads.append(thread)
+                for thread in threads:
+                    thread.join()
+            finally:
+                os.close(fd)
+            if self.errors:
+                raise self.errors[0]
+            if self.expected_hash is not None and file_hash(self.part_path) != self.expected_hash:
+                raise IOError("文件校验失败，请重新下载")
+            os.replace(self.part_path, self.save_path)
+            return self.save_path
+        except Exception:
+            try:
+                os.remove(self.part_path)
+            except OSError:
+                pass
+            raise
+
+    def _preallocate(self, fd):
+        if not self.size:
+            return
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, self.size)
+                return
+            except OSError:
+                pass  # 某些文件系统不支持，退回 ftruncate
+        os.ftruncate(fd, self.size)
+
+    def _fetch_range(self, fd, offset, length):
+        try:
+            sock = socket.create_connection(self.address, timeout=PARALLEL_TIMEOUT)
+        except OSError as e:
+            self.errors.append(e)
+            return
+        try:
+            send_json(sock, {'type': 'transfer', 'username': self.username, 'token': self.token})
+            send_json(sock, {
+                'type': 'download',
+                'transfer_id': 1,
+                'filename': self.filename,
+                'offset': offset,
+                'length': length
+            })
+            self._receive_range(sock, fd, offset, length)
+        except Exception as e:
+            self.errors.append(e)
+        finally:
+            sock.close()
+
+    def _receive_range(self, sock, fd, offset, length):
+        header = bytearray(HEADER_SIZE + TRANSFER_ID.size)
+        buffer = bytearray(RECV_BUFFER_SIZE)
+        view = memoryview(buffer)
+        position = offset
+        while True:
+            if self.errors:
+                raise ConnectionError("其他分段下载失败")
+            recv_exact(sock, memoryview(header)[:HEADER_SIZE])
+            frame_type, frame_length = HEADER.unpack_from(header)
+            if frame_type == FRAME_CHUNK:
+                recv_exact(sock, memoryview(header)[HEADER_SIZE:])
+                remaining = frame_length - TRANSFER_ID.size
+                if position + remaining > offset + length:
+                    raise IOError("服务器发送的数据超出了请求的范围")
+                while remaining:
+                    n = sock.recv_into(view, min(remaining, len(buffer)))
+                    if not n:
+                        raise ConnectionError("连接已断开")
+                    written = 0
+                    while written < n:
+                        written += os.pwrite(fd, view[written:n], position + written)
+                    position += n
+                    remaining -= n
+                continue
+
+            payload = bytearray(frame_length)
+            recv_exact(sock, memoryview(payload))
+            if frame_type != FRAME_JSON:
+                continue
+            data = decode_json(payload)
+            if data.get('type') == 'download_begin':
+                if data['size'] != self.size:
+                    raise IOError("服务器上的文件已经改变，请重新下载")
+                if self.expected_hash is None:
+                    self.expected_hash = data.get('hash')
+            elif data.get('type') == 'download_error':
+                raise IOError(data['error'])
+            elif data.get('type') == 'download_end':
+                if position != offset + length:
+                    raise IOError(f"分段不完整: 收到 {position - offset} / {length} 字节")
+                return
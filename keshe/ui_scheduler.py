@@ -0,0 +1,87 @@
+"""合并界面更新
+
+网络线程和其他后台线程不再为每条消息各发一个信号，而是把更新放进 UpdateCoalescer；
+界面线程按固定的帧率（UI_FPS）取出一批一起处理：
+
+- 聊天记录按到达顺序一次追加；
+- 完整的用户列表或文件列表会替换之前还没处理的列表和增量，只重建一次；
+- 同一个用户的多次上线、下线只保留最后一次，文件的新增和删除互相抵消。
+
+队列从空变为非空时调用 on_pending（由界面线程启动定时器），空闲时没有任何定时唤醒。
+不依赖 Qt，所有方法都可以在任意线程中调用。
+"""
+import threading
+
+UI_FPS = 50  # 每秒最多处理几批界面更新
+
+
+class UpdateBatch:
+    """一批待处理的界面更新"""
+
+    def __init__(self):
+        self.chat = []        # [(文本, 表情编号, 图片内容)]，纯文本的表情编号为 None
+        self.users = None     # 完整的用户列表，None 表示没有
+        self.presence = {}    # {用户名: 'join' 或 'leave'}，在完整列表之后应用
+        self.files = None     # 完整的文件列表，None 表示没有
+        self.added = {}       # 新增或更新的文件名（用 dict 保持顺序）
+        self.removed = set()  # 删除的文件名
+
+    def __bool__(self):
+        return bool(self.chat or self.users is not None or self.presence
+                    or self.files is not None or self.added or self.removed)
+
+
+class UpdateCoalescer:
+
+    def __init__(self, on_pending):
+        self.on_pending = on_pending
+        self.lock = threading.Lock()
+        self.batch = UpdateBatch()
+
+    def message(self, text):
+        self._add(lambda batch: batch.chat.append((text, None, None)))
+
+    def emoji(self, prefix, key, image_data=None):
+        self._add(lambda batch: batch.chat.append((prefix, key, image_data)))
+
+    def set_users(self, users):
+        def apply(batch):
+            batch.users = list(users)
+            batch.presence.clear()
+        self._add(apply)
+
+    def presence(self, op, user):
+        def apply(batch):
+            batch.presence.pop(user, None)  # 保持最后一次变化的顺序
+            batch.presence[user] = op
+        self._add(apply)
+
+    def set_files(self, files):
+        def apply(batch):
+            batch.files = list(files)
+            batch.added.clear()
+            batch.removed.clear()
+        self._add(apply)
+
+    def files_delta(self, added, removed):
+        def apply(batch):
+            for name in removed:
+                batch.added.pop(name, None)
+                batch.removed.add(name)
+            for name in added:
+                batch.removed.discard(name)
+                batch.added[name] = None
+        self._add(apply)
+
+    def take(self):
+        """取出当前的一批更新（在界面线程中调用）"""
+        with self.lock:
+            batch, self.batch = self.batch, UpdateBatch()
+        return batch
+
+    def _add(self, apply):
+        with self.lock:
+            was_empty = not self.batch
+            apply(self.batch)
+        if was_empty:
+            self.on_pending()
@@ -0,0 +1,160 @@
+"""服务器端的流式上传
+
+客户端先发送 upload_begin，然后用 FRAME_CHUNK 分块发送文件内容，最后发送 upload_end。
+数据块直接写入 server_files 中的隐藏临时文件，上传完成后再原子地重命名为目标文件，
+因此每个上传占用的内存是固定的，与文件大小无关，也没有 4 GiB 的限制。
+
+upload_begin 带有文件哈希时上传可以断点续传：临时文件按哈希和大小命名，
+连接断开后保留下来，客户端重新上传同一个文件时服务器通过 upload_ready 告诉它从哪里继续。
+写入可续传的临时文件前先对它加 flock 排他锁，多进程部署时两个工作进程也不会同时追加同一个文件。
+"""
+import os
+import re
+import tempfile
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows 没有 fcntl，也不支持多进程部署，只在进程内防止重复写入
+    fcntl = None
+
+from file_catalog import file_hash
+
+PARTIAL_PREFIX = '.upload-'
+PARTIAL_SUFFIX = '.part'
+PARTIAL_MAX_AGE = 24 * 3600  # 超过这个时间没有续传的临时文件会被清理
+
+HASH_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+_active_partials = set()  # 没有 fcntl 时正在写入的可续传临时文件
+
+
+class UploadError(Exception):
+    """上传失败"""
+
+
+def safe_filename(filename):
+    """只保留文件名部分，拒绝空文件名和服务器内部使用的隐藏文件名"""
+    name = os.path.basename(str(filename).replace('\\', '/'))
+    if not name or name.startswith('.'):
+        raise UploadError(f"非法的文件名: {filename}")
+    return name
+
+
+def cleanup_partials(directory, max_age=PARTIAL_MAX_AGE):
+    """删除长时间没有续传的临时文件，返回删除的数量"""
+    removed = 0
+    deadline = time.time() - max_age
+    with os.scandir(directory) as it:
+        for item in it:
+            if not (item.name.startswith(PARTIAL_PREFIX) and item.name.endswith(PARTIAL_SUFFIX)):
+                continue
+            try:
+                if item.stat().st_mtime < deadline:
+                    os.remove(item.path)
+                    removed += 1
+            except OSError:
+                pass
+    return removed
+
+
+class UploadSession:
+    """一个正在进行的上传"""
+
+    def __init__(self, directory, filename, size, expected_hash=None):
+        self.directory = directory
+        self.filename = safe_filename(filename)
+        self.size = int(size)
+        if self.size < 0:
+            raise UploadError(f"非法的文件大小: {size}")
+        self.expected_hash = expected_hash
+        if expected_hash is None:
+            fd, self.temp_path = tempfile.mkstemp(prefix=PARTIAL_PREFIX, suffix=PARTIAL_SUFFIX,
+                                                  dir=directory)
+            self.file = os.fdopen(fd, 'wb')
+            self.offset = 0
+        else:
+            self._open_partial()
+        self.received = self.offset
+
+    def _open_partial(self):
+        if not HASH_PATTERN.match(str(self.expected_hash)):
+            raise UploadError(f"非法的文件哈希: {self.expected_hash}")
+        name = f"{PARTIAL_PREFIX}{self.expected_hash}-{self.size}{PARTIAL_SUFFIX}"
+        self.temp_path = os.path.join(self.directory, name)
+        self.file = open(self.temp_path, 'ab')
+        if not self._lock():
+            self.file.close()
+            raise UploadError("该文件正在由其他连接上传")
+        self.offset = self.file.tell()
+        if self.offset > self.size:
+            self.file.truncate(0)
+            self.offset = 0
+
+    def _lock(self):
+        """对临时文件加排他锁（其他工作进程中的连接也看得到），已被锁住时返回 False"""
+        if fcntl is None:
+            if self.temp_path in _active_partials:
+                return False
+            _active_partials.add(self.temp_path)
+            return True
+        try:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return False
+        # 加锁之前文件可能刚被另一个连接上传完成并改名，锁住的已经不是这个路径上的临时文件
+        try:
+            current = os.stat(self.temp_path)
+        except OSError:
+            return False
+        opened = os.fstat(self.file.fileno())
+        return (current.st_dev, current.st_ino) == (opened.st_dev, opened.st_ino)
+
+    @property
+    def resumable(self):
+        return self.expected_hash is not None
+
+    def write(self, data):
+        if self.received + len(data) > self.size:
+            raise UploadError("收到的数据超过了声明的文件大小")
+        self.file.write(data)
+        self.received += len(data)
+
+    def finish(self):
+        """校验大小（和哈希）并把临时文件重命名为目标文件，返回文件名
+
+        需要读取整个文件计算哈希，应放到线程池中执行。
+        """
+        if self.received != self.size:
+            raise UploadError(f"文件不完整: 收到 {self.received} / {self.size} 字节")
+        # 改名之后才关闭文件（释放锁），校验期间其他连接不能续传这个临时文件
+        try:
+            self.file.flush()
+            if self.expected_hash is not None and file_hash(self.temp_path) != self.expected_hash:
+                raise UploadError("文件校验失败，内容与哈希不一致")
+            os.replace(self.temp_path, os.path.join(self.directory, self.filename))
+        finally:
+            self._close()
+        return self.filename
+
+    def suspend(self):
+        """连接断开：可续传的上传保留临时文件，否则删除"""
+        if self.resumable:
+            self._close()
+        else:
+            self.abort()
+
+    def abort(self):
+        """放弃上传并删除临时文件"""
+        self._close()
+        try:
+            os.remove(self.temp_path)
+        except OSError:
+            pass
+
+    def _close(self):
+        try:
+            self.file.close()
+        except OSError:
+            pass
+        _active_partials.discard(self.temp_path)